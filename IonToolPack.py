@@ -1,13 +1,65 @@
 import os
-import pandas as pd
 import sys
-from qc.utils import FormatDataframeSamples, export_mza_metadata
-from mirador.image_time_vs_mz import generate_TimeVsMzImages
-from mirador.image_time_vs_arrival_time import generate_TimeVsArrivalTimeImages
+import time
+import threading
 from tkinter import filedialog, Tk, Button, ttk, Entry, StringVar, Label, Scrollbar, Frame, Text, END
-import numpy as np
 import re
-from gui_tabs import call_backend_peakqc, call_backend_tandemmatch, call_backend_peakquant, call_backend_mirador, call_backend_comparefeatures
+
+# Backends (and pandas/numpy/matplotlib through them) are imported on first use, or preloaded in a background thread
+#   once the window is shown, so the window appears without waiting for every tool's imports.
+# Imports are written out (not importlib) so PyInstaller still bundles the backends.
+startTime = time.perf_counter()
+
+def FormatDataframeSamples(*args, **kwargs):
+    from qc.utils import FormatDataframeSamples
+    return FormatDataframeSamples(*args, **kwargs)
+
+def export_mza_metadata(*args, **kwargs):
+    from qc.utils import export_mza_metadata
+    return export_mza_metadata(*args, **kwargs)
+
+def generate_TimeVsMzImages(*args, **kwargs):
+    from mirador.image_time_vs_mz import generate_TimeVsMzImages
+    return generate_TimeVsMzImages(*args, **kwargs)
+
+def generate_TimeVsArrivalTimeImages(*args, **kwargs):
+    from mirador.image_time_vs_arrival_time import generate_TimeVsArrivalTimeImages
+    return generate_TimeVsArrivalTimeImages(*args, **kwargs)
+
+def call_backend_peakqc(*args, **kwargs):
+    from gui_tabs import call_backend_peakqc
+    return call_backend_peakqc(*args, **kwargs)
+
+def call_backend_tandemmatch(*args, **kwargs):
+    from gui_tabs import call_backend_tandemmatch
+    return call_backend_tandemmatch(*args, **kwargs)
+
+def call_backend_peakquant(*args, **kwargs):
+    from gui_tabs import call_backend_peakquant
+    return call_backend_peakquant(*args, **kwargs)
+
+def call_backend_mirador(*args, **kwargs):
+    from gui_tabs import call_backend_mirador
+    return call_backend_mirador(*args, **kwargs)
+
+def call_backend_comparefeatures(*args, **kwargs):
+    from gui_tabs import call_backend_comparefeatures
+    return call_backend_comparefeatures(*args, **kwargs)
+
+def PreloadBackends():
+    # Imports the backends in a background thread, a button clicked meanwhile waits for the import of its module
+    def preload():
+        try:
+            import pandas
+            import qc.utils
+            import mirador.image_time_vs_mz
+            import mirador.image_time_vs_arrival_time
+            import gui_tabs
+        except ImportError as e:
+            print("Warning: backend not preloaded: " + str(e))
+    thread = threading.Thread(target=preload, daemon=True)
+    thread.start()
+    return thread
 
 class MainApplication:
     def __init__(self, root):
@@ -55,6 +107,7 @@ class MainApplication:
 
 
     def import_list_ms_runs(self):
+        import pandas as pd
         csv_file_path = filedialog.askopenfilename()
         print(csv_file_path)
         separator = "\t"
@@ -82,6 +135,7 @@ class MainApplication:
 
 
     def import_list_ms_runs_clipboard(self):
+        import pandas as pd
         runs = []
         paths = []
         cb = root.clipboard_get()
@@ -333,4 +387,18 @@ if __name__ == "__main__":
         command=lambda: call_backend_comparefeatures(tbox_params_comparefeatures.get("1.0", END)), 
                                                        bg='#f5f5f5').pack(pady=2)
 
+    # Startup benchmark (benchmarks/bench_gui_startup.py): print the time to window and to loaded backends, then exit
+    benchmark = os.environ.get("IONTOOLPACK_STARTUP_BENCHMARK", "") != ""
+    def windowShown():
+        if benchmark:
+            print("window " + str(time.perf_counter() - startTime), flush=True)
+        waitPreload(PreloadBackends())
+    def waitPreload(thread):
+        # Tk is only called from the main thread: poll the preload thread
+        if thread.is_alive():
+            root.after(20, waitPreload, thread)
+        elif benchmark:
+            print("backends " + str(time.perf_counter() - startTime), flush=True)
+            root.destroy()
+    root.after_idle(windowShown)
     root.mainloop()
\ No newline at end of file
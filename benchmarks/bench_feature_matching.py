@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qc.feature_matching import MatchFeatures, MatchFeatureLists
+
+# Benchmark of the CompareFeatures matching: m/z sweep engine vs. pairwise comparison of all features.
+# Usage: python benchmarks/bench_feature_matching.py [nLists]
+#
+# Synthetic lists of 10k, 100k and 1M features (m/z 100-1200, RT 0-30 min, AT 10-50 ms), each list a noisy copy of
+# the same features. The pairwise comparison is timed on lists of 10k features only and must find the same pairs.
+
+MZ_TOLERANCE = 0.005
+RT_TOLERANCE = 0.3
+AT_TOLERANCE = 0.1
+
+
+def SyntheticFeatureLists(nFeatures, nLists, rng):
+    mzs = rng.uniform(100, 1200, nFeatures)
+    rts = rng.uniform(0, 30, nFeatures)
+    ats = rng.uniform(10, 50, nFeatures)
+    return {f"method{k}": pd.DataFrame({"MZ": mzs + rng.normal(0, 0.001, nFeatures),
+                                        "RT": rts + rng.normal(0, 0.05, nFeatures),
+                                        "AT": ats + rng.normal(0, 0.02, nFeatures)}) for k in range(nLists)}
+
+
+def LegacyMatchFeatures(dfA, dfB, mzTolerance=MZ_TOLERANCE, rtTolerance=RT_TOLERANCE, atTolerance=AT_TOLERANCE):
+    mzB = dfB["MZ"].to_numpy()
+    rtB = dfB["RT"].to_numpy()
+    atB = dfB["AT"].to_numpy()
+    pairs = []
+    for i, (mz, rt, at) in enumerate(zip(dfA["MZ"], dfA["RT"], dfA["AT"])):
+        for j in np.flatnonzero((np.abs(mzB - mz) <= mzTolerance) & (np.abs(rtB - rt) <= rtTolerance) & (np.abs(atB - at) <= atTolerance)):
+            pairs.append((i, j))
+    return pairs
+
+
+if __name__ == "__main__":
+    nLists = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = np.random.default_rng(0)
+    for nFeatures in [10000, 100000, 1000000]:
+        lists = SyntheticFeatureLists(nFeatures, nLists, rng)
+        [dfA, dfB] = list(lists.values())[:2]
+        start = time.perf_counter()
+        pairs = MatchFeatures(dfA, dfB, MZ_TOLERANCE, RT_TOLERANCE, AT_TOLERANCE)
+        pairTime = time.perf_counter() - start
+        start = time.perf_counter()
+        groups = MatchFeatureLists(lists, MZ_TOLERANCE, RT_TOLERANCE, AT_TOLERANCE)
+        groupTime = time.perf_counter() - start
+        print(f"{nFeatures} features: 2 lists {pairTime:.2f} s ({len(pairs)} pairs), "
+              f"{nLists} lists {groupTime:.2f} s ({groups['GROUP'].nunique()} groups, {(groups['NLISTS'] == nLists).mean():.1%} features in all lists)")
+        if nFeatures == 10000:
+            start = time.perf_counter()
+            legacy = LegacyMatchFeatures(dfA, dfB)
+            legacyTime = time.perf_counter() - start
+            same = set(legacy) == set(zip(pairs["INDEXA"], pairs["INDEXB"]))
+            print(f"{nFeatures} features: pairwise comparison {legacyTime:.2f} s ({len(legacy)} pairs, same pairs: {same})")
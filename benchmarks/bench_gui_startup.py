@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+import subprocess
+
+# Benchmark of the IonToolPack GUI startup: time to window and time to loaded backends (first result possible without
+# waiting for imports), vs. the previous startup importing every backend before the window.
+# Usage: python benchmarks/bench_gui_startup.py [repeats]
+#
+# Requires a display. The GUI prints its timings when IONTOOLPACK_STARTUP_BENCHMARK is set and exits once the backends
+# are loaded. The eager baseline is the import time of the backends in a fresh interpreter, added before the window.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+EAGER_IMPORTS = "import pandas, numpy, qc.utils, mirador.image_time_vs_mz, mirador.image_time_vs_arrival_time, gui_tabs"
+
+
+def RunGui():
+    env = dict(os.environ, IONTOOLPACK_STARTUP_BENCHMARK="1")
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "IonToolPack.py"], cwd=ROOT, env=env, capture_output=True, text=True).stdout
+    total = time.perf_counter() - start
+    timings = dict(line.split() for line in output.splitlines() if line.startswith(("window ", "backends ")))
+    return [float(timings.get("window", "nan")), float(timings.get("backends", "nan")), total]
+
+
+def EagerImportTime():
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", EAGER_IMPORTS], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        print("eager imports failed: " + result.stderr.strip().splitlines()[-1])
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    runs = [RunGui() for k in range(repeats)]
+    eager = min(EagerImportTime() for k in range(repeats))
+    window = min(x[0] for x in runs)
+    backends = min(x[1] for x in runs)
+    print(f"time to window: {window:.2f} s (previous startup: about {window + eager:.2f} s with {eager:.2f} s of backend imports first)")
+    print(f"time to loaded backends: {backends:.2f} s, process total {min(x[2] for x in runs):.2f} s")
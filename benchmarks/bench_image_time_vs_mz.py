@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from PIL import Image
+from matplotlib.colors import LinearSegmentedColormap
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qc.image_time_vs_mz import GenerateImageTimeVsMz
+from benchmarks.synthetic_mza import WriteSyntheticMza
+
+# Benchmark of the time-vs-m/z image: array-based engine vs. the previous per-point dictionary engine.
+# Usage: python benchmarks/bench_image_time_vs_mz.py [nFrames] [pointsPerSpectrum]
+#
+# Tolerance: the array engine sums intensities in float64 (the previous engine summed in the
+# dtype of the stored intensities, float32 for most files). Pixels are identical except for bins
+# whose sum lies within float32 rounding of an intensity threshold or of a power of 10, which the
+# benchmark reports as the number of differing pixels.
+
+def LegacyGenerateImageTimeVsMz(mzaFile, outputFullPath, LcmsImageMinIntensityPercentage=10, LcmsImageMaxIntensityCeilingPercentage=70):
+    mza = h5py.File(mzaFile, 'r')
+    metadata = mza["Metadata"]
+    metadata = metadata[(metadata["MSLevel"] == 1) & (metadata["IonMobilityBin"] == 0)]
+    metadata = metadata[np.argsort(metadata["RetentionTime"])]
+    lcms = {}
+    maxMz = 0
+    maxIntensity = 0
+    for k in range(0, metadata.size):
+        scan = metadata["Scan"][k]
+        mzapath = str(metadata["MzaPath"][k], 'utf-8')
+        mz_array = None
+        if "Full_mz_array" in mza:
+            full_mz = mza["Full_mz_array"][:]
+            mzbins = mza["Arrays_mzbin" + mzapath + "/" + str(scan)][:]
+            mz_array = np.array([full_mz[i] for i in mzbins])
+        else:
+            mz_array = np.array(mza["Arrays_mz" + mzapath + "/" + str(scan)][:])
+        intensities_array = mza["Arrays_intensity" + mzapath + "/" + str(scan)][:]
+        intensities_array = intensities_array/1000
+        spectrum = {}
+        for i in range(0, mz_array.size):
+            mzx = int(np.floor(mz_array[i]))
+            if mzx > maxMz:
+                maxMz = mzx
+            if mzx in spectrum:
+                spectrum[mzx] += intensities_array[i]
+            else:
+                spectrum[mzx] = intensities_array[i]
+        rtx = np.round(metadata["RetentionTime"][k], decimals=1)
+        if rtx in lcms:
+            for mzx in spectrum:
+                if mzx in lcms[rtx]:
+                    lcms[rtx][mzx] += spectrum[mzx]
+                else:
+                    lcms[rtx][mzx] = spectrum[mzx]
+        else:
+            lcms[rtx] = spectrum
+        maxIntx = np.max(list(lcms[rtx].values()))
+        if maxIntx > maxIntensity:
+            maxIntensity = maxIntx
+    mza.close()
+    width = int(np.max(list(lcms.keys())) * 10) + 1
+    height = maxMz + 1
+    img = Image.new('RGB', (width, height))
+    pixels = img.load()
+    colors = [(0, 0, 0.5), (1, 1, 0)]
+    cmap = LinearSegmentedColormap.from_list('mycmap', colors)
+    for i in lcms.keys():
+        for j in lcms[i].keys():
+            x = int(lcms[i][j])
+            if x < (maxIntensity * (LcmsImageMinIntensityPercentage/100)):
+                continue
+            x = int(np.log10(lcms[i][j]))
+            x /= np.log10(maxIntensity * (LcmsImageMaxIntensityCeilingPercentage/100))
+            x = np.array(cmap(x)[0:3])
+            x *= 255
+            pixels[int(i*10), maxMz-j] = tuple(map(int,tuple(x)))
+    img.save(outputFullPath + ".jpg")
+    img.close()
+
+
+if __name__ == "__main__":
+    nFrames = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    pointsPerSpectrum = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        mzaFile = os.path.join(tmp, "synthetic.mza")
+        WriteSyntheticMza(mzaFile, nFrames=nFrames, pointsPerSpectrum=pointsPerSpectrum)
+
+        start = time.perf_counter()
+        LegacyGenerateImageTimeVsMz(mzaFile, os.path.join(tmp, "before"))
+        before = time.perf_counter() - start
+        start = time.perf_counter()
+        GenerateImageTimeVsMz(mzaFile, os.path.join(tmp, "after"))
+        after = time.perf_counter() - start
+
+        with open(os.path.join(tmp, "before.jpg"), "rb") as f1, open(os.path.join(tmp, "after.jpg"), "rb") as f2:
+            identical = f1.read() == f2.read()
+        diff = np.array(Image.open(os.path.join(tmp, "before.jpg"))).astype(int) - np.array(Image.open(os.path.join(tmp, "after.jpg")))
+        print(f"spectra: {nFrames}, points per spectrum: {pointsPerSpectrum}")
+        print(f"before: {before:.2f} s, after: {after:.2f} s, speedup: {before/after:.1f}x")
+        print(f"JPEG byte-identical: {identical}, differing pixels: {np.count_nonzero(np.abs(diff).sum(axis=2))}")
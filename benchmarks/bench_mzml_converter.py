@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import zlib
+import base64
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qc.mzml_converter import ConvertMzmlToMza
+from qc.mza_reader import OpenMza
+
+# Benchmark of the Python mzML to mza converter: throughput (MB of mzML per second) and peak memory vs. file size.
+# Usage: python benchmarks/bench_mzml_converter.py [pointsPerSpectrum]
+#
+# Synthetic mzML files (MS1 scans followed by 10 MS/MS scans, zlib compressed 64-bit m/z and 32-bit intensity arrays).
+# Peak memory is measured with tracemalloc (Python and NumPy allocations, not the HDF5 library buffers) and must stay
+# flat as the file size grows.
+
+
+def EncodeArray(values):
+    return base64.b64encode(zlib.compress(values.tobytes())).decode("ascii")
+
+
+def WriteSyntheticMzml(mzmlFile, nSpectra, pointsPerSpectrum=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    with open(mzmlFile, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n<run id="run">\n')
+        f.write(f'<spectrumList count="{nSpectra}">\n')
+        for k in range(nSpectra):
+            msLevel = 1 if k % 11 == 0 else 2
+            mz = np.sort(rng.uniform(50, 1200, pointsPerSpectrum))
+            intensity = rng.exponential(500, pointsPerSpectrum).astype(np.float32)
+            precursor = ""
+            if msLevel == 2:
+                target = 400 + 50 * (k % 11)
+                precursor = ('<precursorList count="1"><precursor><isolationWindow>'
+                             f'<cvParam cvRef="MS" accession="MS:1000827" name="isolation window target m/z" value="{target}"/>'
+                             '<cvParam cvRef="MS" accession="MS:1000828" name="isolation window lower offset" value="25"/>'
+                             '<cvParam cvRef="MS" accession="MS:1000829" name="isolation window upper offset" value="25"/>'
+                             '</isolationWindow></precursor></precursorList>')
+            f.write(f'<spectrum index="{k}" id="scan={k + 1}" defaultArrayLength="{pointsPerSpectrum}">'
+                    f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{msLevel}"/>'
+                    f'<scanList count="1"><scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{k * 0.1:.3f}" unitAccession="UO:0000010"/></scan></scanList>'
+                    f'{precursor}<binaryDataArrayList count="2">'
+                    '<binaryDataArray><cvParam cvRef="MS" accession="MS:1000523"/><cvParam cvRef="MS" accession="MS:1000574"/><cvParam cvRef="MS" accession="MS:1000514"/>'
+                    f'<binary>{EncodeArray(mz)}</binary></binaryDataArray>'
+                    '<binaryDataArray><cvParam cvRef="MS" accession="MS:1000521"/><cvParam cvRef="MS" accession="MS:1000574"/><cvParam cvRef="MS" accession="MS:1000515"/>'
+                    f'<binary>{EncodeArray(intensity)}</binary></binaryDataArray>'
+                    '</binaryDataArrayList></spectrum>\n')
+        f.write('</spectrumList>\n</run>\n</mzML>\n')
+
+
+if __name__ == "__main__":
+    pointsPerSpectrum = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as folder:
+        for nSpectra in [1000, 4000, 16000]:
+            mzmlFile = os.path.join(folder, f"run{nSpectra}.mzML")
+            mzaFile = os.path.join(folder, f"run{nSpectra}.mza")
+            WriteSyntheticMzml(mzmlFile, nSpectra, pointsPerSpectrum)
+            size = os.path.getsize(mzmlFile) / 1024**2
+            tracemalloc.start()
+            start = time.perf_counter()
+            ConvertMzmlToMza(mzmlFile, mzaFile, minIntensity=20)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] / 1024**2
+            tracemalloc.stop()
+            with OpenMza(mzaFile) as mza:
+                converted = mza.metadata.size
+            print(f"{nSpectra} spectra, {size:.0f} MB mzML: {seconds:.2f} s, {size / seconds:.1f} MB/s, "
+                  f"{nSpectra / seconds:.0f} spectra/s, peak memory {peak:.1f} MB, mza {os.path.getsize(mzaFile) / 1024**2:.0f} MB ({converted} spectra)")
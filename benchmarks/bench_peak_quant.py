@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qc.peak_quant import QuantifyRun
+from qc.mza_reader import OpenMza
+from benchmarks.synthetic_mza import WriteSyntheticMza
+
+# Benchmark of the PeakQuant MS1 extraction: block engine vs. one XIC per target (GetExtractedIonRetention).
+# Usage: python benchmarks/bench_peak_quant.py [nTargets] [nFrames] [pointsPerSpectrum]
+#
+# Both engines sum the same intensities within the RT window of each target (the block engine stores the XICs in
+# float32), the benchmark reports the maximum relative difference. The XIC per target is timed on the first 200 targets only.
+
+MZ_TOLERANCE_HALFWIDTH = 0.01
+
+
+def LegacyQuantifyRun(mzaFile, targets, mztolhalfwidth=MZ_TOLERANCE_HALFWIDTH):
+    abundances = []
+    with OpenMza(mzaFile) as mza:
+        for mz, rt, rtHalfWindow in zip(targets["MZ"], targets["RT"], targets["RTVIEWHALFWINDOW"]):
+            xic = mza.GetExtractedIonRetention(mz, 1, rt - rtHalfWindow, rt + rtHalfWindow, mztolhalfwidth)
+            abundances.append(sum([x/1000 for x in xic["intensity"]]))
+    return np.array(abundances)
+
+
+if __name__ == "__main__":
+    nTargets = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nFrames = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    pointsPerSpectrum = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    rng = np.random.default_rng(0)
+    targets = pd.DataFrame({"MOLECULE": [f"target{k}" for k in range(nTargets)],
+                            "MZ": rng.uniform(60, 1190, nTargets),
+                            "RT": rng.uniform(0.5, 9.5, nTargets),
+                            "RTVIEWHALFWINDOW": 0.5})
+    peaks = [(mz, rt, 0) for mz, rt in zip(targets["MZ"][:200], targets["RT"][:200])]
+    with tempfile.TemporaryDirectory() as folder:
+        mzaFile = os.path.join(folder, "run.mza")
+        WriteSyntheticMza(mzaFile, nFrames, pointsPerSpectrum, targets=peaks)
+        start = time.perf_counter()
+        abundances = QuantifyRun(mzaFile, targets, MZ_TOLERANCE_HALFWIDTH)
+        blockTime = time.perf_counter() - start
+        start = time.perf_counter()
+        legacy = LegacyQuantifyRun(mzaFile, targets[:200])
+        legacyTime = time.perf_counter() - start
+    print(f"block engine: {blockTime:.2f} s for {nTargets} targets x {nFrames} scans")
+    print(f"XIC per target: {legacyTime:.2f} s for 200 targets ({legacyTime / 200 * nTargets:.0f} s estimated for {nTargets})")
+    print(f"max relative difference: {np.max(np.abs(abundances[:200] - legacy) / np.maximum(legacy, 1e-9)):.2e}")
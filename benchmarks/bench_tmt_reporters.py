@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from qc.tmt_reporters import ReadReporterFragments, ExtractReporterIntensities
+from qc.mza_reader import OpenMza, SumIntensityWindows
+from benchmarks.synthetic_mza import WriteSyntheticMza
+
+# Benchmark of the TMT reporter extraction: block engine vs. one SumIntensityWindows lookup per (scan, channel).
+# Usage: python benchmarks/bench_tmt_reporters.py [nFrames] [pointsPerSpectrum]
+#
+# The synthetic MS run has 10 MS/MS windows per MS1 scan and peaks at the TMTpro reporter m/z.
+# Both engines sum the intensities within the same windows, the benchmark reports the maximum difference.
+
+REPORTERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ReporterFragmentsTMTpro.tsv")
+MZ_TOLERANCE_HALFWIDTH = 0.003
+
+
+def LegacyExtractReporterIntensities(mzaFile, reporterMzs, mztolhalfwidth=MZ_TOLERANCE_HALFWIDTH):
+    with OpenMza(mzaFile) as mza:
+        rows = mza.GetRows(msLevel=2)
+        intensities = np.zeros((rows.size, len(reporterMzs)), dtype=np.float32)
+        for i, row in enumerate(rows):
+            mz_array, intensity_array = mza.ReadSpectrum(row)
+            for k, mz in enumerate(reporterMzs):
+                intensities[i, k] = SumIntensityWindows(mz_array, intensity_array, [mz - mztolhalfwidth], [mz + mztolhalfwidth])[0]
+    return [rows, intensities]
+
+
+if __name__ == "__main__":
+    nFrames = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    pointsPerSpectrum = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    [names, reporterMzs] = ReadReporterFragments(REPORTERS_FILE)
+    windows = [(400 + 50 * k, 25, 25) for k in range(10)]
+    targets = [(mz, rt, 0) for mz in reporterMzs for rt in np.linspace(0.5, 9.5, 10)]
+    with tempfile.TemporaryDirectory() as folder:
+        mzaFile = os.path.join(folder, "run.mza")
+        WriteSyntheticMza(mzaFile, nFrames, pointsPerSpectrum, targets=targets, ms2Windows=windows, mzRange=(100, 1200))
+        start = time.perf_counter()
+        [rows, intensities] = ExtractReporterIntensities(mzaFile, reporterMzs, MZ_TOLERANCE_HALFWIDTH)
+        blockTime = time.perf_counter() - start
+        start = time.perf_counter()
+        [legacyRows, legacyIntensities] = LegacyExtractReporterIntensities(mzaFile, reporterMzs)
+        legacyTime = time.perf_counter() - start
+    print(f"{rows.size} MS/MS scans x {len(reporterMzs)} channels")
+    print(f"block engine: {blockTime:.2f} s, {rows.size / blockTime:.0f} scans/sec")
+    print(f"per-lookup loop: {legacyTime:.2f} s, {rows.size / legacyTime:.0f} scans/sec")
+    print(f"max difference: {np.abs(intensities - legacyIntensities).max() if rows.size > 0 else 0}")
@@ -0,0 +1,57 @@
+import h5py
+import numpy as np
+
+# WriteSyntheticMza
+# Writes a small MZA-like HDF5 file (Metadata table plus one dataset per spectrum) for benchmarks.
+# Targets are (mz, rt, at) tuples added as Gaussian peaks in RT (and AT for ion mobility data).
+
+METADATA_DTYPE = np.dtype([("Scan", np.int32),
+                           ("MSLevel", np.int32),
+                           ("RetentionTime", np.float32),
+                           ("IonMobilityBin", np.int32),
+                           ("IonMobilityTime", np.float32),
+                           ("MzaPath", "S16"),
+                           ("TIC", np.float64),
+                           ("IsolationWindowTargetMz", np.float64),
+                           ("IsolationWindowLowerOffset", np.float64),
+                           ("IsolationWindowUpperOffset", np.float64)])
+
+def WriteSyntheticMza(mzaFile, nFrames=600, pointsPerSpectrum=2000, targets=(), imBins=0, ms2Windows=(), maxRT=10.0, mzRange=(50, 1200), seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    arrays = []
+    scan = 0
+    for rt in np.linspace(0.05, maxRT, nFrames):
+        # MS1 (total frame spectrum for ion mobility data) followed by MS2 windows
+        for msLevel, window in [(1, None)] + [(2, w) for w in ms2Windows]:
+            for imBin in range(0, imBins + 1):
+                if imBins > 0 and imBin == 0:
+                    at = 0
+                else:
+                    at = imBin * 0.5
+                scan += 1
+                mz = np.sort(rng.uniform(mzRange[0], mzRange[1], pointsPerSpectrum))
+                intensity = rng.exponential(500, pointsPerSpectrum).astype(np.float32)
+                for (tmz, trt, tat) in targets:
+                    if window is not None and not (window[0] - window[1] <= tmz <= window[0] + window[2]):
+                        continue
+                    peak = 1e6 * np.exp(-0.5 * ((rt - trt) / 0.05) ** 2)
+                    if imBin > 0:
+                        peak *= np.exp(-0.5 * ((at - tat) / 0.3) ** 2)
+                    if peak < 1:
+                        continue
+                    # profile peak of 7 points around the target m/z
+                    peakMz = tmz + np.linspace(-0.003, 0.003, 7)
+                    index = np.searchsorted(mz, peakMz)
+                    mz = np.insert(mz, index, peakMz)
+                    intensity = np.insert(intensity, index, (peak * np.exp(-0.5 * (np.linspace(-3, 3, 7) / 1.2) ** 2)).astype(np.float32))
+                target, lower, upper = (0, 0, 0) if window is None else window
+                rows.append((scan, msLevel, rt, imBin, at, b"/" + str(scan // 10000).encode(), intensity.sum(), target, lower, upper))
+                arrays.append((mz, intensity))
+
+    with h5py.File(mzaFile, "w") as mza:
+        mza.create_dataset("Metadata", data=np.array(rows, dtype=METADATA_DTYPE))
+        for row, (mz, intensity) in zip(rows, arrays):
+            mzapath = str(row[5], "utf-8")
+            mza.create_dataset("Arrays_mz" + mzapath + "/" + str(row[0]), data=mz)
+            mza.create_dataset("Arrays_intensity" + mzapath + "/" + str(row[0]), data=intensity)
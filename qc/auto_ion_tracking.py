@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
+from contextlib import ExitStack
 from qc.ion_batch import GetHighResCoordinates
+from qc.mza_reader import MzaReader
 
 def DetectTopmostIons(dfions, dfruns, topIons=4, minMzDistDetectCentroidMS=0.005):
     dfions = dfions.copy()
@@ -33,13 +35,17 @@ def DetectTopmostIons(dfions, dfruns, topIons=4, minMzDistDetectCentroidMS=0.005
     dfruns = dfruns.copy()
     dfruns.drop_duplicates(['LABELSAMPLEGROUP'], inplace=True, keep='first')
     dfruns.reset_index(inplace=True, drop=True)
-    for k in dftopmost.index:
-        ionmz = dftopmost["MZ"][k]
-        ionrt = dftopmost["RT"][k]/10 # <- ToDo: correct scaling in PCA.py
-        mzaFile = list(dfruns["MZAPATH"][dfruns["LABELSAMPLEGROUP"] == (dftopmost["LABELSAMPLEGROUP"][k])])[0] + ".mza"
-        [ionmz,ionrt] = GetHighResCoordinates(mzaFile, ionmz, ionrt, rtrange=1, mzrange=1, minMzDistCentroid=minMzDistDetectCentroidMS) # these tolerances must be kept at unit resolution
-        dftopmost.loc[k,"MZ"] = ionmz
-        dftopmost.loc[k,"RT"] = ionrt 
+    mzaReaders = {} # keep mza files open to reuse decoded spectra across ions of the same MS run
+    with ExitStack() as stack: # mza files are closed even if an ion fails
+        for k in dftopmost.index:
+            ionmz = dftopmost["MZ"][k]
+            ionrt = dftopmost["RT"][k]/10 # <- ToDo: correct scaling in PCA.py
+            mzaFile = list(dfruns["MZAPATH"][dfruns["LABELSAMPLEGROUP"] == (dftopmost["LABELSAMPLEGROUP"][k])])[0] + ".mza"
+            if mzaFile not in mzaReaders:
+                mzaReaders[mzaFile] = stack.enter_context(MzaReader(mzaFile))
+            [ionmz,ionrt] = GetHighResCoordinates(mzaReaders[mzaFile], ionmz, ionrt, rtrange=1, mzrange=1, minMzDistCentroid=minMzDistDetectCentroidMS) # these tolerances must be kept at unit resolution
+            dftopmost.loc[k,"MZ"] = ionmz
+            dftopmost.loc[k,"RT"] = ionrt 
     
     dftopmost = dftopmost[(dftopmost["MZ"] > 0) & (dftopmost["RT"] > 0)]
     dftopmost.sort_values(by=["LABELSAMPLEGROUP", "rtRegion", "FREQ", "INTENSITY"], ascending=[True, True, False, False], inplace=True)
@@ -0,0 +1,68 @@
+import os
+import h5py
+import hdf5plugin
+import numpy as np
+
+# Compact spectrum layout
+# Optional group written into an mza file after conversion (Compact/ms<level>) with all spectra of an MS level
+#   concatenated in CSR layout: mz and intensity arrays, offsets (spectrum k is offsets[k]:offsets[k+1]) and the Metadata
+#   row of each spectrum. Spectra are ordered by partition (total frame spectra or spectra without ion mobility, then ion
+#   mobility scans) and retention time, so whole-run and RT-window reads are a few large sequential reads of big chunks
+#   instead of one small dataset per spectrum. MzaReader uses this layout when present.
+# The group stores the number of Metadata rows and is ignored if it does not match.
+
+COMPACT_GROUP = "Compact"
+COMPACT_VERSION = 1
+COMPACT_CHUNK = 1024**2 # points per chunk
+
+
+def CompactLayoutPath(mzaFile):
+    # temporary file of the compact layout before it is copied into the mza file
+    return os.path.splitext(mzaFile)[0] + ".compact.tmp"
+
+
+def IsCompactMza(mza):
+    # mza: open h5py File
+    return (COMPACT_GROUP in mza and mza[COMPACT_GROUP].attrs.get("version") == COMPACT_VERSION
+            and mza[COMPACT_GROUP].attrs.get("rows") == mza["Metadata"].shape[0])
+
+
+def WriteCompactLayout(mzaFile, levels):
+    # levels: iterable of (msLevel, rows, blocks) with the Metadata rows of an MS level in layout order and an iterable
+    #   of blocks of their spectra ([mz_array, intensity_array] lists), a generator keeps only one block in memory.
+    # The layout is written to a temporary file, copied into the mza file by AttachCompactLayout.
+    compression = hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+    with h5py.File(CompactLayoutPath(mzaFile), "w") as f:
+        for [msLevel, rows, blocks] in levels:
+            group = f.create_group("ms" + str(msLevel))
+            mz = group.create_dataset("mz", shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(COMPACT_CHUNK,), **compression)
+            intensity = group.create_dataset("intensity", shape=(0,), maxshape=(None,), dtype=np.float32, chunks=(COMPACT_CHUNK,), **compression)
+            offsets = [np.zeros(1, dtype=np.int64)]
+            for spectra in blocks:
+                sizes = np.array([x[0].size for x in spectra], dtype=np.int64)
+                offsets.append(offsets[-1][-1] + np.cumsum(sizes))
+                if sizes.sum() == 0:
+                    continue
+                size = mz.shape[0]
+                mz.resize((size + sizes.sum(),))
+                intensity.resize((size + sizes.sum(),))
+                mz[size:] = np.concatenate([x[0] for x in spectra])
+                intensity[size:] = np.concatenate([x[1] for x in spectra])
+            group.create_dataset("offsets", data=np.concatenate(offsets))
+            group.create_dataset("rows", data=np.asarray(rows, dtype=np.int64))
+
+
+def AttachCompactLayout(mzaFile):
+    # Copies the layout of WriteCompactLayout into the mza file (must not be open), the attributes are written last
+    #   and mark the group as complete
+    try:
+        with h5py.File(CompactLayoutPath(mzaFile), 'r') as f, h5py.File(mzaFile, 'r+') as mza:
+            if COMPACT_GROUP in mza:
+                del mza[COMPACT_GROUP]
+            group = mza.create_group(COMPACT_GROUP)
+            for name in f:
+                f.copy(f[name], group, name=name)
+            group.attrs["rows"] = mza["Metadata"].shape[0]
+            group.attrs["version"] = COMPACT_VERSION
+    finally:
+        os.remove(CompactLayoutPath(mzaFile))
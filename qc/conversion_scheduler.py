@@ -0,0 +1,87 @@
+import os
+import time
+import subprocess
+import pandas as pd
+from multiprocessing.pool import Pool
+from qc.mzml_converter import ConvertMzmlFile
+
+# Conversion scheduler
+# Runs the mza.exe conversions of a batch of raw files (mixed vendors) within a budget of cores: each job has a thread
+#   cost (Agilent .d files are converted with threads inside mza.exe, other formats with one thread), and jobs are
+#   started, largest cost first, as long as the cores in use stay within the budget (a job costing more than the budget
+#   runs alone). Output of mza.exe (stdout and stderr) is streamed to one log file per job, and the conversion time and
+#   size of the mza file of each job are returned.
+# mzML files converted in Python (see qc/mzml_converter.py) are jobs of the same budget costing one core, run in a process pool.
+
+
+class ConversionJob:
+    def __init__(self, name, args, mzaFile, threads=1):
+        self.name = name # MS run name, used for the log file
+        self.args = args # arguments of mza.exe
+        self.mzaFile = mzaFile
+        self.threads = threads
+
+
+class MzmlConversionJob:
+    def __init__(self, name, mzmlFile, mzaFile, minIntensity=0):
+        self.name = name
+        self.mzmlFile = mzmlFile
+        self.mzaFile = mzaFile
+        self.minIntensity = minIntensity
+        self.threads = 1
+
+
+def ConversionThreads(rawFile, agilentThreads):
+    # Thread cost of the conversion of a raw file: agilentThreads for Agilent .d folders (AcqData), otherwise 1
+    if os.path.splitext(rawFile)[1].lower() == ".d" and os.path.exists(os.path.join(rawFile, "AcqData")):
+        return agilentThreads
+    return 1
+
+
+def RunConversions(jobs, execPath, coreBudget, logFolder, pollInterval=0.2):
+    # Runs the conversion jobs (ConversionJob and MzmlConversionJob) within coreBudget cores. Returns a data frame with MSRUN,
+    #   THREADS, RETURNCODE, SECONDS (conversion time), MZASIZE (bytes, -1 if no mza file) and LOG (log file, "" for mzML
+    #   files converted in Python) of each job
+    os.makedirs(logFolder, exist_ok=True)
+    coreBudget = max(1, coreBudget)
+    pending = sorted(jobs, key=lambda x: -x.threads)
+    nMzml = sum(1 for x in jobs if isinstance(x, MzmlConversionJob))
+    pool = Pool(min(coreBudget, nMzml)) if nMzml > 0 else None
+    running = [] # (job, process or async result, log file, start time)
+    records = []
+    inUse = 0
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            # start the largest pending jobs fitting in the free cores (or one job if none is running)
+            for job in list(pending):
+                cost = min(job.threads, coreBudget)
+                if inUse + cost <= coreBudget or len(running) == 0:
+                    if isinstance(job, MzmlConversionJob):
+                        running.append((job, pool.apply_async(ConvertMzmlFile, args=(job.mzmlFile, job.mzaFile, job.minIntensity)), None, time.perf_counter()))
+                    else:
+                        logFile = os.path.join(logFolder, job.name + ".log")
+                        log = open(logFile, "w")
+                        process = subprocess.Popen(execPath + job.args, shell=True, stdout=log, stderr=subprocess.STDOUT)
+                        running.append((job, process, log, time.perf_counter()))
+                    pending.remove(job)
+                    inUse += cost
+            time.sleep(pollInterval)
+            for x in [x for x in running if (x[1].ready() if x[2] is None else x[1].poll() is not None)]:
+                [job, process, log, start] = x
+                running.remove(x)
+                inUse -= min(job.threads, coreBudget)
+                if log is None:
+                    records.append(process.get()) # record of ConvertMzmlFile (conversion errors are caught)
+                    continue
+                log.close()
+                records.append({"MSRUN": job.name,
+                                "THREADS": job.threads,
+                                "RETURNCODE": process.returncode,
+                                "SECONDS": round(time.perf_counter() - start, 2),
+                                "MZASIZE": os.path.getsize(job.mzaFile) if os.path.exists(job.mzaFile) else -1,
+                                "LOG": log.name})
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return pd.DataFrame(records, columns=["MSRUN", "THREADS", "RETURNCODE", "SECONDS", "MZASIZE", "LOG"])
@@ -1,138 +1,174 @@
 import pandas as pd
 from sklearn.ensemble import IsolationForest
-from scipy.stats import zscore
+from multiprocessing.pool import ThreadPool
 import seaborn as sns
 import numpy as np
 import matplotlib.pyplot as plt
 
 
  # rterrorAbsThreshold: IM DIA 0.2, Metab DDA 0.03. Prot DDA 0.5
-def detect_outliers(data, mzerrorppmAbsThreshold = 15, rterrorAbsThreshold = 0.3, aterrorAbsThreshold = 0.1):
+ # method: 'isolationforest' fits an IsolationForest (random_state=0) per sample group and metric column, in parallel with nJobs threads,
+ #   'robust' flags values with a robust z-score (median/MAD) above robustZThreshold, computed for all columns at once
+def detect_outliers(data, mzerrorppmAbsThreshold = 15, rterrorAbsThreshold = 0.3, aterrorAbsThreshold = 0.1, method = 'isolationforest', nJobs = 1, robustZThreshold = 3.5):
 
     # Group by MOLECULE if it exists and create columns for each molecule and metric
     if 'MOLECULE' in data.columns:
-        data.drop(columns=["MZERROR"], inplace=True) # to keep only error in ppm
-        # keep the first 4 columns plus all columns named with the substring "ERROR"
-        error_columns = [col for col in data.columns if 'ERROR' in col]
-        filtered_columns = data.columns[:4].tolist() + error_columns
-        data = data[filtered_columns]
-        # transform data frame to wide format, where each error column is named with a suffix of the MOLECULE value and the content is the corresponding error value
-        data = data.pivot_table(index=['MSRUN', 'LABELSAMPLEGROUP', 'MSRUNID'],
-                         columns='MOLECULE',
-                         values=error_columns)
-        # Flatten multi-level column index
-        data.columns = [f"{col[0]}_{col[1]}" for col in data.columns]
-        # Reset index to make MSRUN, LABELSAMPLEGROUP, and MSRUNID as columns
-        data = data.reset_index()
-    
-    outliers_df = pd.DataFrame()
-    for group_key, group in data.groupby('LABELSAMPLEGROUP'):
-
-        # Perform outlier detection for each metric column 
-        for column in data.columns[4:].tolist():
-            # Select specified column for outlier detection
-            X = group[[column]]
-            X = X.dropna()
-            if X.shape[0] < 3:
+        data = pivot_error_columns(data.drop(columns=["MZERROR"])) # to keep only error in ppm
+    columns = data.columns[4:].tolist()
+    # Apply thresholds to filter instances with small errors, no threshold for other metrics
+    thresholds = get_column_thresholds(columns, {'MZERRORPPM': mzerrorppmAbsThreshold, 'RTERROR': rterrorAbsThreshold, 'ATERROR': aterrorAbsThreshold}, -np.inf)
+
+    values = data[columns].to_numpy(dtype=float)
+    groups = data['LABELSAMPLEGROUP'].to_numpy()
+    zscores = get_group_zscores(data, columns)
+    if method == 'robust':
+        [isOutlier, scores] = get_robust_outliers(data, columns, robustZThreshold)
+    else:
+        [isOutlier, scores] = get_isolationforest_outliers(data, columns, nJobs)
+    isOutlier &= np.abs(values) > thresholds
+
+    [rows, cols] = get_sorted_cells(isOutlier, groups)
+    return pd.DataFrame({
+        'LABELSAMPLEGROUP': groups[rows],  # Store the sample group
+        'MSRUNID': data['MSRUNID'].to_numpy()[rows],
+        'Metric': np.array(columns, dtype=object)[cols],  # Store the name of the metric
+        'MetricValue': values[rows, cols],
+        'OutlierScore': scores[rows, cols],  # Store the outlier scores
+        'Zscore': zscores[rows, cols] # Store Z-score
+    })
+
+
+def pivot_error_columns(data):
+    # keep the first 4 columns plus all columns named with the substring "ERROR"
+    error_columns = [col for col in data.columns if 'ERROR' in col]
+    filtered_columns = data.columns[:4].tolist() + error_columns
+    data = data[filtered_columns]
+    # transform data frame to wide format, where each error column is named with a suffix of the MOLECULE value and the content is the corresponding error value
+    data = data.pivot_table(index=['MSRUN', 'LABELSAMPLEGROUP', 'MSRUNID'],
+                     columns='MOLECULE',
+                     values=error_columns)
+    # Flatten multi-level column index
+    data.columns = [f"{col[0]}_{col[1]}" for col in data.columns]
+    # Reset index to make MSRUN, LABELSAMPLEGROUP, and MSRUNID as columns
+    return data.reset_index()
+
+
+def get_sorted_cells(mask, groups):
+    # (row, column) indexes of the True cells of mask, sorted by sample group, metric column and row
+    cells = np.argwhere(mask.T) # (column, row)
+    rows = cells[:, 1]
+    cols = cells[:, 0]
+    order = np.lexsort((rows, cols, pd.factorize(groups, sort=True)[0][rows]))
+    return [rows[order], cols[order]]
+
+
+def get_column_thresholds(columns, familyThresholds, default):
+    # Absolute threshold of each column, from the first metric family (substring of the column name) found in familyThresholds
+    thresholds = np.full(len(columns), default, dtype=float)
+    for k, column in enumerate(columns):
+        for family, threshold in familyThresholds.items():
+            if family in column:
+                thresholds[k] = threshold
+                break
+    return thresholds
+
+
+def get_group_zscores(data, columns):
+    # Z-scores (population standard deviation, as scipy zscore) of each column per LABELSAMPLEGROUP, for all columns at once.
+    #   NaN for missing values and for constant columns
+    grouped = data.groupby('LABELSAMPLEGROUP')[columns]
+    deviations = data[columns] - grouped.transform('mean')
+    std = np.sqrt((deviations ** 2).groupby(data['LABELSAMPLEGROUP']).transform('mean'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscores = (deviations / std).to_numpy(dtype=float)
+    return zscores
+
+
+def get_robust_outliers(data, columns, robustZThreshold=3.5):
+    # Outlier mask and robust z-scores (0.6745 * (x - median) / MAD) of each column per LABELSAMPLEGROUP, for all columns at once.
+    #   If the MAD is 0, the mean absolute deviation (scaled by 0.7979) is used instead. Groups with less than 3 values are skipped.
+    grouped = data.groupby('LABELSAMPLEGROUP')[columns]
+    deviations = data[columns] - grouped.transform('median')
+    groupedDeviations = deviations.abs().groupby(data['LABELSAMPLEGROUP'])
+    mad = groupedDeviations.transform('median').to_numpy(dtype=float)
+    meanad = groupedDeviations.transform('mean').to_numpy(dtype=float) * 0.7979
+    mad = np.where(mad > 0, mad, meanad)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = 0.6745 * deviations.to_numpy(dtype=float) / mad
+    scores[(mad == 0) | (grouped.transform('count') < 3).to_numpy()] = np.nan
+    isOutlier = np.abs(scores) > robustZThreshold # False for NaN
+    return [isOutlier, scores]
+
+
+def get_isolationforest_outliers(data, columns, nJobs=1):
+    # Outlier mask and IsolationForest scores (decision function) of each column per LABELSAMPLEGROUP, one fit per (group, column).
+    #   Fits are independent (random_state=0), results do not depend on nJobs.
+    values = data[columns].to_numpy(dtype=float)
+    isOutlier = np.zeros(values.shape, dtype=bool)
+    scores = np.full(values.shape, np.nan)
+    tasks = []
+    for group_key, rows in data.groupby('LABELSAMPLEGROUP').indices.items():
+        for k in range(len(columns)):
+            rowsk = rows[~np.isnan(values[rows, k])]
+            if rowsk.size < 3:
                 continue  # Skip if there are less than 3 samples in the group
-    
-            # Adjust contamination based on variance
-            if X.var().values[0] < 0.01:  # Adjust threshold as needed
-                cont = 0.0001  # A very small value
-            else:
-                cont = 0.01  # A small value, but higher than for low-variance data
-
-            clf = IsolationForest(contamination=cont, random_state=0)
-            outliers = clf.fit_predict(X)
-            # Filter dataframe to get rows with outliers
-            outlier_indices = X.index[outliers == -1]
-
-            # Apply thresholds to filter instacens with small errors:
-            if 'MZERRORPPM' in column and len(outlier_indices) > 0:
-                indexes = X[X[column].abs() > mzerrorppmAbsThreshold].index
-                outlier_indices = list(set(indexes).intersection(outlier_indices))
-            elif 'RTERROR' in column and len(outlier_indices) > 0:
-                indexes = X[X[column].abs() > rterrorAbsThreshold].index
-                outlier_indices = list(set(indexes).intersection(outlier_indices))
-            elif 'ATERROR' in column and len(outlier_indices) > 0:
-                indexes = X[X[column].abs() > aterrorAbsThreshold].index
-                outlier_indices = list(set(indexes).intersection(outlier_indices))
-
-            if len(outlier_indices) > 0:
-                outlier_scores = clf.decision_function(X.loc[outlier_indices])
-                # Create DataFrame for outlier rows
-                outlier_rows = pd.DataFrame({
-                    'LABELSAMPLEGROUP': [group_key] * len(outlier_indices),  # Store the sample group
-                    'MSRUNID': group.loc[outlier_indices, 'MSRUNID'].values,
-                    'Metric': [column] * len(outlier_indices),  # Store the name of the metric
-                    'MetricValue': group.loc[outlier_indices, column].values,
-                    'OutlierScore': outlier_scores,  # Store the outlier scores,
-                    'Zscore': zscore(X[column])[outlier_indices] # Store Z-score
-                })
-                # Concatenate outlier rows with outliers_df
-                outliers_df = pd.concat([outliers_df, outlier_rows])
-    return outliers_df
-
-
-def calculate_percentage_error(group):
-    mean_abundance = group['ABUNDANCE'].mean()
-    group['ABUNDANCEERROR'] = (abs(group['ABUNDANCE'] - mean_abundance) / mean_abundance) * 100
-    return group
+            tasks.append((rowsk, k))
+    if nJobs > 1 and len(tasks) > 1:
+        with ThreadPool(min(nJobs, len(tasks))) as pool:
+            results = pool.starmap(fit_isolation_forest, [(values[rows, k],) for rows, k in tasks])
+    else:
+        results = [fit_isolation_forest(values[rows, k]) for rows, k in tasks]
+    for [rows, k], [outliers, outlierScores] in zip(tasks, results):
+        isOutlier[rows, k] = outliers
+        scores[rows, k] = outlierScores
+    return [isOutlier, scores]
+
+
+def fit_isolation_forest(x):
+    # Outlier mask and scores of the values x of one sample group and metric
+    X = x.reshape(-1, 1)
+    # Adjust contamination based on variance
+    if np.var(x, ddof=1) < 0.01:  # Adjust threshold as needed
+        cont = 0.0001  # A very small value
+    else:
+        cont = 0.01  # A small value, but higher than for low-variance data
+    clf = IsolationForest(contamination=cont, random_state=0)
+    outliers = clf.fit_predict(X) == -1
+    outlierScores = np.full(x.size, np.nan)
+    if outliers.any():
+        outlierScores[outliers] = clf.decision_function(X[outliers])
+    return [outliers, outlierScores]
 
 
 def detect_outsidetolerances(data, mzerrorppmAbsThreshold = 15, rterrorAbsThreshold = 0.3, aterrorAbsThreshold = 0.1, abundanceerrorAbsThreshold = 30):
+    if len(data) == 0:
+        return pd.DataFrame() # e.g., no QC samples, nothing to report
 
     # Calculate abundance percentage error:
-    data = data.groupby(['LABELSAMPLEGROUP', 'MOLECULE']).apply(calculate_percentage_error).reset_index(drop=True)
+    mean_abundance = data.groupby(['LABELSAMPLEGROUP', 'MOLECULE'])['ABUNDANCE'].transform('mean')
+    data = data.assign(ABUNDANCEERROR=(abs(data['ABUNDANCE'] - mean_abundance) / mean_abundance) * 100)
 
     # Group by MOLECULE if it exists and create columns for each molecule and metric
     if 'MOLECULE' in data.columns:
-        data.drop(columns=["MZERROR"], inplace=True) # to keep only error in ppm
-        # keep the first 4 columns plus all columns named with the substring "ERROR"
-        error_columns = [col for col in data.columns if 'ERROR' in col]
-        filtered_columns = data.columns[:4].tolist() + error_columns
-        data = data[filtered_columns]
-        # transform data frame to wide format, where each error column is named with a suffix of the MOLECULE value and the content is the corresponding error value
-        data = data.pivot_table(index=['MSRUN', 'LABELSAMPLEGROUP', 'MSRUNID'],
-                         columns='MOLECULE',
-                         values=error_columns)
-        # Flatten multi-level column index
-        data.columns = [f"{col[0]}_{col[1]}" for col in data.columns]
-        # Reset index to make MSRUN, LABELSAMPLEGROUP, and MSRUNID as columns
-        data = data.reset_index()
-    
-    outsidetol_df = pd.DataFrame()
-    for group_key, group in data.groupby('LABELSAMPLEGROUP'):
-        # Perform outlier detection for each metric column 
-        for column in data.columns[4:].tolist():
-            # Select specified column for z score calculation
-            X = group[[column]]
-            X = X.dropna()
-            if X.shape[0] < 3:
-                continue 
-            indexes = []
-            # Apply thresholds to filter instacens with small errors:
-            if 'MZERRORPPM' in column:
-                indexes = X[X[column].abs() > mzerrorppmAbsThreshold].index
-            elif 'RTERROR' in column:
-                indexes = X[X[column].abs() > rterrorAbsThreshold].index
-            elif 'ATERROR' in column :
-                indexes = X[X[column].abs() > aterrorAbsThreshold].index
-            elif 'ABUNDANCEERROR' in column :
-                indexes = X[X[column].abs() > abundanceerrorAbsThreshold].index
-
-            if len(indexes) > 0:
-                new_rows = pd.DataFrame({
-                    'LABELSAMPLEGROUP': [group_key] * len(indexes),  # Store the sample group
-                    'MSRUNID': group.loc[indexes, 'MSRUNID'].values,
-                    'Metric': [column] * len(indexes),  # Store the name of the metric
-                    'MetricValue': group.loc[indexes, column].values,
-                    'Zscore': zscore(X[column])[indexes] # Store Z-score
-                })
-                # Concatenate 
-                outsidetol_df = pd.concat([outsidetol_df, new_rows])
-    #outsidetol_df.dropna(inplace=True)
-    return outsidetol_df
+        data = pivot_error_columns(data.drop(columns=["MZERROR"])) # to keep only error in ppm
+    columns = data.columns[4:].tolist()
+    # Apply thresholds to filter instances with small errors, other metrics are not reported
+    thresholds = get_column_thresholds(columns, {'MZERRORPPM': mzerrorppmAbsThreshold, 'RTERROR': rterrorAbsThreshold, 
+                                                 'ATERROR': aterrorAbsThreshold, 'ABUNDANCEERROR': abundanceerrorAbsThreshold}, np.inf)
+
+    values = data[columns].to_numpy(dtype=float)
+    groups = data['LABELSAMPLEGROUP'].to_numpy()
+    zscores = get_group_zscores(data, columns)
+    hasValues = (data.groupby('LABELSAMPLEGROUP')[columns].transform('count') >= 3).to_numpy(dtype=bool) # skip groups with less than 3 values
+    isOutside = (np.abs(values) > thresholds) & hasValues
+    [rows, cols] = get_sorted_cells(isOutside, groups)
+    return pd.DataFrame({
+        'LABELSAMPLEGROUP': groups[rows],  # Store the sample group
+        'MSRUNID': data['MSRUNID'].to_numpy()[rows],
+        'Metric': np.array(columns, dtype=object)[cols],  # Store the name of the metric
+        'MetricValue': values[rows, cols],
+        'Zscore': zscores[rows, cols] # Store Z-score
+    })
 
 
 def plot_heatmap(data, outputPath):
@@ -0,0 +1,110 @@
+import os
+import re
+import glob
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+# Tolerance-based matching of lists of features (CompareFeatures).
+# Features are sorted by m/z and each feature is compared only with the features within mz_tolerance after it
+#   (sweep with searchsorted), then pairs are filtered by rt_tolerance and at_tolerance: runtime is near-linear
+#   for lists where few features fall within the m/z tolerance of each other.
+# N-way matching links features of different lists within the tolerances, and groups are the connected components
+#   of the links: a group can hold features farther apart than the tolerances if they are linked through other features.
+
+FEATURE_COLUMNS = {"MZ": "mz_column_names", "RT": "rt_column_names", "AT": "at_column_names",
+                   "ABUNDANCE": "abundance_column_names", "MOLECULE": "molecule_column_names"}
+
+
+def HarmonizeFeatureColumns(df, config):
+    # Renames the columns of a feature list to MZ, RT, AT, ABUNDANCE and MOLECULE using the column name aliases of the config
+    renames = {}
+    for name, aliases in FEATURE_COLUMNS.items():
+        for alias in config.get(aliases, []):
+            if alias in df.columns and name not in renames.values():
+                renames[alias] = name
+    return df.rename(columns=renames)
+
+
+def ReadFeatureLists(folder, config):
+    # Returns a dictionary {method name: data frame} of the CSV files in the folder, with the method name between the
+    #   delimiters_method_file_name of the file name (or the file name if not found)
+    lists = {}
+    for csvFile in sorted(glob.glob(os.path.join(folder, "*.csv"))):
+        name = os.path.splitext(os.path.basename(csvFile))[0]
+        found = re.search(config.get("delimiters_method_file_name", "__(.*?)__"), name)
+        lists[found.group(1) if found else name] = HarmonizeFeatureColumns(pd.read_csv(csvFile), config)
+    return lists
+
+
+def FindFeaturePairs(mzs, rts=None, ats=None, listIds=None, mzTolerance=0.005, rtTolerance=0.3, atTolerance=0.1, chunkSize=1000000):
+    # Pairs (i, j) of features with |mz| <= mzTolerance, |rt| <= rtTolerance and |at| <= atTolerance (rts or ats None: not compared)
+    #   and from different lists (listIds None: all pairs). Returns arrays [i, j] of indexes in the input order, i != j, each pair once.
+    mzs = np.asarray(mzs, dtype=float)
+    order = np.argsort(mzs, kind="stable")
+    sortedMzs = mzs[order]
+    ends = np.searchsorted(sortedMzs, sortedMzs + mzTolerance, side="right")
+    counts = ends - np.arange(sortedMzs.size) - 1 # features after each feature within the m/z tolerance
+    pairs = []
+    # expand the candidate pairs by chunks of features to bound memory
+    cumulative = np.cumsum(counts)
+    start = 0
+    while start < sortedMzs.size:
+        end = max(int(np.searchsorted(cumulative, (cumulative[start - 1] if start > 0 else 0) + chunkSize, side="right")), start + 1)
+        chunkCounts = counts[start:end]
+        first = np.repeat(np.arange(start, end), chunkCounts)
+        second = first + 1 + np.arange(chunkCounts.sum()) - np.repeat(np.cumsum(chunkCounts) - chunkCounts, chunkCounts)
+        first = order[first]
+        second = order[second]
+        keep = np.ones(first.size, dtype=bool)
+        if rts is not None:
+            keep &= np.abs(np.asarray(rts)[first] - np.asarray(rts)[second]) <= rtTolerance
+        if ats is not None:
+            keep &= np.abs(np.asarray(ats)[first] - np.asarray(ats)[second]) <= atTolerance
+        if listIds is not None:
+            keep &= np.asarray(listIds)[first] != np.asarray(listIds)[second]
+        pairs.append((first[keep], second[keep]))
+        start = end
+    if len(pairs) == 0:
+        return [np.array([], dtype=np.int64), np.array([], dtype=np.int64)]
+    return [np.concatenate([x[0] for x in pairs]), np.concatenate([x[1] for x in pairs])]
+
+
+def MatchFeatureLists(lists, mzTolerance=0.005, rtTolerance=0.3, atTolerance=0.1):
+    # N-way matching of feature lists ({name: data frame with MZ and optionally RT and AT}).
+    # Returns one data frame of all features with the columns LIST (name of the list) and GROUP (connected component of
+    #   matched features), and NLISTS (number of lists with a feature in the group)
+    df = pd.concat([x.assign(LIST=name) for name, x in lists.items()], ignore_index=True)
+    listIds = pd.factorize(df["LIST"])[0]
+    rts = df["RT"].to_numpy(dtype=float) if "RT" in df.columns and df["RT"].notna().all() else None
+    ats = df["AT"].to_numpy(dtype=float) if "AT" in df.columns and df["AT"].notna().all() else None
+    [first, second] = FindFeaturePairs(df["MZ"].to_numpy(dtype=float), rts, ats, listIds, mzTolerance, rtTolerance, atTolerance)
+    graph = sparse.coo_matrix((np.ones(first.size, dtype=np.int8), (first, second)), shape=(len(df), len(df)))
+    df["GROUP"] = connected_components(graph, directed=False)[1]
+    df["NLISTS"] = df.groupby("GROUP")["LIST"].transform("nunique")
+    return df
+
+
+def MatchFeatures(dfA, dfB, mzTolerance=0.005, rtTolerance=0.3, atTolerance=0.1):
+    # Pairs of matched features of two lists: data frame with the row positions INDEXA and INDEXB and the differences
+    #   MZERROR, RTERROR and ATERROR (B - A, when the columns exist in both lists)
+    def values(name):
+        if name not in dfA.columns or name not in dfB.columns:
+            return None
+        x = np.concatenate([dfA[name].to_numpy(dtype=float), dfB[name].to_numpy(dtype=float)])
+        return None if np.isnan(x).any() else x
+    mzs = values("MZ")
+    rts = values("RT")
+    ats = values("AT")
+    listIds = np.repeat([0, 1], [len(dfA), len(dfB)])
+    [first, second] = FindFeaturePairs(mzs, rts, ats, listIds, mzTolerance, rtTolerance, atTolerance)
+    # pairs are unordered: put the feature of list A first
+    swap = first >= len(dfA)
+    first, second = np.where(swap, second, first), np.where(swap, first, second)
+    pairs = pd.DataFrame({"INDEXA": first, "INDEXB": second - len(dfA), "MZERROR": mzs[second] - mzs[first]})
+    if rts is not None:
+        pairs["RTERROR"] = rts[second] - rts[first]
+    if ats is not None:
+        pairs["ATERROR"] = ats[second] - ats[first]
+    return pairs.sort_values(["INDEXA", "INDEXB"], ignore_index=True)
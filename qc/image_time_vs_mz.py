@@ -1,99 +1,127 @@
-import h5py
-import hdf5plugin
 import numpy as np
-from PIL import Image 
+from PIL import Image
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
+from qc.mza_reader import OpenMza
 
 # GenerateImageTimeVsMz
 # m/z dimension is rounded and summed, used at unit resolution
 # retention time is rounded to 1 decimal places and summed
+# The binned matrix is saved losslessly to outputFullPath.npz (used by PCA), the JPEG image is an optional render of it
+
+# Dark blue to yellow color gradient of the images
+TIME_VS_MZ_CMAP = LinearSegmentedColormap.from_list('mycmap', [(0, 0, 0.5), (1, 1, 0)])
+
+def GenerateImageTimeVsMz(mzaFile, outputFullPath, LcmsImageMinIntensityPercentage=10, LcmsImageMaxIntensityCeilingPercentage=70, saveImage=True):
+
+    [lcms, rtPixels] = BinSpectraTimeVsMz(mzaFile)
+    if lcms.size == 0:
+        return
+
+    SaveTimeVsMzMatrix(lcms, rtPixels, outputFullPath + ".npz")
+    if not saveImage:
+        return
+    pixels = ColorizeTimeVsMz(lcms, rtPixels, LcmsImageMinIntensityPercentage, LcmsImageMaxIntensityCeilingPercentage)
+    img = Image.fromarray(pixels)
+    img.save(outputFullPath + ".jpg")
+    img.close()
+
+
+def SaveTimeVsMzMatrix(lcms, rtPixels, outputFile):
+    # Saves the binned matrix from BinSpectraTimeVsMz as a compressed sparse matrix (coordinates of the non-zero bins):
+    #   MZ (unit m/z bin), RT (image column, retention time x 10), INTENSITY (summed, scaled by 1/1000) and SHAPE (height, width) of the image.
+    #   Retention times rounded to the same image column are summed.
+    width = np.max(rtPixels) + 1
+    matrix = np.zeros((lcms.shape[0], width))
+    np.add.at(matrix.T, rtPixels, lcms.T)
+    mzIndexes, rtIndexes = np.nonzero(matrix)
+    np.savez_compressed(outputFile, MZ=mzIndexes.astype(np.int32), RT=rtIndexes.astype(np.int32),
+                        INTENSITY=matrix[mzIndexes, rtIndexes].astype(np.float32), SHAPE=np.array(matrix.shape))
+
+
+def GetTimeVsMzMatrixShape(matrixFile):
+    # (height, width) of the image of a matrix saved by SaveTimeVsMzMatrix, without loading the bins
+    with np.load(matrixFile) as data:
+        return tuple(int(x) for x in data["SHAPE"])
 
-def GenerateImageTimeVsMz(mzaFile, outputFullPath, LcmsImageMinIntensityPercentage=10, LcmsImageMaxIntensityCeilingPercentage=70):
-
-    mza = h5py.File(mzaFile, 'r')
-    # Reading Metadata table:
-    metadata = mza["Metadata"]
-    # Keep only MS1, and TFS for ion mobility data
-    metadata = metadata[(metadata["MSLevel"] == 1) & (metadata["IonMobilityBin"] == 0)]
-    metadata = metadata[np.argsort(metadata["RetentionTime"])]
-
-    lcms = {} # Create a dictionary with keys as RT and values as mz dictionaries
-    maxMz = 0
-    maxIntensity = 0
-    for k in range(0, metadata.size):
-        scan = metadata["Scan"][k]
-        mzapath = str(metadata["MzaPath"][k], 'utf-8')
-
-        mz_array = None
-        if "Full_mz_array" in mza:
-            # Get array of m/z values (common for all spectra in the file) and map mzbins to m/z:
-            full_mz = mza["Full_mz_array"][:]
-            mzbins = mza["Arrays_mzbin" + mzapath + "/" + str(scan)][:]
-            mz_array = np.array([full_mz[i] for i in mzbins])
-        else:
-            mz_array = np.array(mza["Arrays_mz" + mzapath + "/" + str(scan)][:])
-        intensities_array = mza["Arrays_intensity" + mzapath + "/" + str(scan)][:]
-        intensities_array = intensities_array/1000 # scale intensity to avoid overflow 
-
-        spectrum = {} # Create a dictionary with keys as unit mz and values as intensities
-        for i in range(0, mz_array.size):
-            mzx = int(np.floor(mz_array[i]))
-
-            if mzx > maxMz:
-                maxMz = mzx
-
-            if mzx in spectrum:
-                spectrum[mzx] += intensities_array[i]
-            else:
-                spectrum[mzx] = intensities_array[i]
-
-        rtx = np.round(metadata["RetentionTime"][k], decimals=1)
-        if rtx in lcms:
-            for mzx in spectrum:
-                if mzx in lcms[rtx]:
-                    lcms[rtx][mzx] += spectrum[mzx]
-                else:
-                    lcms[rtx][mzx] = spectrum[mzx]
-        else:
-            lcms[rtx] = spectrum
-
-        maxIntx = np.max(list(lcms[rtx].values()))
-        if maxIntx > maxIntensity:
-            maxIntensity = maxIntx
-    mza.close()
-    
-    # Create image from 0 coordinate center (bottom left in image) to be comparable across runs:
-    # Create a new RGB image with the same size as the input image
-    width = int(np.max(list(lcms.keys())) * 10) + 1
-    height = maxMz + 1
 
-    img = Image.new('RGB', (width, height))
+def LoadTimeVsMzMatrix(matrixFile, height=None, width=None):
+    # Dense matrix (m/z x RT, row 0 is m/z 0) of a matrix saved by SaveTimeVsMzMatrix, cropped or padded with 0 to height x width
+    with np.load(matrixFile) as data:
+        shape = data["SHAPE"]
+        height = int(shape[0]) if height is None else height
+        width = int(shape[1]) if width is None else width
+        mzIndexes = data["MZ"]
+        rtIndexes = data["RT"]
+        keep = (mzIndexes < height) & (rtIndexes < width)
+        matrix = np.zeros((height, width), dtype=np.float32)
+        matrix[mzIndexes[keep], rtIndexes[keep]] = data["INTENSITY"][keep]
+    return matrix
 
-    # Get the pixel access object for the image
-    pixels = img.load()
 
-    # Define the dark blue to yellow color gradient
-    colors = [(0, 0, 0.5), (1, 1, 0)]
-    # Create a colormap with the defined gradient
-    cmap = LinearSegmentedColormap.from_list('mycmap', colors)
+def BinSpectraTimeVsMz(mzaFile):
+    # Returns a dense matrix of summed intensities (scaled by 1/1000) and the image column (pixel x) of each matrix column:
+    #   rows are unit m/z bins (row 0 is m/z 0) and columns are retention times rounded to 1 decimal, sorted.
+    # mzaFile: path to the mza file or an open MzaReader
+    with OpenMza(mzaFile) as mza:
+        # Keep only MS1, and TFS for ion mobility data
+        rows = mza.GetRows(msLevel=1)
 
-    for i in lcms.keys(): # width or x, size[0]
-        for j in lcms[i].keys(): # height or y, size[1]
+        # Matrix column of each scan, one column per rounded retention time
+        rtColumns = {}
+        scanColumns = []
+        for rt in mza.metadata["RetentionTime"][rows]:
+            rtx = np.round(rt, decimals=1)
+            if rtx not in rtColumns:
+                rtColumns[rtx] = len(rtColumns)
+            scanColumns.append(rtColumns[rtx])
+        rtPixels = np.array([int(rtx * 10) for rtx in rtColumns], dtype=int)
 
-            x = int(lcms[i][j])
-            if x < (maxIntensity * (LcmsImageMinIntensityPercentage/100)):
+        lcms = np.zeros((len(rtColumns), 1024)) # RT x m/z while accumulating, m/z axis grows as needed
+        maxMz = 0
+        spectra = []
+        for k in range(0, rows.size):
+            if k % 1000 == 0: # blocks of spectra, one sequential read with the compact layout
+                spectra = mza.ReadSpectra(rows[k:k + 1000]) # each spectrum is read once, no need to cache it
+            [mz_array, intensities_array] = spectra[k % 1000]
+            if mz_array.size == 0:
                 continue
-            if x > (maxIntensity * (LcmsImageMaxIntensityCeilingPercentage/100)):
-                x = maxIntensity * (LcmsImageMaxIntensityCeilingPercentage/100)
-            # scale intensity value to 255 and max:
-            x = int(np.log10(lcms[i][j]))
-            x /= np.log10(maxIntensity * (LcmsImageMaxIntensityCeilingPercentage/100))
-            x = np.array(cmap(x)[0:3]) # ignore the 4th channel (alpha)
-            x *= 255
-            # Set the pixel in the RGB image
-            pixels[int(i*10), maxMz-j] = tuple(map(int,tuple(x)))
-    
-    #pixels = np.transpose(pixels)
-    img.save(outputFullPath + ".jpg")
-    img.close()
+            intensities_array = intensities_array/1000 # scale intensity to avoid overflow
+
+            # sum intensities per unit m/z
+            spectrum = np.bincount(np.floor(mz_array).astype(np.int64), weights=intensities_array)
+            maxMz = max(maxMz, spectrum.size - 1)
+            if spectrum.size > lcms.shape[1]:
+                grown = np.zeros((lcms.shape[0], max(spectrum.size, lcms.shape[1] * 2)))
+                grown[:, :lcms.shape[1]] = lcms
+                lcms = grown
+            lcms[scanColumns[k], :spectrum.size] += spectrum
+
+    return [np.ascontiguousarray(lcms[:, :maxMz + 1].T), rtPixels]
+
+
+def ColorizeTimeVsMz(lcms, rtPixels, LcmsImageMinIntensityPercentage=10, LcmsImageMaxIntensityCeilingPercentage=70):
+    # Returns the RGB pixels (height x width x 3) of the binned matrix from BinSpectraTimeVsMz.
+    # Create image from 0 coordinate center (bottom left in image) to be comparable across runs:
+    maxIntensity = np.max(lcms)
+    height = lcms.shape[0]
+    width = np.max(rtPixels) + 1
+    maxMz = height - 1
+
+    # keep only bins above the minimum intensity, truncated to integer as in the pixel values.
+    #   Bins are ordered by retention time, so a later retention time rounded to the same pixel is drawn last
+    rtIndexes, mzIndexes = np.nonzero(((np.trunc(lcms) >= maxIntensity * (LcmsImageMinIntensityPercentage/100)) & (lcms > 0)).T)
+    rows = maxMz - mzIndexes
+    cols = rtPixels[rtIndexes]
+    last = rows.size - 1 - np.unique((rows * width + cols)[::-1], return_index=True)[1]
+    rtIndexes, mzIndexes, rows, cols = rtIndexes[last], mzIndexes[last], rows[last], cols[last]
+
+    # scale intensity value to 255 and max:
+    x = np.trunc(np.log10(lcms[mzIndexes, rtIndexes]))
+    x /= np.log10(maxIntensity * (LcmsImageMaxIntensityCeilingPercentage/100))
+    x = TIME_VS_MZ_CMAP(x)[:, 0:3] # ignore the 4th channel (alpha)
+    x *= 255
+
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[rows, cols] = x.astype(np.uint8)
+    return pixels
@@ -1,30 +1,31 @@
 import os
-import h5py
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
-from mza.mza import GetExtractedIonRetention, GetClosestSpectrum, GetExtractedIonArrival
+from qc.mza_reader import OpenMza, SumIntensityWindows
 from scipy.signal import find_peaks
 
 def GetHighResCoordinates(mzaFile, mz, rt, rtrange=0.5, mzrange=0.5, minMzDistCentroid = 0.005):
-    df = GetExtractedIonRetention(mzaFileName=mzaFile, mz=mz, msLevel=1, startRT=rt - rtrange, endRT=rt + rtrange, mztolhalfwidth=mzrange/2)
-    mz_array = []
-    if len(df) > 0:
-        df.sort_values("rt", inplace=True, ignore_index=True)
-        # Get spectrum at apex:
-        index = find_peaks(df["intensity"], width=3)[0]
-        if len(index) > 0:
-            #index = index[np.array(abs(df["RT"][index] - rt)).argmin()]
-            index = index[np.array(df["intensity"][index]).argmax()] # keep the most intense
-        else:
-            return [0, 0]
-        rtapex = df.loc[index,"rt"]
+    # mzaFile: path to the mza file or an open MzaReader
+    with OpenMza(mzaFile) as mza:
+        df = mza.GetExtractedIonRetention(mz=mz, msLevel=1, startRT=rt - rtrange, endRT=rt + rtrange, mztolhalfwidth=mzrange/2)
+        mz_array = []
+        if len(df) > 0:
+            df.sort_values("rt", inplace=True, ignore_index=True)
+            # Get spectrum at apex:
+            index = find_peaks(df["intensity"], width=3)[0]
+            if len(index) > 0:
+                #index = index[np.array(abs(df["RT"][index] - rt)).argmin()]
+                index = index[np.array(df["intensity"][index]).argmax()] # keep the most intense
+            else:
+                return [0, 0]
+            rtapex = df.loc[index,"rt"]
 
-        [mz_array, intensity_array] = GetClosestSpectrum(mzaFileName=mzaFile, msLevel=1, rt=rtapex)
-        indexes = np.argwhere((mz_array >= mz - mzrange) & (mz_array <= mz + mzrange))
-        mz_array = mz_array[indexes].flatten() # keep only the selected indexes
-        intensity_array = intensity_array[indexes].flatten()
+            [mz_array, intensity_array] = mza.GetClosestSpectrum(msLevel=1, rt=rtapex)
+            indexes = np.argwhere((mz_array >= mz - mzrange) & (mz_array <= mz + mzrange))
+            mz_array = mz_array[indexes].flatten() # keep only the selected indexes
+            intensity_array = intensity_array[indexes].flatten()
 
     if len(mz_array) == 0:
         return [0, 0]
@@ -47,93 +48,160 @@ def GetHighResCoordinates(mzaFile, mz, rt, rtrange=0.5, mzrange=0.5, minMzDistCe
     return [mz_array[apexmz], rtapex]
 
 
-def GenerateImageIonBatch(dfruns, outputFolder, mz, rt, molecule, suffixImage, mzHalfWindowXIC=0.01, rtrange=0.3, mzrange=0.075, at=0, atrange=1.5):
-    # Check and flag if ion mobility data:
-    isIMdata = False
-    if at > 0: # at = arrival time
-        # check if first mza file has ion mobility values:
-        mzaFile = dfruns.loc[0,"MZAPATH"] + ".mza" 
-        with h5py.File(mzaFile, 'r') as mza:
-            metadata = mza["Metadata"]
-            if len(metadata["IonMobilityBin"] > 0):
-                isIMdata = True
-    mzvals = []
-    flagIsMzCentroid = []
-    intensvals = []
-    rtvals = []
-    xicvals = []
-    atvals = []
-    atxicvals = []
-    
-    for mzaFile in dfruns["MZAPATH"]:
-        mzaFile = mzaFile + ".mza"
-        df = GetExtractedIonRetention(mzaFileName=mzaFile, mz=mz, msLevel=1, startRT=rt-rtrange, endRT=rt+rtrange, mztolhalfwidth=mzHalfWindowXIC)
+def ExtractIonTraces(mzaFile, mz, rt, mzHalfWindowXIC=0.01, rtrange=0.3, mzrange=0.075, at=0, atrange=1.5, isIMdata=False):
+    # Extract the XIC, the spectrum at the XIC apex and the XIM (ion mobility data) of one ion in one MS run
+    # mzaFile: path to the mza file or an open MzaReader
+    traces = {"mz": [], "intensity": [], "rt": [], "xic": [], "at": [], "atxic": []}
+    with OpenMza(mzaFile) as mza:
+        df = mza.GetExtractedIonRetention(mz=mz, msLevel=1, startRT=rt-rtrange, endRT=rt+rtrange, mztolhalfwidth=mzHalfWindowXIC)
         if len(df) > 0:
             df.sort_values("rt", inplace=True, ignore_index=True)
-            rtvals.append(df["rt"])
-            xicvals.append(df["intensity"])
+            traces["rt"] = df["rt"]
+            traces["xic"] = df["intensity"]
             # Get spectrum at apex:
-            index = find_peaks(df["intensity"], width=3)[0]
-            if len(index) > 0:
-                index = index[np.array(df["intensity"][index]).argmax()] # keep the most intense
-            else:
-                # Get spectrum at apex:
-                index = np.array(df["intensity"]).argmax()
-            [mz_array, intensity_array] = GetClosestSpectrum(mzaFileName=mzaFile, msLevel=1, rt=df.loc[index,"rt"])
+            index = GetApexIndex(df["intensity"])
+            [mz_array, intensity_array] = mza.GetClosestSpectrum(msLevel=1, rt=df.loc[index,"rt"])
             indexes = np.argwhere((mz_array >= mz - mzrange) & (mz_array <= mz + mzrange))
-            mz_array = mz_array[indexes].flatten() # keep only the selected indexes
-            intensity_array = intensity_array[indexes].flatten()
-            mzvals.append(mz_array)
-            intensvals.append(intensity_array)
-        else:
-            rtvals.append([])
-            xicvals.append([])
-            mzvals.append([])
-            intensvals.append([])
-        
+            traces["mz"] = mz_array[indexes].flatten() # keep only the selected indexes
+            traces["intensity"] = intensity_array[indexes].flatten()
+
         if isIMdata:
-            df = GetExtractedIonArrival(mzaFileName=mzaFile, mz=mz, msLevel=1, rt=rt, startAT = at-atrange, endAT = at+atrange, mztolhalfwidth = mzHalfWindowXIC)
+            df = mza.GetExtractedIonArrival(mz=mz, msLevel=1, rt=rt, startAT = at-atrange, endAT = at+atrange, mztolhalfwidth = mzHalfWindowXIC)
             if len(df) > 0:
                 df.sort_values("at", inplace=True, ignore_index=True)
-                atvals.append(df["at"])
-                atxicvals.append(df["intensity"])
-            else:
-                atvals.append([])
-                atxicvals.append([])
+                traces["at"] = df["at"]
+                traces["atxic"] = df["intensity"]
+    return traces
+
+
+def ExtractIonTracesBatch(mzaFile, dfions):
+    # Extract the traces of ExtractIonTraces for all ions in dfions (columns MZ, RT, AT, MZXICHALFWINDOW,
+    #   RTVIEWHALFWINDOW, MZVIEWHALFWINDOW, ATVIEWHALFWINDOW) reading each MS1 spectrum of the MS run once,
+    #   or querying the m/z index of the MS run if it exists.
+    # Returns a list of traces in the same order as dfions.
+    ionsMz = np.array(dfions["MZ"], dtype=float)
+    ionsRt = np.array(dfions["RT"], dtype=float)
+    ionsAt = np.array(dfions["AT"], dtype=float)
+    mzTols = np.array(dfions["MZXICHALFWINDOW"], dtype=float)
+    rtRanges = np.array(dfions["RTVIEWHALFWINDOW"], dtype=float)
+    mzRanges = np.array(dfions["MZVIEWHALFWINDOW"], dtype=float)
+    atRanges = np.array(dfions["ATVIEWHALFWINDOW"], dtype=float)
+    # sort ions by m/z to search all of them at once in each spectrum:
+    order = np.argsort(ionsMz, kind="stable")
+    nions = len(order)
+    rtvals = [[] for k in range(nions)]
+    xicvals = [[] for k in range(nions)]
+    windows = [[] for k in range(nions)] # spectrum window (+- mzrange) of each scan in the XIC
+    atvals = [[] for k in range(nions)]
+    atxicvals = [[] for k in range(nions)]
+
+    with OpenMza(mzaFile) as mza:
+        if mza.index is not None:
+            # the m/z index reads only the points of each ion window, faster than a sweep over all spectra
+            isIMdata = mza.GetRows(msLevel=1, ionMobility=True).size > 0
+            return [ExtractIonTraces(mza, ionsMz[k], ionsRt[k], mzTols[k], rtRanges[k], mzRanges[k], ionsAt[k], atRanges[k], isIMdata and ionsAt[k] > 0) for k in range(nions)]
+
+        metadata = mza.metadata
+        startRTs = (ionsRt - rtRanges)[order]
+        endRTs = (ionsRt + rtRanges)[order]
+        for row in mza.GetRows(msLevel=1):
+            scanRT = metadata["RetentionTime"][row]
+            active = np.flatnonzero((startRTs <= scanRT) & (scanRT <= endRTs))
+            if active.size == 0:
+                continue
+            ions = order[active]
+            mz_array, intensity_array = mza.ReadSpectrum(row) # each spectrum is read once, no need to cache it
+            xics = SumIntensityWindows(mz_array, intensity_array, ionsMz[ions] - mzTols[ions], ionsMz[ions] + mzTols[ions])
+            lows = np.searchsorted(mz_array, ionsMz[ions] - mzRanges[ions], side="left")
+            highs = np.searchsorted(mz_array, ionsMz[ions] + mzRanges[ions], side="right")
+            for i, k in enumerate(ions):
+                rtvals[k].append(scanRT)
+                xicvals[k].append(xics[i])
+                windows[k].append((mz_array[lows[i]:highs[i]].copy(), intensity_array[lows[i]:highs[i]].copy()))
+
+        # Ion mobility: XIM from the frame closest to the ion RT
+        imscans = mza.GetRows(msLevel=1, ionMobility=True)
+        imions = np.flatnonzero(ionsAt > 0)
+        if imscans.size > 0 and imions.size > 0:
+            frameRTs = np.unique(metadata["RetentionTime"][imscans])
+            ionFrames = frameRTs[np.abs(frameRTs[None, :] - ionsRt[imions, None]).argmin(axis=1)]
+            for frameRT in np.unique(ionFrames):
+                ions = imions[ionFrames == frameRT]
+                ions = ions[np.argsort(ionsMz[ions], kind="stable")]
+                for row in mza.GetClosestFrameRows(imscans, frameRT):
+                    scanAT = metadata["IonMobilityTime"][row]
+                    active = ions[((ionsAt[ions] - atRanges[ions]) <= scanAT) & (scanAT <= (ionsAt[ions] + atRanges[ions]))]
+                    if active.size == 0:
+                        continue
+                    mz_array, intensity_array = mza.ReadSpectrum(row)
+                    xims = SumIntensityWindows(mz_array, intensity_array, ionsMz[active] - mzTols[active], ionsMz[active] + mzTols[active])
+                    for i, k in enumerate(active):
+                        atvals[k].append(scanAT)
+                        atxicvals[k].append(xims[i])
+
+    ionTraces = []
+    for k in range(nions):
+        traces = {"mz": [], "intensity": [], "rt": [], "xic": [], "at": np.array(atvals[k]), "atxic": np.array(atxicvals[k])}
+        if len(rtvals[k]) > 0:
+            traces["rt"] = np.array(rtvals[k])
+            traces["xic"] = np.array(xicvals[k])
+            # Get spectrum at apex:
+            index = GetApexIndex(traces["xic"])
+            traces["mz"], traces["intensity"] = windows[k][index]
+        ionTraces.append(traces)
+    return ionTraces
+
+
+def GetApexIndex(xic):
+    # Index of the most intense peak in the XIC, or of the maximum intensity if no peak is found
+    index = find_peaks(xic, width=3)[0]
+    if len(index) > 0:
+        return index[np.array(xic)[index].argmax()] # keep the most intense
+    return np.array(xic).argmax()
+
+
+def GenerateImageIonBatch(dfruns, outputFolder, mz, rt, molecule, suffixImage, mzHalfWindowXIC=0.01, rtrange=0.3, mzrange=0.075, at=0, atrange=1.5, ionTraces=None, mzaReaders=None, returnPlots=False):
+    # ionTraces: optional list (one per MS run) of traces from ExtractIonTracesBatch, otherwise extracted per MS run
+    # mzaReaders: optional list (one per MS run) of open MzaReader, otherwise mza files are opened from dfruns["MZAPATH"]
+    # returnPlots: return [errors data frame, plot specs drawn by RenderImageIonBatch] instead of drawing the figures, e.g., for a RenderQueue
+    mzaFiles = mzaReaders
+    if mzaFiles is None:
+        mzaFiles = [x + ".mza" for x in dfruns["MZAPATH"]]
+    # Check and flag if ion mobility data:
+    isIMdata = False
+    if at > 0: # at = arrival time
+        # check if first mza file has ion mobility values:
+        with OpenMza(mzaFiles[0]) as mza:
+            if len(mza.metadata["IonMobilityBin"] > 0):
+                isIMdata = True
+    if ionTraces is None:
+        ionTraces = [ExtractIonTraces(mzaFile, mz, rt, mzHalfWindowXIC, rtrange, mzrange, at, atrange, isIMdata) for mzaFile in mzaFiles]
+    mzvals = [x["mz"] for x in ionTraces]
+    intensvals = [x["intensity"] for x in ionTraces]
+    rtvals = [x["rt"] for x in ionTraces]
+    xicvals = [x["xic"] for x in ionTraces]
+    atvals = [x["at"] for x in ionTraces]
+    atxicvals = [x["atxic"] for x in ionTraces]
     
     # Generate overlaid ion figures: ----------------------------
     # Create a figure with subplots
     npanels = 2
     if isIMdata:
         npanels = 3
+    plotSpecs = []
     for label in dfruns["LABELSAMPLEGROUP"].unique():
         indexes = dfruns[dfruns["LABELSAMPLEGROUP"] == label].index
         suffixImageNew = suffixImage.replace("MZ", label + "-MZ")
         legendText = dfruns.loc[indexes, "legend"]
         if len(legendText) > 15:
             legendText = legendText[0:14]
-
-        figheight = 4 * npanels
-        fig, axes = plt.subplots(nrows=npanels, ncols=1, figsize=(6, figheight), gridspec_kw={'hspace': 0.5})
-        
-        build_overlaid_plot([mzvals[i] for i in indexes.values],
-                            [intensvals[i] for i in indexes.values], 
-                            mz, mzrange, "$\it{m/z}$", "Intensity", axes[0])
-        
-        build_overlaid_plot([rtvals[i] for i in indexes.values], 
-                            [xicvals[i] for i in indexes.values], 
-                            rt, rtrange, "Retention time", "Intensity", axes[1])
-        
-        if isIMdata:
-            build_overlaid_plot([atvals[i] for i in indexes.values], 
-                                [atxicvals[i] for i in indexes.values], 
-                                at, atrange, "Arrival time", "Intensity", axes[2])
-
-        plt.legend(legendText, loc ="right", fontsize=9)
-        fig.suptitle(suffixImageNew)
-        plt.savefig(os.path.join(outputFolder, suffixImageNew + ".jpg"), bbox_inches="tight")
-        plt.savefig(os.path.join(outputFolder, suffixImageNew + ".pdf"), bbox_inches="tight")
-        plt.close()
+        plotSpecs.append({"outputFilename": os.path.join(outputFolder, suffixImageNew), "title": suffixImageNew, "npanels": npanels, "legendText": list(legendText),
+                          "mzvals": [mzvals[i] for i in indexes.values], "intensvals": [intensvals[i] for i in indexes.values], "mz": mz, "mzrange": mzrange,
+                          "rtvals": [rtvals[i] for i in indexes.values], "xicvals": [xicvals[i] for i in indexes.values], "rt": rt, "rtrange": rtrange,
+                          "isIMdata": isIMdata, "atvals": [atvals[i] for i in indexes.values], "atxicvals": [atxicvals[i] for i in indexes.values], "at": at, "atrange": atrange})
+    if not returnPlots:
+        for x in plotSpecs:
+            RenderImageIonBatch(x)
 
     # Compute errors: ----------------------------
     df = pd.DataFrame({"MSRUN": dfruns["MZAPATH"], 
@@ -188,9 +256,37 @@ def GenerateImageIonBatch(dfruns, outputFolder, mz, rt, molecule, suffixImage, m
         df["ATERROR"] = df["AT"] - at
 
     df = df[~(np.isnan(df["MZ"]) | np.isnan(df["RT"]))]
+    if returnPlots:
+        return [df, plotSpecs]
     return df
 
 
+def RenderImageIonBatch(plotSpec):
+    # Draws and saves (.jpg and .pdf) the overlaid ion figure of one sample group from a plot spec of GenerateImageIonBatch
+    p = plotSpec
+    figheight = 4 * p["npanels"]
+    fig, axes = plt.subplots(nrows=p["npanels"], ncols=1, figsize=(6, figheight), gridspec_kw={'hspace': 0.5})
+    
+    build_overlaid_plot(p["mzvals"],
+                        p["intensvals"], 
+                        p["mz"], p["mzrange"], "$\it{m/z}$", "Intensity", axes[0])
+    
+    build_overlaid_plot(p["rtvals"], 
+                        p["xicvals"], 
+                        p["rt"], p["rtrange"], "Retention time", "Intensity", axes[1])
+    
+    if p["isIMdata"]:
+        build_overlaid_plot(p["atvals"], 
+                            p["atxicvals"], 
+                            p["at"], p["atrange"], "Arrival time", "Intensity", axes[2])
+
+    plt.legend(p["legendText"], loc ="right", fontsize=9)
+    fig.suptitle(p["title"])
+    plt.savefig(p["outputFilename"] + ".jpg", bbox_inches="tight")
+    plt.savefig(p["outputFilename"] + ".pdf", bbox_inches="tight")
+    plt.close()
+
+
 def build_overlaid_plot(x,y, xcenter, xrange, xlabel1, ylabel1, ax):
     for k in range(0,len(x)):
         ax.plot(x[k], y[k], '-')
@@ -0,0 +1,117 @@
+import os
+import zipfile
+import numpy as np
+
+# IsolationWindowIndex
+# Interval index of the isolation windows of the MS/MS scans of an mza file, stored next to it (run.mza -> run.isoindex.npz)
+#   by BuildMzIndex (MzIndex option), MzaReader otherwise builds it in memory.
+# Scans are grouped in partitions (MS level x total frame spectra or ion mobility scans). In each partition, the window
+#   [target - lower offset, target + upper offset] of each scan is added to every unit m/z bucket it covers, and the postings
+#   of each bucket are sorted by retention time: scans covering an m/z within an RT range are found with a binary search
+#   in one or two buckets (DDA and DIA data).
+# Scans without isolation window (all ions fragmentation) and very wide windows are kept in a list sorted by retention time
+#   and checked for each query.
+# The index stores the size and modification time of the mza file and is ignored if the mza file changes.
+
+ISOINDEX_VERSION = 1
+MAX_BUCKETED_WIDTH = 100 # Da, wider windows are not expanded in m/z buckets
+
+
+def IsolationIndexPath(mzaFile):
+    return os.path.splitext(mzaFile)[0] + ".isoindex.npz"
+
+
+def IsolationIndexFingerprint(mzaFile):
+    stat = os.stat(mzaFile)
+    return np.array([ISOINDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+class IsolationWindowIndex:
+    def __init__(self, arrays):
+        # arrays: dictionary of the arrays of each partition, named <partition>-<array> (see Build)
+        self.partitions = {}
+        for name in set(x.rsplit("-", 1)[0] for x in arrays if x != "fingerprint"):
+            msLevel = int(name.split("-")[0][2:])
+            self.partitions[(msLevel, name.endswith("-im"))] = {x.rsplit("-", 1)[1]: arrays[x] for x in arrays if x.rsplit("-", 1)[0] == name}
+
+    @staticmethod
+    def Build(metadata):
+        # Index of the MS/MS scans (MSLevel > 1) of a Metadata table
+        arrays = {}
+        for msLevel in np.unique(metadata["MSLevel"]):
+            if msLevel < 2:
+                continue
+            for ionMobility in [False, True]:
+                if ionMobility:
+                    rows = np.flatnonzero((metadata["MSLevel"] == msLevel) & (metadata["IonMobilityBin"] > 0))
+                else:
+                    rows = np.flatnonzero((metadata["MSLevel"] == msLevel) & (metadata["IonMobilityBin"] == 0))
+                if rows.size == 0:
+                    continue
+                name = "ms" + str(msLevel) + ("-im" if ionMobility else "")
+                rows = rows[np.argsort(metadata["RetentionTime"][rows], kind="stable")]
+                target = metadata["IsolationWindowTargetMz"][rows]
+                lower = target - metadata["IsolationWindowLowerOffset"][rows]
+                upper = target + metadata["IsolationWindowUpperOffset"][rows]
+                bucketed = (target > 0) & (upper - lower <= MAX_BUCKETED_WIDTH)
+                # postings of the windows in each unit m/z bucket, sorted by bucket then retention time (rows are sorted by RT)
+                firstBuckets = np.floor(np.maximum(lower[bucketed], 0)).astype(np.int64)
+                nBuckets = np.maximum(np.floor(upper[bucketed]).astype(np.int64) - firstBuckets + 1, 0)
+                postings = np.repeat(rows[bucketed], nBuckets)
+                buckets = np.repeat(firstBuckets, nBuckets) + np.arange(nBuckets.sum()) - np.repeat(np.cumsum(nBuckets) - nBuckets, nBuckets)
+                order = np.argsort(buckets, kind="stable")
+                buckets = buckets[order]
+                postings = postings[order]
+                maxBucket = int(buckets[-1]) + 1 if buckets.size > 0 else 0
+                arrays[name + "-rows"] = postings
+                arrays[name + "-buckets"] = np.searchsorted(buckets, np.arange(0, maxBucket + 1), side="left")
+                arrays[name + "-wide"] = rows[~bucketed]
+        for name in [x for x in arrays if x.endswith("-rows") or x.endswith("-wide")]:
+            arrays[name.rsplit("-", 1)[0] + "-" + name.rsplit("-", 1)[1] + "rt"] = metadata["RetentionTime"][arrays[name]]
+        return IsolationWindowIndex(arrays), arrays
+
+    @staticmethod
+    def Load(mzaFile, metadata=None):
+        # Returns the index of an mza file from its sidecar file if valid, otherwise built from the Metadata table (if given)
+        #   and saved next to the mza file when possible
+        try:
+            with np.load(IsolationIndexPath(mzaFile)) as data:
+                if np.array_equal(data["fingerprint"], IsolationIndexFingerprint(mzaFile)):
+                    return IsolationWindowIndex({x: data[x] for x in data.files})
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile): # missing, outdated or truncated file, rebuilt
+            pass
+        if metadata is None:
+            return None
+        index, arrays = IsolationWindowIndex.Build(metadata)
+        try:
+            # written to a temporary file first, an interrupted save leaves no partial index
+            with open(IsolationIndexPath(mzaFile) + ".tmp", "wb") as f: # file object: np.savez adds no extension
+                np.savez(f, fingerprint=IsolationIndexFingerprint(mzaFile), **arrays)
+            os.replace(IsolationIndexPath(mzaFile) + ".tmp", IsolationIndexPath(mzaFile))
+        except OSError: # e.g., read-only folder, the index is kept in memory only
+            pass
+        return index
+
+    def Covering(self, metadata, msLevel, ionMobility, mz, mztolhalfwidth=0.01, startRT=-np.inf, endRT=np.inf):
+        # Metadata rows of the scans with an isolation window containing mz +- mztolhalfwidth (as IsolationWindowsContain)
+        #   and a retention time in [startRT, endRT], sorted by retention time
+        partition = self.partitions.get((msLevel, bool(ionMobility)))
+        if partition is None:
+            return np.array([], dtype=np.int64)
+        candidates = []
+        buckets = partition["buckets"]
+        for bucket in range(max(int(np.floor(mz - mztolhalfwidth)), 0), int(np.floor(mz + mztolhalfwidth)) + 1):
+            if bucket + 1 >= buckets.size:
+                break
+            first = buckets[bucket]
+            last = buckets[bucket + 1]
+            rts = partition["rowsrt"][first:last]
+            candidates.append(partition["rows"][first + np.searchsorted(rts, startRT, side="left"):first + np.searchsorted(rts, endRT, side="right")])
+        rts = partition["widert"]
+        candidates.append(partition["wide"][np.searchsorted(rts, startRT, side="left"):np.searchsorted(rts, endRT, side="right")])
+        rows = np.unique(np.concatenate(candidates))
+        target = metadata["IsolationWindowTargetMz"][rows]
+        lower = target - metadata["IsolationWindowLowerOffset"][rows] - mztolhalfwidth
+        upper = target + metadata["IsolationWindowUpperOffset"][rows] + mztolhalfwidth
+        rows = rows[(target == 0) | ((lower <= mz) & (mz <= upper))]
+        return rows[np.argsort(metadata["RetentionTime"][rows], kind="stable")]
@@ -1,135 +1,206 @@
+import inspect
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
-import h5py
-from mza.mza import GetClosestSpectrum, GetExtractedIonRetention, GetExtractedIonArrival
-
-def GenerateMS2plot(mzaFile, outputFilename, molecule, precMz, mztolhalfwidth, rt, fragsMz, fragsIntensity, at=0, mzHalfWindowXIC=0.01, rtrange=0.3, mzrange=0.07, atrange=1.5, minMzDistCentroid = 0.005): # mzrange=0.1
-    # Check and flag if ion mobility data:
-    isDIAdata = False
-    isIMdata = False
-    if at > 0: # at = arrival time
-        # check if first mza file has ion mobility values:
-        with h5py.File(mzaFile, 'r') as mza:
-            metadata = mza["Metadata"]
-            metadata = metadata[(metadata["MSLevel"] == 2) & (metadata["IsolationWindowTargetMz"] == 0) | (metadata["IsolationWindowLowerOffset"] > 1) & (metadata["IsolationWindowUpperOffset"] > 1)]
-            if len(metadata):
-                isDIAdata = True
-            if len(metadata["IonMobilityBin"] > 0):
-                isIMdata = True
-    rtvals = []
-    xicvals = []
-    atvals = []
-    atxicvals = []
-    msLevels = [1] # To add trace for precursor in first position
-    for x in fragsMz: msLevels.append(2)
-    legendText = ["p" + str(round(precMz, ndigits=2))]
-    for x in fragsMz: legendText.append(str(round(x, ndigits=2)))
-    lineStyles = ['--'] # To plot precursor trace dashed
-    for x in fragsMz: lineStyles.append('-')
-    fragstemp = [precMz]
-    for x in fragsMz: fragstemp.append(x)
-    for k in range(len(fragstemp)):
-        mz = fragstemp[k]
+from qc.mza_reader import OpenMza
+
+def GenerateMS2plot(mzaFile, outputFilename, molecule, precMz, mztolhalfwidth, rt, fragsMz, fragsIntensity, at=0, mzHalfWindowXIC=0.01, rtrange=0.3, mzrange=0.07, atrange=1.5, minMzDistCentroid = 0.005, returnPlots=False, traces=None): # mzrange=0.1
+    # mzaFile: path to the mza file or an open MzaReader
+    # returnPlots: return the plot spec (list) drawn by RenderMS2plot instead of drawing the figure, e.g., for a RenderQueue
+    # traces: optional precursor and fragment traces from ExtractMS2TracesBatch, otherwise extracted for this ion
+    with OpenMza(mzaFile) as mza:
+        if traces is None:
+            traces = ExtractMS2TracesBatch(mza, [(precMz, mztolhalfwidth, rt, fragsMz, at, mzHalfWindowXIC, rtrange, atrange)])[0]
+        isDIAdata = traces["isDIAdata"]
+        isIMdata = traces["isIMdata"]
+        rtvals = list(traces["rtvals"])
+        xicvals = list(traces["xicvals"])
+        atvals = list(traces["atvals"])
+        atxicvals = list(traces["atxicvals"])
+        legendText = ["p" + str(round(precMz, ndigits=2))]
+        for x in fragsMz: legendText.append(str(round(x, ndigits=2)))
+        lineStyles = ['--'] # To plot precursor trace dashed
+        for x in fragsMz: lineStyles.append('-')
+
+        # Scale precursor intensity:
+        preci = 0
+        if len(xicvals) > 1:
+            maxFragIntensity = max(map(lambda x: max(x, default=0), xicvals[1:]), default=0)
+            maxPrecIntensity = max(xicvals[preci], default=0)
+            # scale precursor intensity to 5% above the mas fragment intensity
+            xicvals[preci] = [(x/maxPrecIntensity) * maxFragIntensity for x in xicvals[preci]]
+        if len(atxicvals) > 1:
+            maxFragIntensity = max(map(lambda x: max(x, default=0), atxicvals[1:]), default=0)
+            maxPrecIntensity = max(atxicvals[preci], default=0)
+            # scale precursor intensity to 5% above the mas fragment intensity
+            atxicvals[preci] = [(x/maxPrecIntensity) * maxFragIntensity for x in atxicvals[preci]]
+
+        # Generate overlaid ion figures: ----------------------------
+        # Create a figure with subplots
+        npanels = 1
         if isDIAdata:
-            df = GetExtractedIonRetention(mzaFileName=mzaFile, mz=mz, msLevel=msLevels[k], startRT=rt-rtrange, endRT=rt+rtrange, mztolhalfwidth=mzHalfWindowXIC)
-            if len(df) > 0:
-                df.sort_values("rt", inplace=True, ignore_index=True)
-                rtvals.append(df["rt"])
-                xicvals.append(df["intensity"])
-            else:
-                rtvals.append([])
-                xicvals.append([])
+            npanels = 2
         if isIMdata:
-            df = GetExtractedIonArrival(mzaFileName=mzaFile, mz=mz, msLevel=msLevels[k], rt=rt, startAT = at-atrange, endAT = at+atrange, mztolhalfwidth = mzHalfWindowXIC)
-            if len(df) > 0:
-                df.sort_values("at", inplace=True, ignore_index=True)
-                atvals.append(df["at"])
-                atxicvals.append(df["intensity"])
-            else:
-                atvals.append([])
-                atxicvals.append([])
-
-    # Scale precursor intensity:
-    preci = 0
-    if len(xicvals) > 1:
-        maxFragIntensity = max(map(lambda x: max(x, default=0), xicvals[1:]), default=0)
-        maxPrecIntensity = max(xicvals[preci], default=0)
-        # scale precursor intensity to 5% above the mas fragment intensity
-        xicvals[preci] = [(x/maxPrecIntensity) * maxFragIntensity for x in xicvals[preci]]
-    if len(atxicvals) > 1:
-        maxFragIntensity = max(map(lambda x: max(x, default=0), atxicvals[1:]), default=0)
-        maxPrecIntensity = max(atxicvals[preci], default=0)
-        # scale precursor intensity to 5% above the mas fragment intensity
-        atxicvals[preci] = [(x/maxPrecIntensity) * maxFragIntensity for x in atxicvals[preci]]
-
-    # Generate overlaid ion figures: ----------------------------
-    # Create a figure with subplots
-    npanels = 1
-    if isDIAdata:
-        npanels = 2
-    if isIMdata:
-        npanels = 3
-    # Spectrum plot:
-    minmz = np.min(fragsMz)
-    maxmz = np.max(fragsMz)
-    [mz_array, intensity_array] = GetClosestSpectrum(mzaFileName=mzaFile, msLevel=2, rt=rt, at=at, precursorMz=precMz, mztolhalfwidth=mztolhalfwidth)
-    if len(mz_array) < 2:
-        return
-    # Normalize intensity:
-    maxIntensityExperimental = max(intensity_array)
-    intensity_array = [x/maxIntensityExperimental for x in intensity_array]
-    maxIntensityReference = max(fragsIntensity)
-    fragsIntensity = [x/maxIntensityReference for x in fragsIntensity]
+            npanels = 3
+        # Spectrum plot:
+        minmz = np.min(fragsMz)
+        maxmz = np.max(fragsMz)
+        [mz_array, intensity_array] = mza.GetClosestSpectrum(msLevel=2, rt=rt, at=at, precursorMz=precMz, mztolhalfwidth=mztolhalfwidth)
+        if len(mz_array) < 2:
+            return []
+        # Normalize intensity:
+        maxIntensityExperimental = max(intensity_array)
+        intensity_array = [x/maxIntensityExperimental for x in intensity_array]
+        maxIntensityReference = max(fragsIntensity)
+        fragsIntensity = [x/maxIntensityReference for x in fragsIntensity]
     
+        # Check if spectrum is profile or centroid:
+        apexmz = np.array(intensity_array).argmax()
+        if apexmz == 0 and len(intensity_array) > 1:
+            apexmz+=1
+        if apexmz == len(intensity_array) - 1 and len(intensity_array) > 0:
+            apexmz-=1
+        minMzDist = min(mz_array[apexmz+1] - mz_array[apexmz], mz_array[apexmz] - mz_array[apexmz-1])
+
+        plotSpec = {"outputFilename": outputFilename, "molecule": molecule, "npanels": npanels,
+                    "mz_array": mz_array, "intensity_array": intensity_array, "isCentroid": minMzDist > minMzDistCentroid,
+                    "maxIntensityExperimental": maxIntensityExperimental, "maxIntensityReference": maxIntensityReference,
+                    "fragsMz": fragsMz, "fragsIntensity": fragsIntensity, "minmz": minmz, "maxmz": maxmz,
+                    "isDIAdata": isDIAdata, "rtvals": rtvals, "xicvals": xicvals, "rt": rt, "rtrange": rtrange, "legendText": legendText, 
+                    "isIMdata": isIMdata, "atvals": atvals, "atxicvals": atxicvals, "at": at, "atrange": atrange, "lineStyles": lineStyles}
+    if returnPlots:
+        return [plotSpec]
+    RenderMS2plot(plotSpec)
+
+
+def GenerateMS2plotBatch(mzaFile, ms2Ions, returnPlots=False):
+    # MS/MS plots of all ions of one MS run, opening the mza file once and reading each spectrum once for the traces of all ions.
+    # ms2Ions: list of the arguments of GenerateMS2plot after mzaFile for each ion
+    # returnPlots: return the plot specs drawn by RenderMS2plot instead of drawing the figures, e.g., for a RenderQueue
+    ms2Ions = [GetMS2plotArguments(x) for x in ms2Ions]
+    plotSpecs = []
+    with OpenMza(mzaFile) as mza:
+        ionTraces = ExtractMS2TracesBatch(mza, [(x["precMz"], x["mztolhalfwidth"], x["rt"], x["fragsMz"], x["at"], x["mzHalfWindowXIC"], x["rtrange"], x["atrange"]) for x in ms2Ions])
+        for x, traces in zip(ms2Ions, ionTraces):
+            plotSpecs += GenerateMS2plot(mza, **x, returnPlots=True, traces=traces)
+    if returnPlots:
+        return plotSpecs
+    for x in plotSpecs:
+        RenderMS2plot(x)
+
+
+def GetMS2plotArguments(args):
+    # Dictionary of the arguments of GenerateMS2plot after mzaFile given as a tuple, with default values
+    arguments = inspect.signature(GenerateMS2plot).bind(None, *args)
+    arguments.apply_defaults()
+    return {k: v for k, v in arguments.arguments.items() if k not in ["mzaFile", "returnPlots", "traces"]}
+
+
+def ExtractMS2TracesBatch(mzaFile, ms2Ions):
+    # Precursor (MS1) and fragment (MS2) traces of all ions of one MS run: XICs for DIA data, XIMs for ion mobility data.
+    # ms2Ions: list of (precMz, mztolhalfwidth, rt, fragsMz, at, mzHalfWindowXIC, rtrange, atrange)
+    # Fragments are extracted from the MS2 spectra with an isolation window containing the precursor m/z +- mztolhalfwidth
+    #   (or without isolation window), all fragments of all ions are summed reading each spectrum once.
+    # Returns a list of dictionaries (isDIAdata, isIMdata, rtvals, xicvals, atvals, atxicvals), traces with the precursor in first position.
+    with OpenMza(mzaFile) as mza:
+        # Check and flag if DIA or ion mobility data (only for ions with arrival time):
+        metadata = mza.metadata
+        metadata = metadata[(metadata["MSLevel"] == 2) & (metadata["IsolationWindowTargetMz"] == 0) | (metadata["IsolationWindowLowerOffset"] > 1) & (metadata["IsolationWindowUpperOffset"] > 1)]
+        runIsDIAdata = len(metadata) > 0
+        runIsIMdata = len(metadata["IonMobilityBin"] > 0) > 0
+
+        ms1Rows = mza.GetRows(1)
+        ms1ImRows = mza.GetRows(1, ionMobility=True)
+        ionTraces = []
+        requests = [] # (rows, lowMzs, highMzs) of the XICs and XIMs of all ions, one request per ion and MS level
+        for [precMz, mztolhalfwidth, rt, fragsMz, at, mzHalfWindowXIC, rtrange, atrange] in ms2Ions:
+            traces = {"isDIAdata": runIsDIAdata and at > 0, "isIMdata": runIsIMdata and at > 0, "requests": {}}
+            for msLevel, mzs in [(1, [precMz]), (2, list(fragsMz))]:
+                mzs = np.array(mzs, dtype=float)
+                if traces["isDIAdata"]:
+                    if msLevel > 1:
+                        rowsk = mza.GetIsolationRows(msLevel, precMz, mztolhalfwidth, startRT=rt-rtrange, endRT=rt+rtrange)
+                    else:
+                        rowsk = ms1Rows
+                        rts = mza.metadata["RetentionTime"][rowsk]
+                        rowsk = rowsk[(rts >= rt-rtrange) & (rts <= rt+rtrange)]
+                    traces["requests"][("rt", msLevel)] = len(requests)
+                    requests.append((rowsk, mzs - mzHalfWindowXIC, mzs + mzHalfWindowXIC))
+                if traces["isIMdata"]:
+                    rowsk = ms1ImRows
+                    if msLevel > 1:
+                        rowsk = mza.GetIsolationRows(msLevel, precMz, mztolhalfwidth, ionMobility=True)
+                    rowsk = mza.GetClosestFrameRows(rowsk, rt)
+                    ats = mza.metadata["IonMobilityTime"][rowsk]
+                    rowsk = rowsk[(ats >= at-atrange) & (ats <= at+atrange)]
+                    traces["requests"][("at", msLevel)] = len(requests)
+                    requests.append((rowsk, mzs - mzHalfWindowXIC, mzs + mzHalfWindowXIC))
+            ionTraces.append(traces)
+        sums = mza.SumIntensityRowsBatch(requests)
+
+        for traces in ionTraces:
+            for axis, metadataColumn in [("rt", "RetentionTime"), ("at", "IonMobilityTime")]:
+                xvals = []
+                yvals = []
+                for msLevel in [1, 2]:
+                    if (axis, msLevel) not in traces["requests"]:
+                        continue
+                    i = traces["requests"][(axis, msLevel)]
+                    x = mza.metadata[metadataColumn][requests[i][0]]
+                    order = np.argsort(x, kind="stable")
+                    for k in range(sums[i].shape[1]):
+                        xvals.append(x[order] if x.size > 0 else [])
+                        yvals.append(sums[i][order, k] if x.size > 0 else [])
+                traces[axis + "vals"] = xvals
+                traces[("xic" if axis == "rt" else "atxic") + "vals"] = yvals
+            del traces["requests"]
+    return ionTraces
+
+
+def RenderMS2plot(plotSpec):
+    # Draws and saves (.jpg and .pdf) the figure of a plot spec from GenerateMS2plot
+    p = plotSpec
     # Generate subplot for the experimental spectrum
     #fig = plt.figure(figsize=(8, 6))
-    figheight = 4 * npanels
-    fig, axes = plt.subplots(nrows=npanels, ncols=1, figsize=(6, figheight), gridspec_kw={'hspace': 0.5})
+    figheight = 4 * p["npanels"]
+    fig, axes = plt.subplots(nrows=p["npanels"], ncols=1, figsize=(6, figheight), gridspec_kw={'hspace': 0.5})
     mspanel = axes
-    if npanels > 1:
+    if p["npanels"] > 1:
         mspanel = axes[0]
 
-    # Check if spectrum is profile or centroid:
-    apexmz = np.array(intensity_array).argmax()
-    if apexmz == 0 and len(intensity_array) > 1:
-        apexmz+=1
-    if apexmz == len(intensity_array) - 1 and len(intensity_array) > 0:
-        apexmz-=1
-    minMzDist = min(mz_array[apexmz+1] - mz_array[apexmz], mz_array[apexmz] - mz_array[apexmz-1])
-    if minMzDist > minMzDistCentroid: # plot centroid
-        mspanel.bar(mz_array, intensity_array, width=0.5, label='Experimental')
+    if p["isCentroid"]: # plot centroid
+        mspanel.bar(p["mz_array"], p["intensity_array"], width=0.5, label='Experimental')
     else: # plot profile
-        mspanel.plot(mz_array, intensity_array, '-', label='Experimental')
+        mspanel.plot(p["mz_array"], p["intensity_array"], '-', label='Experimental')
     mspanel.set_ylabel("Intensity")
-    mspanel.set_title("Intensity/Max: Exp=" + str(round(maxIntensityExperimental)) + ", Ref=" + str(round(maxIntensityReference)))
-    fig.suptitle(f"Fragment ions for {molecule}")
+    mspanel.set_title("Intensity/Max: Exp=" + str(round(p["maxIntensityExperimental"])) + ", Ref=" + str(round(p["maxIntensityReference"])))
+    fig.suptitle(f"Fragment ions for {p['molecule']}")
     mspanel.legend()
     # Generate subplot for reference spectrum in mirror format
-    fragsIntensity = np.array(fragsIntensity) * -1
-    mspanel.bar(fragsMz, fragsIntensity, color='red', width=0.5, label='Reference')
+    fragsIntensity = np.array(p["fragsIntensity"]) * -1
+    mspanel.bar(p["fragsMz"], fragsIntensity, color='red', width=0.5, label='Reference')
     mspanel.legend()
     # Plot horizontal line at 0 on the x-axis
     mspanel.axhline(0, color='black', linestyle='--', linewidth=1)
     # Adjust minimum and maximum x-axis limits for the current molecule
-    mspanel.set_xlim(minmz - 50, maxmz + 50)
+    mspanel.set_xlim(p["minmz"] - 50, p["maxmz"] + 50)
     mspanel.set_xlabel("m/z")
 
-    if isDIAdata:
-        build_overlaid_plot(rtvals, 
-                            xicvals, 
-                            lineStyles,
-                            rt, rtrange, "Retention time", "Intensity", axes[1])
-        axes[1].legend(legendText, loc ="right", fontsize=9)
-
-    if isIMdata:
-        build_overlaid_plot(atvals, 
-                            atxicvals, 
-                            lineStyles,
-                            at, atrange, "Arrival time", "Intensity", axes[2])
-    
-    plt.savefig(outputFilename + ".jpg")
-    plt.savefig(outputFilename + ".pdf")
+    if p["isDIAdata"]:
+        build_overlaid_plot(p["rtvals"], 
+                            p["xicvals"], 
+                            p["lineStyles"],
+                            p["rt"], p["rtrange"], "Retention time", "Intensity", axes[1])
+        axes[1].legend(p["legendText"], loc ="right", fontsize=9)
+
+    if p["isIMdata"]:
+        build_overlaid_plot(p["atvals"], 
+                            p["atxicvals"], 
+                            p["lineStyles"],
+                            p["at"], p["atrange"], "Arrival time", "Intensity", axes[2])
+
+    plt.savefig(p["outputFilename"] + ".jpg")
+    plt.savefig(p["outputFilename"] + ".pdf")
     plt.close(fig)
 
 
@@ -0,0 +1,123 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# MzIndex
+# Inverted m/z index of an mza file, stored as a sidecar folder next to it (run.mza -> run.mzindex).
+# All points of the file are grouped in partitions (MS level x total frame spectra or ion mobility scans),
+#   one set of .npy files per partition, and sorted by m/z within each partition. Each posting keeps the Metadata row index of its spectrum
+#   and its intensity, so an m/z window query only reads the postings in the window.
+# Postings are written in blocks of spectra to temporary files and sorted from there, only the m/z values and their sort order
+#   of one partition are in memory.
+# Unit m/z buckets store the first posting of each bucket to locate a window without searching the whole partition.
+# The index stores the size and modification time of the mza file and is ignored if the mza file changes.
+
+MZINDEX_VERSION = 2
+SORT_CHUNK = 4 * 1024**2 # postings reordered at once
+
+
+def MzIndexPath(mzaFile):
+    return os.path.splitext(mzaFile)[0] + ".mzindex"
+
+
+def MzaFingerprint(mzaFile):
+    stat = os.stat(mzaFile)
+    return {"version": MZINDEX_VERSION, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def IsMzIndexValid(mzaFile):
+    try:
+        with open(os.path.join(MzIndexPath(mzaFile), "index.json"), "r") as f:
+            return json.load(f)["fingerprint"] == MzaFingerprint(mzaFile)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def WriteMzIndex(mzaFile, partitions):
+    # partitions: iterable of (msLevel, ionMobility, blocks) with blocks an iterable of (mz_array, row_array, intensity_array)
+    #   with the points of a block of spectra in any order, generators keep only one block in memory.
+    # The index.json file is written last and marks the index as complete.
+    indexPath = MzIndexPath(mzaFile)
+    fingerprint = MzaFingerprint(mzaFile)
+    if os.path.exists(indexPath):
+        shutil.rmtree(indexPath)
+    os.makedirs(indexPath)
+
+    table = []
+    for [msLevel, ionMobility, blocks] in partitions:
+        name = "ms" + str(msLevel) + ("-im" if ionMobility else "")
+        # unsorted postings appended to temporary files
+        tmpFiles = {x: os.path.join(indexPath, name + "-" + x + ".tmp") for x in ["mz", "row", "intensity"]}
+        dtypes = None
+        size = 0
+        with open(tmpFiles["mz"], "wb") as fmz, open(tmpFiles["row"], "wb") as frow, open(tmpFiles["intensity"], "wb") as fintensity:
+            for [mz_array, row_array, intensity_array] in blocks:
+                if mz_array.size == 0:
+                    continue
+                if dtypes is None:
+                    dtypes = {"mz": mz_array.dtype, "row": np.dtype(np.int64), "intensity": intensity_array.dtype}
+                mz_array.astype(dtypes["mz"], copy=False).tofile(fmz)
+                row_array.astype(dtypes["row"], copy=False).tofile(frow)
+                intensity_array.astype(dtypes["intensity"], copy=False).tofile(fintensity)
+                size += mz_array.size
+        if size > 0:
+            SortPostings(indexPath, name, tmpFiles, dtypes)
+            table.append({"msLevel": int(msLevel), "ionMobility": bool(ionMobility), "name": name})
+        for x in tmpFiles.values():
+            os.remove(x)
+
+    with open(os.path.join(indexPath, "index.json"), "w") as f:
+        json.dump({"fingerprint": fingerprint, "partitions": table}, f)
+
+
+def SortPostings(indexPath, name, tmpFiles, dtypes):
+    # Saves the postings of the temporary files of a partition sorted by m/z (.npy files) and its buckets
+    mz_array = np.fromfile(tmpFiles["mz"], dtype=dtypes["mz"])
+    order = np.argsort(mz_array, kind="stable")
+    mz_array = mz_array[order]
+    np.save(os.path.join(indexPath, name + "-mz.npy"), mz_array)
+    # first posting of each unit m/z bucket, from m/z 0 to the max m/z of the partition + 1 (= number of postings)
+    maxBucket = int(np.floor(mz_array[-1])) + 1
+    np.save(os.path.join(indexPath, name + "-buckets.npy"), np.searchsorted(mz_array, np.arange(0, maxBucket + 1), side="left"))
+    del mz_array
+    for x in ["row", "intensity"]:
+        # reordered by chunks from the memory mapped temporary file into the memory mapped .npy file
+        source = np.memmap(tmpFiles[x], dtype=dtypes[x], mode="r")
+        target = np.lib.format.open_memmap(os.path.join(indexPath, name + "-" + x + ".npy"), mode="w+", dtype=dtypes[x], shape=order.shape)
+        for start in range(0, order.size, SORT_CHUNK):
+            target[start:start + SORT_CHUNK] = source[order[start:start + SORT_CHUNK]]
+        target.flush()
+        del source, target # files are closed before the temporary file is removed
+
+
+class MzIndex:
+    def __init__(self, indexPath):
+        with open(os.path.join(indexPath, "index.json"), "r") as f:
+            table = json.load(f)["partitions"]
+        # postings are memory mapped, only the pages of the queried windows are read
+        self.partitions = {}
+        for p in table:
+            self.partitions[(p["msLevel"], p["ionMobility"])] = {
+                x: np.load(os.path.join(indexPath, p["name"] + "-" + x + ".npy"), mmap_mode="r") for x in ["mz", "row", "intensity"]}
+            self.partitions[(p["msLevel"], p["ionMobility"])]["buckets"] = np.load(os.path.join(indexPath, p["name"] + "-buckets.npy"))
+
+    @staticmethod
+    def Load(mzaFile):
+        # Returns the MzIndex of an mza file, or None if the index does not exist or is outdated
+        if not IsMzIndexValid(mzaFile):
+            return None
+        return MzIndex(MzIndexPath(mzaFile))
+
+    def Window(self, msLevel, ionMobility, lowMz, highMz):
+        # Returns the postings [mz, row, intensity] with lowMz <= m/z <= highMz in the partition
+        partition = self.partitions.get((msLevel, bool(ionMobility)))
+        if partition is None:
+            return [np.array([]), np.array([], dtype=np.int64), np.array([])]
+        buckets = partition["buckets"]
+        first = buckets[min(max(int(np.floor(lowMz)), 0), buckets.size - 1)]
+        last = buckets[min(max(int(np.floor(highMz)) + 1, 0), buckets.size - 1)]
+        mz_array = partition["mz"][first:last]
+        start = first + np.searchsorted(mz_array, lowMz, side="left")
+        end = first + np.searchsorted(mz_array, highMz, side="right")
+        return [np.asarray(partition[x][start:end]) for x in ["mz", "row", "intensity"]]
@@ -0,0 +1,295 @@
+import h5py
+import hdf5plugin
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from contextlib import nullcontext
+from qc.mz_index import MzIndex, WriteMzIndex, IsMzIndexValid
+from qc.isolation_index import IsolationWindowIndex
+from qc.compact_layout import COMPACT_GROUP, IsCompactMza, WriteCompactLayout, AttachCompactLayout
+
+# MzaReader
+# Session on an mza file: keeps the HDF5 file open, caches the Metadata table and the Full_mz_array,
+#   and keeps the most recently decoded spectra in memory (LRU cache bounded by bytes).
+# Spectra are identified by their row index in the Metadata table.
+# If a valid m/z index (see qc/mz_index.py) exists next to the mza file, extracted ion queries read only
+#   the indexed points within the m/z windows instead of decoding every spectrum in the RT/AT range.
+# MS/MS scans with an isolation window containing a precursor m/z are found with the isolation window index
+#   (see qc/isolation_index.py), loaded (if saved by BuildMzIndex) or built in memory on first use.
+# If the mza file has the compact layout (see qc/compact_layout.py), spectra are read from the concatenated arrays of their
+#   MS level, and ReadSpectra reads the spectra of many rows with one slice per MS level.
+
+class MzaReader:
+    def __init__(self, mzaFile, cacheBytes=128 * 1024**2, useIndex=True):
+        self.mzaFile = mzaFile
+        self.mza = h5py.File(mzaFile, 'r', rdcc_nbytes=64 * 1024**2) # chunk cache holding several chunks of the compact layout
+        self.metadata = self.mza["Metadata"][:]
+        self.compact = None
+        if IsCompactMza(self.mza):
+            # {MS level: [offsets, mz dataset, intensity dataset]} and position of each Metadata row in its MS level
+            self.compact = {}
+            self.compactPositions = np.full(self.metadata.size, -1, dtype=np.int64)
+            for name, group in self.mza[COMPACT_GROUP].items():
+                rows = group["rows"][:]
+                self.compactPositions[rows] = np.arange(rows.size)
+                self.compact[int(name[2:])] = [group["offsets"][:], group["mz"], group["intensity"]]
+        self.full_mz = None
+        if "Full_mz_array" in self.mza:
+            # array of m/z values common for all spectra in the file, spectra store indexes (mzbins)
+            self.full_mz = self.mza["Full_mz_array"][:]
+        self.index = MzIndex.Load(mzaFile) if useIndex else None
+        self.useIndex = useIndex
+        self.isolationIndex = None
+        self.cacheBytes = cacheBytes
+        self.cache = OrderedDict()
+        self.cacheSize = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.cache.clear()
+        self.cacheSize = 0
+        self.index = None
+        self.isolationIndex = None
+        self.mza.close()
+
+    def CacheInfo(self):
+        return {"hits": self.hits, "misses": self.misses, "spectra": len(self.cache), "bytes": self.cacheSize}
+
+    def GetSpectrum(self, index):
+        # Returns [mz_array, intensity_array] of the Metadata row index
+        spectrum = self.cache.get(index)
+        if spectrum is not None:
+            self.hits += 1
+            self.cache.move_to_end(index)
+            return spectrum
+        self.misses += 1
+        spectrum = self.ReadSpectrum(index)
+        nbytes = spectrum[0].nbytes + spectrum[1].nbytes
+        if nbytes <= self.cacheBytes:
+            self.cache[index] = spectrum
+            self.cacheSize += nbytes
+            while self.cacheSize > self.cacheBytes:
+                x = self.cache.popitem(last=False)[1]
+                self.cacheSize -= x[0].nbytes + x[1].nbytes
+        return spectrum
+
+    def ReadSpectrum(self, index):
+        # Decode the spectrum of a Metadata row index from the file, without caching
+        if self.compact is not None:
+            [offsets, mz, intensity] = self.compact[int(self.metadata["MSLevel"][index])]
+            position = self.compactPositions[index]
+            return [mz[offsets[position]:offsets[position + 1]], intensity[offsets[position]:offsets[position + 1]]]
+        scan = str(self.metadata["Scan"][index])
+        mzapath = str(self.metadata["MzaPath"][index], 'utf-8')
+        if self.full_mz is not None:
+            mz_array = self.full_mz[self.mza["Arrays_mzbin" + mzapath + "/" + scan][:]]
+        else:
+            mz_array = self.mza["Arrays_mz" + mzapath + "/" + scan][:]
+        intensity_array = self.mza["Arrays_intensity" + mzapath + "/" + scan][:]
+        return [mz_array, intensity_array]
+
+    def ReadSpectra(self, rows):
+        # ReadSpectrum of each Metadata row index in rows, without caching. With the compact layout, the points of the rows
+        #   of each MS level are read with one slice (from the first to the last spectrum) if the rows are mostly contiguous
+        if self.compact is None:
+            return [self.ReadSpectrum(k) for k in rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        spectra = [None] * rows.size
+        levels = self.metadata["MSLevel"][rows]
+        for msLevel in np.unique(levels):
+            [offsets, mz, intensity] = self.compact[int(msLevel)]
+            selected = np.flatnonzero(levels == msLevel)
+            positions = self.compactPositions[rows[selected]]
+            first = offsets[positions.min()]
+            last = offsets[positions.max() + 1]
+            if last - first > 2 * (offsets[positions + 1] - offsets[positions]).sum() + mz.chunks[0]:
+                for k in selected: # scattered rows, a slice would read mostly unused points
+                    spectra[k] = self.ReadSpectrum(rows[k])
+                continue
+            mz_array = mz[first:last]
+            intensity_array = intensity[first:last]
+            for k, position in zip(selected, positions):
+                spectra[k] = [mz_array[offsets[position] - first:offsets[position + 1] - first],
+                              intensity_array[offsets[position] - first:offsets[position + 1] - first]]
+        return spectra
+
+    def GetRows(self, msLevel=1, ionMobility=False):
+        # Metadata row indexes of an MS level sorted by retention time:
+        #   total frame spectra (or spectra without ion mobility) or ion mobility scans (IonMobilityBin > 0)
+        if ionMobility:
+            rows = np.flatnonzero((self.metadata["MSLevel"] == msLevel) & (self.metadata["IonMobilityBin"] > 0))
+        else:
+            rows = np.flatnonzero((self.metadata["MSLevel"] == msLevel) & (self.metadata["IonMobilityBin"] == 0))
+        return rows[np.argsort(self.metadata["RetentionTime"][rows], kind="stable")]
+
+    def GetClosestFrameRows(self, rows, rt):
+        # Rows of the ion mobility frame with the retention time closest to rt, sorted by arrival time
+        if rows.size == 0:
+            return rows
+        rts = self.metadata["RetentionTime"][rows]
+        frameRT = rts[np.abs(rts - rt).argmin()]
+        rows = rows[rts == frameRT]
+        return rows[np.argsort(self.metadata["IonMobilityTime"][rows], kind="stable")]
+
+    def GetIsolationIndex(self):
+        # Isolation window index of the MS/MS scans: loaded from its file next to the mza file if useIndex and the file
+        #   was saved by BuildMzIndex (MzIndex option), otherwise built in memory (nothing is written next to the mza file)
+        if self.isolationIndex is None:
+            if self.useIndex:
+                self.isolationIndex = IsolationWindowIndex.Load(self.mzaFile)
+            if self.isolationIndex is None:
+                self.isolationIndex = IsolationWindowIndex.Build(self.metadata)[0]
+        return self.isolationIndex
+
+    def GetIsolationRows(self, msLevel, precursorMz, mztolhalfwidth=0.01, ionMobility=False, startRT=-np.inf, endRT=np.inf):
+        # Rows of the MS/MS scans with an isolation window containing precursorMz +- mztolhalfwidth (or without isolation window)
+        #   within the RT range, sorted by retention time
+        return self.GetIsolationIndex().Covering(self.metadata, msLevel, ionMobility, precursorMz, mztolhalfwidth, startRT, endRT)
+
+    def SumIntensityRows(self, rows, lowMz, highMz):
+        # Summed intensity within [lowMz, highMz] of each Metadata row index in rows (rows of the same partition:
+        #   MS level and total frame spectra or ion mobility scans)
+        if rows.size == 0:
+            return np.array([], dtype=float)
+        if self.index is None:
+            return np.array([SumIntensityWindows(*self.GetSpectrum(k), [lowMz], [highMz])[0] for k in rows], dtype=float)
+        [_, postingRows, postingIntensities] = self.index.Window(self.metadata["MSLevel"][rows[0]], self.metadata["IonMobilityBin"][rows[0]] > 0, lowMz, highMz)
+        sortedRows = np.sort(rows)
+        positions = np.minimum(np.searchsorted(sortedRows, postingRows), sortedRows.size - 1)
+        selected = sortedRows[positions] == postingRows
+        sums = np.bincount(positions[selected], weights=postingIntensities[selected].astype(np.float64), minlength=sortedRows.size)
+        return sums[np.searchsorted(sortedRows, rows)]
+
+    def SumIntensityRowsBatch(self, requests):
+        # SumIntensityRows for several requests (rows, lowMzs, highMzs) with one or more m/z windows each, reading each spectrum once
+        #   (or querying the m/z index if it exists). Rows of a request must be of the same partition.
+        #   Returns one array (rows x windows) of summed intensities per request.
+        sums = [np.zeros((len(rows), len(lowMzs))) for rows, lowMzs, highMzs in requests]
+        if self.index is not None:
+            for [rows, lowMzs, highMzs], x in zip(requests, sums):
+                for k in range(len(lowMzs)):
+                    x[:, k] = self.SumIntensityRows(np.asarray(rows), lowMzs[k], highMzs[k])
+            return sums
+        # (request, position) of each spectrum row, windows of all requests are summed at once
+        rowRequests = {}
+        for i, [rows, lowMzs, highMzs] in enumerate(requests):
+            for position, row in enumerate(rows):
+                rowRequests.setdefault(row, []).append((i, position))
+        for row in sorted(rowRequests):
+            mz_array, intensity_array = self.ReadSpectrum(row) # each spectrum is read once, no need to cache it
+            lowMzs = np.concatenate([requests[i][1] for i, position in rowRequests[row]])
+            highMzs = np.concatenate([requests[i][2] for i, position in rowRequests[row]])
+            rowSums = SumIntensityWindows(mz_array, intensity_array, lowMzs, highMzs)
+            start = 0
+            for i, position in rowRequests[row]:
+                end = start + sums[i].shape[1]
+                sums[i][position] = rowSums[start:end]
+                start = end
+        return sums
+
+    def GetExtractedIonRetention(self, mz, msLevel=1, startRT=0, endRT=np.inf, mztolhalfwidth=0.01):
+        # XIC: summed intensity within mz +- mztolhalfwidth of each spectrum in the RT range
+        rows = self.GetRows(msLevel)
+        rts = self.metadata["RetentionTime"][rows]
+        rows = rows[(rts >= startRT) & (rts <= endRT)]
+        intensities = self.SumIntensityRows(rows, mz - mztolhalfwidth, mz + mztolhalfwidth)
+        return pd.DataFrame({"rt": self.metadata["RetentionTime"][rows], "intensity": intensities})
+
+    def GetExtractedIonArrival(self, mz, msLevel=1, rt=0, startAT=0, endAT=np.inf, mztolhalfwidth=0.01):
+        # XIM: summed intensity within mz +- mztolhalfwidth of each ion mobility scan in the AT range, frame closest to rt
+        rows = self.GetClosestFrameRows(self.GetRows(msLevel, ionMobility=True), rt)
+        ats = self.metadata["IonMobilityTime"][rows]
+        rows = rows[(ats >= startAT) & (ats <= endAT)]
+        intensities = self.SumIntensityRows(rows, mz - mztolhalfwidth, mz + mztolhalfwidth)
+        return pd.DataFrame({"at": self.metadata["IonMobilityTime"][rows], "intensity": intensities})
+
+    def Extract2DIonIntensityFrame(self, mz, msLevel=1, startRT=0, endRT=np.inf, startAT=0, endAT=np.inf, mztolhalfwidth=0.01):
+        # XIS: summed intensity within mz +- mztolhalfwidth of each ion mobility scan in the RT and AT ranges
+        rows = self.GetRows(msLevel, ionMobility=True)
+        rts = self.metadata["RetentionTime"][rows]
+        ats = self.metadata["IonMobilityTime"][rows]
+        rows = rows[(rts >= startRT) & (rts <= endRT) & (ats >= startAT) & (ats <= endAT)]
+        intensities = self.SumIntensityRows(rows, mz - mztolhalfwidth, mz + mztolhalfwidth)
+        return pd.DataFrame({"rt": self.metadata["RetentionTime"][rows], "at": self.metadata["IonMobilityTime"][rows], "intensity": intensities})
+
+    def GetClosestSpectrum(self, msLevel=1, rt=0, at=0, precursorMz=0, mztolhalfwidth=0.01):
+        # Spectrum closest to rt (and to at for ion mobility data). For MS2, only spectra with an
+        #   isolation window containing precursorMz +- mztolhalfwidth (or without isolation window)
+        ionMobility = at > 0 and self.GetRows(msLevel, ionMobility=True).size > 0
+        if msLevel > 1 and precursorMz > 0:
+            rows = self.GetIsolationRows(msLevel, precursorMz, mztolhalfwidth, ionMobility)
+        else:
+            rows = self.GetRows(msLevel, ionMobility=ionMobility)
+        if rows.size == 0:
+            return [np.array([]), np.array([])]
+        if self.metadata["IonMobilityBin"][rows[0]] > 0:
+            rows = self.GetClosestFrameRows(rows, rt)
+            return self.GetSpectrum(rows[np.abs(self.metadata["IonMobilityTime"][rows] - at).argmin()])
+        return self.GetSpectrum(rows[np.abs(self.metadata["RetentionTime"][rows] - rt).argmin()])
+
+
+def OpenMza(mzaFile):
+    # Use in a with statement: opens an MzaReader for an mza file path,
+    #   or returns the MzaReader given as argument without closing it at the end
+    if isinstance(mzaFile, MzaReader):
+        return nullcontext(mzaFile)
+    return MzaReader(mzaFile)
+
+
+def IsolationWindowsContain(metadata, mz, mztolhalfwidth=0.01):
+    # Mask of Metadata rows with an isolation window containing mz +- mztolhalfwidth,
+    #   rows without isolation window target (all ions fragmentation) contain all m/z values
+    target = metadata["IsolationWindowTargetMz"]
+    lower = target - metadata["IsolationWindowLowerOffset"] - mztolhalfwidth
+    upper = target + metadata["IsolationWindowUpperOffset"] + mztolhalfwidth
+    return (target == 0) | ((lower <= mz) & (mz <= upper))
+
+
+def SumIntensityWindows(mz_array, intensity_array, lowMzs, highMzs):
+    # Sum the intensities within each [low, high] m/z window, mz_array must be sorted
+    cumsum = np.concatenate(([0], np.cumsum(intensity_array, dtype=np.float64)))
+    return cumsum[np.searchsorted(mz_array, highMzs, side="right")] - cumsum[np.searchsorted(mz_array, lowMzs, side="left")]
+
+
+def BuildMzIndex(mzaFile, blockSize=2000):
+    # Write the m/z index of an mza file (see qc/mz_index.py), if it does not exist or the mza file changed.
+    #   Spectra are read in blocks of blockSize rows to limit memory.
+    if IsMzIndexValid(mzaFile):
+        return
+    with MzaReader(mzaFile, cacheBytes=0, useIndex=False) as mza:
+        IsolationWindowIndex.Load(mzaFile, mza.metadata) # saved next to the mza file if outdated
+        def postings(rows):
+            spectra = mza.ReadSpectra(rows)
+            sizes = np.array([x[0].size for x in spectra], dtype=np.int64)
+            return [np.concatenate([x[0] for x in spectra]), 
+                    np.repeat(rows.astype(np.int64), sizes), 
+                    np.concatenate([x[1] for x in spectra])]
+        def partitions():
+            for msLevel in np.unique(mza.metadata["MSLevel"]):
+                for ionMobility in [False, True]:
+                    rows = mza.GetRows(msLevel, ionMobility=ionMobility)
+                    if rows.size == 0:
+                        continue
+                    yield [msLevel, ionMobility, (postings(rows[start:start + blockSize]) for start in range(0, rows.size, blockSize))]
+        WriteMzIndex(mzaFile, partitions())
+
+
+def CompactMza(mzaFile, blockSize=2000):
+    # Write the compact layout (see qc/compact_layout.py) into an mza file if not present, reading blocks of spectra to limit memory.
+    #   The mza file changes: run before building its m/z index.
+    with MzaReader(mzaFile, cacheBytes=0, useIndex=False) as mza:
+        if mza.compact is not None:
+            return
+        def levels():
+            for msLevel in np.unique(mza.metadata["MSLevel"]):
+                rows = np.concatenate([mza.GetRows(msLevel, ionMobility=False), mza.GetRows(msLevel, ionMobility=True)])
+                yield [msLevel, rows, ([mza.ReadSpectrum(k) for k in rows[start:start + blockSize]] for start in range(0, rows.size, blockSize))]
+        WriteCompactLayout(mzaFile, levels())
+    AttachCompactLayout(mzaFile)
@@ -0,0 +1,212 @@
+import os
+import re
+import time
+import zlib
+import base64
+import numpy as np
+import pandas as pd
+import h5py
+from xml.etree.ElementTree import iterparse
+from multiprocessing.pool import Pool
+
+# mzML to mza converter (without mza.exe, e.g., on Linux)
+# Spectra are streamed from the mzML file with an incremental XML parser (elements are cleared once converted) and their
+#   binary arrays (base64, optionally zlib compressed) are decoded with NumPy. Points below the intensity threshold
+#   (MinIntensityMza) are removed.
+# The mza file has the layout read by MzaReader: a Metadata table (Scan, MSLevel, RetentionTime in minutes, IonMobilityBin,
+#   IonMobilityTime, MzaPath, TIC and isolation window fields) written in chunks, and one compressed dataset per spectrum in
+#   Arrays_mz<MzaPath>/<Scan> and Arrays_intensity<MzaPath>/<Scan>.
+# Ion mobility data (consecutive spectra of the same RT and MS level with a drift time) are stored as ion mobility scans
+#   (IonMobilityBin 1, 2, ...) followed by a total frame spectrum (IonMobilityBin 0) summing the scans of the frame.
+# Spectra without ion mobility keep the scan number of the mzML file (scan=<n> of the spectrum id, index + 1 otherwise),
+#   ion mobility scans, total frame spectra and repeated scan numbers are numbered after the last written scan.
+
+METADATA_DTYPE = np.dtype([("Scan", np.int32),
+                           ("MSLevel", np.int32),
+                           ("RetentionTime", np.float32),
+                           ("IonMobilityBin", np.int32),
+                           ("IonMobilityTime", np.float32),
+                           ("MzaPath", "S16"),
+                           ("TIC", np.float64),
+                           ("IsolationWindowTargetMz", np.float64),
+                           ("IsolationWindowLowerOffset", np.float64),
+                           ("IsolationWindowUpperOffset", np.float64)])
+METADATA_CHUNK = 4096 # rows of the Metadata table written at once
+SCANS_PER_GROUP = 10000 # spectra per MzaPath group
+
+CV_MSLEVEL = "MS:1000511"
+CV_SCANSTARTTIME = "MS:1000016"
+CV_TIC = "MS:1000285"
+CV_TARGETMZ = "MS:1000827"
+CV_LOWEROFFSET = "MS:1000828"
+CV_UPPEROFFSET = "MS:1000829"
+CV_SELECTEDIONMZ = "MS:1000744"
+CV_DRIFTTIME = ["MS:1002476", "MS:1002815"] # drift time (ms), inverse reduced ion mobility
+CV_MZARRAY = "MS:1000514"
+CV_INTENSITYARRAY = "MS:1000515"
+CV_DTYPES = {"MS:1000521": np.float32, "MS:1000523": np.float64, "MS:1000519": np.int32, "MS:1000522": np.int64}
+CV_ZLIB = "MS:1000574"
+CV_SECONDS = "UO:0000010"
+
+
+def LocalName(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def CvParams(element):
+    # {accession: (value, unitAccession)} of the cvParam elements below element
+    return {x.get("accession"): (x.get("value"), x.get("unitAccession")) for x in element.iter() if LocalName(x.tag) == "cvParam"}
+
+
+def DecodeBinaryArray(element):
+    # NumPy array of a binaryDataArray element and its array type (CV_MZARRAY, CV_INTENSITYARRAY or None)
+    params = CvParams(element)
+    dtype = next((CV_DTYPES[x] for x in params if x in CV_DTYPES), np.float64)
+    binary = next((x for x in element if LocalName(x.tag) == "binary"), None)
+    data = base64.b64decode(binary.text) if binary is not None and binary.text else b""
+    if CV_ZLIB in params:
+        data = zlib.decompress(data)
+    elif any(x in params for x in ["MS:1002312", "MS:1002313", "MS:1002314"]):
+        raise ValueError("MS-Numpress compressed arrays are not supported")
+    arrayType = CV_MZARRAY if CV_MZARRAY in params else CV_INTENSITYARRAY if CV_INTENSITYARRAY in params else None
+    return [np.frombuffer(data, dtype=dtype), arrayType]
+
+
+def ReadMzmlSpectra(mzmlFile):
+    # Generator of the spectra of an mzML file: dictionaries with scan, msLevel, rt (minutes), driftTime (None if
+    #   no ion mobility), tic (None if not given), targetMz, lowerOffset, upperOffset, mz and intensity arrays
+    spectrumList = None
+    for event, element in iterparse(mzmlFile, events=("start", "end")):
+        if event == "start":
+            if LocalName(element.tag) == "spectrumList":
+                spectrumList = element
+            continue
+        if LocalName(element.tag) != "spectrum":
+            continue
+        params = CvParams(element)
+        found = re.search(r"scan=(\d+)", element.get("id", ""))
+        rt = float(params.get(CV_SCANSTARTTIME, (0, None))[0])
+        if params.get(CV_SCANSTARTTIME, (0, None))[1] == CV_SECONDS:
+            rt /= 60
+        driftTime = next((float(params[x][0]) for x in CV_DRIFTTIME if x in params), None)
+        targetMz = float(params[CV_TARGETMZ][0]) if CV_TARGETMZ in params else float(params.get(CV_SELECTEDIONMZ, (0, None))[0])
+        spectrum = {"scan": int(found.group(1)) if found else int(element.get("index", 0)) + 1,
+                    "msLevel": int(params.get(CV_MSLEVEL, (1, None))[0]),
+                    "rt": rt,
+                    "driftTime": driftTime,
+                    "tic": float(params[CV_TIC][0]) if CV_TIC in params else None,
+                    "targetMz": targetMz,
+                    "lowerOffset": float(params.get(CV_LOWEROFFSET, (0, None))[0]),
+                    "upperOffset": float(params.get(CV_UPPEROFFSET, (0, None))[0]),
+                    "mz": np.array([]),
+                    "intensity": np.array([])}
+        for x in element.iter():
+            if LocalName(x.tag) == "binaryDataArray":
+                [values, arrayType] = DecodeBinaryArray(x)
+                if arrayType == CV_MZARRAY:
+                    spectrum["mz"] = values.astype(np.float64)
+                elif arrayType == CV_INTENSITYARRAY:
+                    spectrum["intensity"] = values.astype(np.float32)
+        if spectrumList is not None:
+            spectrumList.clear() # drop converted spectra from the tree to keep the memory bounded
+        yield spectrum
+
+
+class MzaWriter:
+    def __init__(self, mzaFile):
+        self.mza = h5py.File(mzaFile, "w")
+        self.metadata = self.mza.create_dataset("Metadata", shape=(0,), maxshape=(None,), dtype=METADATA_DTYPE,
+                                                chunks=(METADATA_CHUNK,), compression="gzip")
+        self.rows = []
+        self.scans = set()
+        self.scan = 0 # last scan number
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def Write(self, mz, intensity, msLevel, rt, imBin=0, at=0, tic=None, target=0, lower=0, upper=0, scan=None):
+        # Appends a spectrum with its scan number, numbered after the last scan if None or already written
+        if scan is None or scan in self.scans:
+            scan = self.scan + 1
+        self.scans.add(scan)
+        self.scan = max(self.scan, scan)
+        mzapath = "/" + str(scan // SCANS_PER_GROUP)
+        order = np.argsort(mz, kind="stable")
+        compression = "gzip" if mz.size >= 64 else None # small arrays are stored as is
+        self.mza.create_dataset("Arrays_mz" + mzapath + "/" + str(scan), data=mz[order], compression=compression)
+        self.mza.create_dataset("Arrays_intensity" + mzapath + "/" + str(scan), data=intensity[order], compression=compression)
+        self.rows.append((scan, msLevel, rt, imBin, at, mzapath.encode(), float(intensity.sum()) if tic is None else tic, target, lower, upper))
+        if len(self.rows) >= METADATA_CHUNK:
+            self.Flush()
+
+    def Flush(self):
+        if len(self.rows) == 0:
+            return
+        size = self.metadata.shape[0]
+        self.metadata.resize((size + len(self.rows),))
+        self.metadata[size:] = np.array(self.rows, dtype=METADATA_DTYPE)
+        self.rows = []
+
+    def close(self):
+        self.Flush()
+        self.mza.close()
+
+
+def ConvertMzmlToMza(mzmlFile, mzaFile, minIntensity=0):
+    # Converts an mzML file to an mza file, removing the points with an intensity below minIntensity
+    frame = [] # ion mobility scans of the current frame
+    with MzaWriter(mzaFile + ".tmp") as writer:
+        def writeFrame():
+            if len(frame) == 0:
+                return
+            first = frame[0]
+            for k, x in enumerate(frame):
+                writer.Write(x["mz"], x["intensity"], x["msLevel"], x["rt"], k + 1, x["driftTime"], x["tic"], x["targetMz"], x["lowerOffset"], x["upperOffset"])
+            # total frame spectrum: intensities of the scans summed per m/z
+            mz, positions = np.unique(np.concatenate([x["mz"] for x in frame]), return_inverse=True)
+            intensity = np.bincount(positions, weights=np.concatenate([x["intensity"] for x in frame]), minlength=mz.size).astype(np.float32)
+            writer.Write(mz, intensity, first["msLevel"], first["rt"], 0, 0, None, first["targetMz"], first["lowerOffset"], first["upperOffset"])
+            frame.clear()
+
+        for x in ReadMzmlSpectra(mzmlFile):
+            keep = x["intensity"] >= minIntensity
+            x["mz"] = x["mz"][keep]
+            x["intensity"] = x["intensity"][keep]
+            if len(frame) > 0 and (x["driftTime"] is None or x["rt"] != frame[0]["rt"] or x["msLevel"] != frame[0]["msLevel"]):
+                writeFrame()
+            if x["driftTime"] is None:
+                writer.Write(x["mz"], x["intensity"], x["msLevel"], x["rt"], 0, 0, x["tic"], x["targetMz"], x["lowerOffset"], x["upperOffset"], x["scan"])
+            else:
+                frame.append(x)
+        writeFrame()
+    os.replace(mzaFile + ".tmp", mzaFile) # an interrupted conversion leaves no partial mza file
+
+
+def ConvertMzmlFile(mzmlFile, mzaFile, minIntensity=0):
+    # ConvertMzmlToMza with the record of the conversion (as RunConversions of qc/conversion_scheduler.py)
+    start = time.perf_counter()
+    returnCode = 0
+    try:
+        ConvertMzmlToMza(mzmlFile, mzaFile, minIntensity)
+    except Exception as e:
+        print("Error: conversion of " + mzmlFile + " failed: " + str(e))
+        returnCode = 1
+    return {"MSRUN": os.path.splitext(os.path.basename(mzaFile))[0],
+            "THREADS": 1,
+            "RETURNCODE": returnCode,
+            "SECONDS": round(time.perf_counter() - start, 2),
+            "MZASIZE": os.path.getsize(mzaFile) if os.path.exists(mzaFile) else -1,
+            "LOG": ""}
+
+
+def ConvertMzmlFiles(mzmlFiles, mzaFiles, minIntensity=0, nProcesses=1):
+    # Converts mzML files in parallel (one process per file), returns the records of the conversions as a data frame
+    if nProcesses > 1 and len(mzmlFiles) > 1:
+        with Pool(min(nProcesses, len(mzmlFiles))) as pool:
+            records = pool.starmap(ConvertMzmlFile, [(x, y, minIntensity) for x, y in zip(mzmlFiles, mzaFiles)])
+    else:
+        records = [ConvertMzmlFile(x, y, minIntensity) for x, y in zip(mzmlFiles, mzaFiles)]
+    return pd.DataFrame(records, columns=["MSRUN", "THREADS", "RETURNCODE", "SECONDS", "MZASIZE", "LOG"])
@@ -1,50 +1,53 @@
 import os
 import numpy as np
 from PIL import Image
-from sklearn.decomposition import PCA
+import tempfile
+from sklearn.decomposition import PCA, IncrementalPCA
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.colors as pltcolors
 import matplotlib.backends.backend_pdf
+from qc.image_time_vs_mz import GetTimeVsMzMatrixShape, LoadTimeVsMzMatrix, TIME_VS_MZ_CMAP
 
-def PerformPCA(images, msRuns, labelGroups, runIds, outputFolder, mzaFiles, display = False, minIntensityPresencePercentage=80):
+def PerformPCA(images, msRuns, labelGroups, runIds, outputFolder, mzaFiles, display = False, minIntensityPresencePercentage=80, batchSize=0, basisFile=None,
+               imageMinIntensityPercentage=10, imageMaxIntensityCeilingPercentage=70):
+    # images: binned time-vs-m/z matrices (.npz from GenerateImageTimeVsMz) or rendered images (.jpg)
+    # imageMinIntensityPercentage, imageMaxIntensityCeilingPercentage: floor and ceiling of the .npz matrices, as in their images
+    # batchSize: 0 loads all images in memory and performs an exact PCA, otherwise the images are streamed
+    #   in batches of batchSize runs to an incremental PCA, memory is bounded by the batch size.
+    # basisFile: PCA basis (npz) saved by a previous call, if it exists the runs are projected on it without refitting.
+    #   The fitted basis is saved to outputFolder/PCA-basis.npz
 
-    # create an empty list to store the image data
-    images1D = []
-
-    minW = 1000000
-    minH = minW
-    # loop through all the images in the folder and check their sizes to keep the smallest dimension:
-    for filename in images:
-        if filename.endswith('.jpg'):
-            # load the image and flatten its data
-            img = Image.open(filename).convert('L')
-            width, height = img.size
-            if width < minW:
-                minW = width
-            if height < minH:
-                minH = height
+    # check image sizes (header only) to keep the smallest dimension:
+    [minW, minH] = GetImagesMinSize(images)
+    basis = None
+    if basisFile is not None and os.path.exists(basisFile):
+        basis = dict(np.load(basisFile))
+        [minW, minH] = basis["size"] # images are cropped or padded to the size of the basis
     
-    # loop images to crop them, add their flattened data to the lists
-    for filename in images:
-        if filename.endswith('.jpg'):
-            img = Image.open(filename).convert('L')
-            width, height = img.size
-            # box for cropping is a 4-tuple defining the left, upper, right, and lower pixel coordinate. 
-            #   Origin is top left of image. MZ x RT origin is bottom left.
-            img = img.crop((0, height - minH, minW, height))
-            img = np.array(img).flatten()
-            images1D.append(img)
-            
-    # convert the image data and labelGroups to numpy arrays
-    images1D = np.array(images1D)
     labelGroups = np.array(labelGroups)
     runIds = np.array(runIds)
+    streaming = batchSize > 0 or basis is not None
+    tmpdir = None
+    if streaming:
+        # each image is decoded once to a file-backed matrix, read again by batches
+        tmpdir = tempfile.TemporaryDirectory(dir=outputFolder)
+        images1D = LoadImages1D(images, minW, minH, os.path.join(tmpdir.name, "images1D.npy"), imageMinIntensityPercentage, imageMaxIntensityCeilingPercentage)
+        batchSize = batchSize if batchSize > 0 else 20
+        if basis is None:
+            basis = FitIncrementalPCA(images1D, batchSize, minW, minH)
+        transformed_data = ProjectPCA(images1D, basis, batchSize)
+        explained_variance_ratio = basis["explained_variance_ratio"]
+    else:
+        images1D = LoadImages1D(images, minW, minH, None, imageMinIntensityPercentage, imageMaxIntensityCeilingPercentage)
 
-    # perform PCA on the image data
-    pca = PCA(n_components=2)
-    pca.fit(images1D)
-    transformed_data = pca.transform(images1D)
+        # perform PCA on the image data
+        pca = PCA(n_components=2)
+        pca.fit(images1D)
+        transformed_data = pca.transform(images1D)
+        explained_variance_ratio = pca.explained_variance_ratio_
+        basis = {"components": pca.components_, "mean": pca.mean_, "explained_variance_ratio": pca.explained_variance_ratio_, "size": np.array([minW, minH])}
+    np.savez(os.path.join(outputFolder, "PCA-basis.npz"), **basis)
 
     # Create data frame for saving formated output:
     df = pd.DataFrame({"MSRUN": msRuns, "LABELSAMPLEGROUP": labelGroups, "MSRUNID": runIds, "PC1": transformed_data[:, 0], "PC2": transformed_data[:, 1], "MZAPATH": mzaFiles})
@@ -80,8 +83,8 @@ def PerformPCA(images, msRuns, labelGroups, runIds, outputFolder, mzaFiles, disp
         plt.text(x=df["PC1"][i]+0.3, y=df["PC2"][i]+0.3, s=(str(df["MSRUNID"][i])), 
             rotation=40, rotation_mode="anchor",     
             fontdict=dict(color="black",size=8))
-    plt.xlabel("PC1, explained variance " + "{:.3f}".format(pca.explained_variance_ratio_[0]))
-    plt.ylabel("PC2, explained variance " + "{:.3f}".format(pca.explained_variance_ratio_[1]))
+    plt.xlabel("PC1, explained variance " + "{:.3f}".format(explained_variance_ratio[0]))
+    plt.ylabel("PC2, explained variance " + "{:.3f}".format(explained_variance_ratio[1]))
 
     #plt.savefig(outputFolder + "/PCA.jpg")
     plt.savefig(outputFolder + "/PCA.pdf")
@@ -89,31 +92,119 @@ def PerformPCA(images, msRuns, labelGroups, runIds, outputFolder, mzaFiles, disp
         plt.show(block=False)
 
     # Find common ions per LABELSAMPLEGROUP: --------------
-    images1DFreq = np.copy(images1D)
-    # normalize pixel values to 0 and 1:
-    for k in range(images1DFreq.shape[0]):
-            threshold = np.max(images1DFreq[k]) * (minIntensityPresencePercentage/100)
-            images1DFreq[k][images1DFreq[k] < threshold] = 0
-            images1DFreq[k][images1DFreq[k] > 0] = 1
-
-    # build a data frame with detected ions and frequencies:
+    dfIons = FindCommonIons(images1D, df, minW, minH, minIntensityPresencePercentage, batchSize if batchSize > 0 else 20)
+    if streaming:
+        del images1D
+        tmpdir.cleanup()
+    return dfIons
+
+
+def GetImagesMinSize(images):
+    # Smallest width and height of the images (.npz matrices or .jpg), reading only the headers
+    minW = 1000000
+    minH = minW
+    for filename in images:
+        if filename.endswith('.npz'):
+            height, width = GetTimeVsMzMatrixShape(filename)
+        elif filename.endswith('.jpg'):
+            with Image.open(filename) as img:
+                width, height = img.size
+        else:
+            continue
+        if width < minW:
+            minW = width
+        if height < minH:
+            minH = height
+    return [minW, minH]
+
+
+def LoadImages1D(images, minW, minH, outputFile=None, minIntensityPercentage=10, maxIntensityCeilingPercentage=70):
+    # Matrix (runs x pixels, uint8) of the flattened gray images cropped to minW x minH (padded with 0 if smaller),
+    #   in memory or memory mapped to outputFile
+    images = [x for x in images if x.endswith('.npz') or x.endswith('.jpg')]
+    if outputFile is None:
+        images1D = np.zeros((len(images), minW * minH), dtype=np.uint8)
+    else:
+        images1D = np.lib.format.open_memmap(outputFile, mode="w+", dtype=np.uint8, shape=(len(images), minW * minH))
+    for k, filename in enumerate(images):
+        if filename.endswith('.npz'):
+            images1D[k] = GetGrayTimeVsMzMatrix(filename, minW, minH, minIntensityPercentage, maxIntensityCeilingPercentage).flatten()
+            continue
+        with Image.open(filename) as img:
+            img = img.convert('L')
+            width, height = img.size
+            # box for cropping is a 4-tuple defining the left, upper, right, and lower pixel coordinate. 
+            #   Origin is top left of image. MZ x RT origin is bottom left.
+            img = img.crop((0, height - minH, minW, height))
+            images1D[k] = np.array(img).flatten()
+    return images1D
+
+
+def GetGrayTimeVsMzMatrix(matrixFile, minW, minH, minIntensityPercentage=10, maxIntensityCeilingPercentage=70):
+    # Gray pixels (0-255) of a binned time-vs-m/z matrix, oriented as the JPEG image (origin top left, MZ x RT origin bottom left):
+    #   floor, ceiling and colormap of ColorizeTimeVsMz relative to the maximum intensity of the run, converted to gray as
+    #   Image.convert('L'), without the JPEG losses (retention times rounded to the same pixel are summed in the matrix)
+    matrix = LoadTimeVsMzMatrix(matrixFile)
+    maxIntensity = np.max(matrix, initial=0)
+    pixels = np.zeros(matrix.shape, dtype=np.uint8)
+    kept = (np.trunc(matrix) >= maxIntensity * (minIntensityPercentage/100)) & (matrix > 0)
+    if kept.any():
+        x = np.trunc(np.log10(matrix[kept])) / np.log10(maxIntensity * (maxIntensityCeilingPercentage/100))
+        rgb = (TIME_VS_MZ_CMAP(x)[:, 0:3] * 255).astype(np.uint32)
+        pixels[kept] = (rgb[:, 0] * 19595 + rgb[:, 1] * 38470 + rgb[:, 2] * 7471 + 0x8000) >> 16 # ITU-R 601-2 luma of PIL
+    # cropped (lowest m/z and first retention times) or padded with 0 to minH x minW
+    gray = np.zeros((minH, minW), dtype=np.uint8)
+    height = min(minH, pixels.shape[0])
+    width = min(minW, pixels.shape[1])
+    gray[:height, :width] = pixels[:height, :width]
+    return gray[::-1]
+
+
+def GetBatches(n, batchSize):
+    # [start, end) of the batches of n rows, the last batch is merged with the previous one if it has less than 2 rows (PCA components)
+    bounds = list(range(0, n, batchSize)) + [n]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < 2:
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def FitIncrementalPCA(images1D, batchSize, minW, minH):
+    pca = IncrementalPCA(n_components=2)
+    for [start, end] in GetBatches(images1D.shape[0], batchSize):
+        pca.partial_fit(np.asarray(images1D[start:end], dtype=np.float64))
+    return {"components": pca.components_, "mean": pca.mean_, "explained_variance_ratio": pca.explained_variance_ratio_, "size": np.array([minW, minH])}
+
+
+def ProjectPCA(images1D, basis, batchSize):
+    # Coordinates of the images on the PCA basis (components and mean), by batches
+    transformed_data = np.zeros((images1D.shape[0], basis["components"].shape[0]))
+    for [start, end] in GetBatches(images1D.shape[0], batchSize):
+        transformed_data[start:end] = (np.asarray(images1D[start:end], dtype=np.float64) - basis["mean"]) @ basis["components"].T
+    return transformed_data
+
+
+def FindCommonIons(images1D, df, minW, minH, minIntensityPresencePercentage, batchSize):
+    # Data frame of the pixels present in the runs of each LABELSAMPLEGROUP (except blanks), indexed by pixel (flattened image 1D):
+    #   FREQ is the number of runs with the pixel above minIntensityPresencePercentage of the run maximum,
+    #   INTENSITY is the pixel value in the first run of the group. Only pixels with FREQ and INTENSITY > 0 are kept.
+    #   Presence is counted by batches of runs, no matrix of pixels x runs is built.
     dfIons = pd.DataFrame()
-    df["IndexOriginal"] = range(1, df.shape[0]+1)
     for label in df['LABELSAMPLEGROUP'].unique():
         if "blank" in label.lower(): # skip blanks, no needed to check RT and m/z shift
             continue
-        runIndexes = np.array(df[df['LABELSAMPLEGROUP'] == label]["IndexOriginal"]) - 1
-        dfimg = pd.DataFrame(np.transpose(images1DFreq[runIndexes]))
-        dfimg["FREQ"] = dfimg.sum(axis=1)
-        dfimg["indexPixel1D"] = range(0, dfimg.shape[0])
-        dfimg["MZ"] = minH - np.floor(dfimg["indexPixel1D"] / minW) - 1 # Substract minH to calculate m/z: bottom left in image, but 1D array starts at top left (pixel flattened image 1D)
-        dfimg["RT"] = dfimg["indexPixel1D"] % minW
-        # Take the INTENSITY from the first run in group for this label:
-        dfimg["INTENSITY"] = np.transpose(images1D[runIndexes[0]])
-        dfimg = dfimg[(dfimg["FREQ"] > 0) & (dfimg["INTENSITY"] > 0)]
-        dfimg["LABELSAMPLEGROUP"] = label
-        dfIons = pd.concat([dfIons, dfimg[["LABELSAMPLEGROUP", "MZ", "RT", "FREQ", "INTENSITY"]]])
-
+        runIndexes = np.flatnonzero(df['LABELSAMPLEGROUP'] == label)
+        freq = np.zeros(images1D.shape[1], dtype=np.uint64)
+        for [start, end] in GetBatches(runIndexes.size, batchSize):
+            batch = np.asarray(images1D[runIndexes[start:end]])
+            # pixels above the intensity threshold of each run:
+            thresholds = np.max(batch, axis=1) * (minIntensityPresencePercentage/100)
+            freq += ((batch >= thresholds[:, None]) & (batch > 0)).sum(axis=0, dtype=np.uint64)
+        intensity = np.asarray(images1D[runIndexes[0]])
+        indexPixel1D = np.flatnonzero((freq > 0) & (intensity > 0))
+        dfimg = pd.DataFrame({"LABELSAMPLEGROUP": label,
+                              "MZ": minH - np.floor(indexPixel1D / minW) - 1, # Substract minH to calculate m/z: bottom left in image, but 1D array starts at top left (pixel flattened image 1D)
+                              "RT": indexPixel1D % minW,
+                              "FREQ": freq[indexPixel1D],
+                              "INTENSITY": intensity[indexPixel1D]}, index=indexPixel1D)
+        dfIons = pd.concat([dfIons, dfimg])
     return dfIons
-        #dfimg.to_csv(outputFolder + "/Ions-" + label + ".csv", index=False)
-
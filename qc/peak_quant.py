@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+import h5py
+from multiprocessing.pool import Pool
+from qc.mza_reader import OpenMza
+
+# Targeted MS1 extraction (PeakQuant)
+# The MS1 spectra of each MS run are read once, in blocks of scans. All targets are mapped to their m/z windows
+#   (MZ +- mz_tolerance_halfwidth) with searchsorted on the cumulative intensities of the spectra of a block, giving a
+#   targets x scans XIC matrix. Abundances are the XIC sums within the RT window of each target (RT +- RTVIEWHALFWINDOW,
+#   the whole run if the target has no RT), scaled by 1/1000 as in ImageIonBatch.
+# MS runs are processed in parallel and the abundances are saved as a targets x runs matrix in HDF5 and in CSV.
+
+MAX_BLOCK_WINDOWS = 5000000 # scans x targets of a block, bounds the memory of the window bounds
+
+
+def ReadQuantTargets(targetsFile, precursorMzDecimals=5, rtHalfWindow=0.5):
+    # Data frame of the targets (MOLECULE, MZ rounded to precursorMzDecimals, RT and RTVIEWHALFWINDOW)
+    df = pd.read_csv(targetsFile)
+    df.columns = df.columns.str.upper()
+    df["MZ"] = df["MZ"].astype(float).round(precursorMzDecimals)
+    if "MOLECULE" not in df.columns:
+        df["MOLECULE"] = df["MZ"].astype(str)
+    if "RT" not in df.columns:
+        df["RT"] = np.nan
+    if "RTVIEWHALFWINDOW" not in df.columns:
+        df["RTVIEWHALFWINDOW"] = rtHalfWindow
+    return df[["MOLECULE", "MZ", "RT", "RTVIEWHALFWINDOW"]]
+
+
+def ExtractTargetsXIC(mzaFile, mzs, mztolhalfwidth=0.01, blockSize=1000):
+    # Returns [rts, xics] of the MS1 spectra (total frame spectra for ion mobility data) sorted by retention time:
+    #   xics (targets x scans, float32) are the summed intensities within mz +- mztolhalfwidth of each target
+    mzs = np.asarray(mzs, dtype=float)
+    lowMzs = mzs - mztolhalfwidth
+    highMzs = mzs + mztolhalfwidth
+    blockSize = int(max(1, min(blockSize, MAX_BLOCK_WINDOWS // max(mzs.size, 1))))
+    with OpenMza(mzaFile) as mza:
+        rows = mza.GetRows(msLevel=1)
+        rts = mza.metadata["RetentionTime"][rows].astype(float)
+        xics = np.zeros((mzs.size, rows.size), dtype=np.float32)
+        for start in range(0, rows.size, blockSize):
+            block = rows[start:start + blockSize]
+            spectra = mza.ReadSpectra(block) # each scan is read once, no need to cache it
+            sizes = np.array([x[0].size for x in spectra], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(sizes)])
+            # spectra of the block one after the other: m/z shifted by span x position, spectra are sorted by m/z
+            span = max(float(max((x[0][-1] for x in spectra if x[0].size > 0), default=0)), highMzs.max(initial=0)) + 1
+            positions = np.repeat(np.arange(block.size), sizes)
+            keys = np.concatenate([x[0] for x in spectra]).astype(float) + positions * span
+            cumulative = np.concatenate([[0], np.cumsum(np.concatenate([x[1] for x in spectra]).astype(np.float64))])
+            shifts = (np.arange(block.size) * span)[:, None]
+            lows = np.searchsorted(keys, lowMzs[None, :] + shifts, side="left")
+            highs = np.searchsorted(keys, highMzs[None, :] + shifts, side="right")
+            # windows are limited to the spectrum of their position by the span (m/z >= 0)
+            lows = np.clip(lows, offsets[:-1, None], offsets[1:, None])
+            highs = np.clip(highs, offsets[:-1, None], offsets[1:, None])
+            xics[:, start:start + block.size] = (cumulative[highs] - cumulative[lows]).T
+    return [rts, xics]
+
+
+def IntegrateTargets(rts, xics, targetRts, rtHalfWindows):
+    # Abundance of each target: sum of its XIC within RT +- rtHalfWindow (whole run if RT is NaN), scaled by 1/1000
+    targetRts = np.asarray(targetRts, dtype=float)
+    rtHalfWindows = np.asarray(rtHalfWindows, dtype=float)
+    starts = np.where(np.isnan(targetRts), 0, np.searchsorted(rts, targetRts - rtHalfWindows, side="left"))
+    ends = np.where(np.isnan(targetRts), rts.size, np.searchsorted(rts, targetRts + rtHalfWindows, side="right"))
+    abundances = np.zeros(xics.shape[0])
+    for start in range(0, xics.shape[0], 1000): # cumulative sums by chunks of targets to bound memory
+        end = min(start + 1000, xics.shape[0])
+        cumulative = np.concatenate([np.zeros((end - start, 1)), np.cumsum(xics[start:end], axis=1, dtype=np.float64)], axis=1)
+        targets = np.arange(end - start)
+        abundances[start:end] = (cumulative[targets, ends[start:end]] - cumulative[targets, starts[start:end]]) / 1000
+    return abundances
+
+
+def QuantifyRun(mzaFile, targets, mztolhalfwidth=0.01, blockSize=1000):
+    # Abundances of the targets (data frame from ReadQuantTargets) in an mza file
+    [rts, xics] = ExtractTargetsXIC(mzaFile, targets["MZ"].to_numpy(), mztolhalfwidth, blockSize)
+    return IntegrateTargets(rts, xics, targets["RT"].to_numpy(), targets["RTVIEWHALFWINDOW"].to_numpy())
+
+
+def QuantifyRuns(mzaFiles, targetsFile, outputFile, mztolhalfwidth=0.01, precursorMzDecimals=5, rtHalfWindow=0.5, nProcesses=1, blockSize=1000):
+    # Abundances of the targets in several MS runs (one process per MS run), saved as a targets x runs matrix in
+    #   <outputFile>.h5 (datasets ABUNDANCE, MOLECULE, MZ, RT and MSRUN) and <outputFile>.csv (one column per MS run)
+    targets = ReadQuantTargets(targetsFile, precursorMzDecimals, rtHalfWindow)
+    runs = [os.path.basename(x).replace(".mza", "") for x in mzaFiles]
+    if nProcesses > 1 and len(mzaFiles) > 1:
+        with Pool(min(nProcesses, len(mzaFiles))) as pool:
+            results = [pool.apply_async(QuantifyRun, args=(x, targets, mztolhalfwidth, blockSize)) for x in mzaFiles]
+            abundances = [x.get() for x in results]
+    else:
+        abundances = [QuantifyRun(x, targets, mztolhalfwidth, blockSize) for x in mzaFiles]
+    abundances = np.stack(abundances, axis=1) if len(abundances) > 0 else np.zeros((len(targets), 0))
+    with h5py.File(outputFile + ".h5", "w") as f:
+        f.create_dataset("ABUNDANCE", data=abundances, compression="gzip")
+        f.create_dataset("MOLECULE", data=targets["MOLECULE"].astype(str).to_numpy(dtype=object), dtype=h5py.string_dtype())
+        f.create_dataset("MZ", data=targets["MZ"].to_numpy(dtype=float))
+        f.create_dataset("RT", data=targets["RT"].to_numpy(dtype=float))
+        f.create_dataset("MSRUN", data=np.array(runs, dtype=object), dtype=h5py.string_dtype())
+    df = pd.concat([targets[["MOLECULE", "MZ", "RT"]], pd.DataFrame(abundances, columns=runs)], axis=1)
+    df.to_csv(outputFile + ".csv", index=False)
+    return df
@@ -7,21 +7,33 @@ from qc.utils import FormatDataframeSamples
 from qc.image_time_vs_mz import GenerateImageTimeVsMz
 from qc.pca import PerformPCA
 from qc.auto_ion_tracking import DetectTopmostIons
-from qc.ion_batch import GenerateImageIonBatch
-from qc.ms2 import GenerateMS2plot
-from qc.xis import GenerateXISurfacePlot
+from qc.ion_batch import GenerateImageIonBatch, ExtractIonTracesBatch, RenderImageIonBatch
+from qc.ms2 import GenerateMS2plotBatch, RenderMS2plot
+from qc.xis import GenerateXISurfacePlotBatch, RenderXISurfacePlot
+from qc.render_queue import RenderQueue
 from qc.spectra_metrics import ExtractSpectraMetadataMetrics
+from qc.mza_reader import BuildMzIndex, CompactMza
+from qc.stage_cache import StageCache, CellKey, FileIdentity
+from qc.conversion_scheduler import ConversionJob, MzmlConversionJob, ConversionThreads, RunConversions
 from qc.detailed_anomaly_detection import detect_outliers, plot_heatmap, detect_outsidetolerances
 import string
-import subprocess
 import traceback 
 import warnings
 import glob
 import time
 import tomllib
 
-def mza_conversion(myArgs, execPath):
-    subprocess.run(execPath + myArgs, shell=True)
+def mza_indexing(mzaFile):
+    try:
+        BuildMzIndex(mzaFile)
+    except OSError as e: # e.g., read-only folder, the mza file is then read without index
+        print("Warning: m/z index not created for " + mzaFile + ": " + str(e))
+
+def mza_compaction(mzaFile):
+    try:
+        CompactMza(mzaFile)
+    except OSError as e: # e.g., read-only file, the mza file is then read with one dataset per spectrum
+        print("Warning: compact layout not written for " + mzaFile + ": " + str(e))
 
 def qc_pipeline(dfruns, outputPath, configFile=""):
     if configFile == "":
@@ -48,6 +60,9 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
     if not os.path.exists(resultsPath):
         os.makedirs(resultsPath)
 
+    # Manifest of the computed (MS run, stage) and (ion, stage) cells, only stale cells are recomputed
+    cache = StageCache(resultsPath)
+
     # Use parallel processing
     nProcesses = math.floor(multiprocessing.cpu_count() * 0.6) # Use n = 70% of computer cores
     if nProcesses < 1:
@@ -59,40 +74,71 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
 
     minIntensityMza = config["MinIntensityMza"]
     dfruns["MZAPATH"] = ""
-    myFiles = []
-    useMultithreading = True
+    myJobs = []
+    myCells = []
+    # cores of the conversions and threads of an Agilent .d conversion (threads used inside mza.exe), 0 for nProcesses
+    conversionCores = config.get("ConversionCores", 0) or nProcesses
+    agilentThreads = config.get("ConversionAgilentThreads", 0) or conversionCores
+    # mzML files converted in Python (required without mza.exe, e.g., on Linux)
+    pythonMzml = config.get("PythonMzmlConverter", False) or os.name != "nt"
     for i, row in dfruns.iterrows():
         if row["MSRUNFORMAT"] != ".mza":
-            if not os.path.exists(os.path.join(mzaPath, row["MSRUN"] + ".mza")):
-                # mza file does not exist in project path, convert raw MS file to mza
-                xpath = os.path.join(row["MSRUNPATH"], row["MSRUN"] + row["MSRUNFORMAT"])
-                myFiles.append(' -file "' + xpath + '" -out "' + mzaPath + '" -intensityThreshold ' + str(minIntensityMza))
-                if row["MSRUNFORMAT"] == ".d" and os.path.exists(os.path.join(xpath, "AcqData")): # don't use multithreading here for Agilent .d because it will be used per file by mza.exe
-                    useMultithreading = False
+            xpath = os.path.join(row["MSRUNPATH"], row["MSRUN"] + row["MSRUNFORMAT"])
+            mzaFile = os.path.join(mzaPath, row["MSRUN"] + ".mza")
+            key = CellKey(FileIdentity(xpath), minIntensityMza)
+            if os.path.exists(mzaFile) and cache.Get("conversion", mzaFile) is None:
+                # mza file converted before the manifest existed, keep it (conversion is the slowest stage)
+                cache.Update("conversion", mzaFile, key, [mzaFile])
+            if not cache.IsValid("conversion", mzaFile, key):
+                # mza file does not exist in project path or raw file/settings changed, convert raw MS file to mza
+                if os.path.exists(mzaFile):
+                    os.remove(mzaFile)
+                myCells.append((mzaFile, key))
+                if pythonMzml and row["MSRUNFORMAT"].lower() == ".mzml":
+                    myJobs.append(MzmlConversionJob(row["MSRUN"], xpath, mzaFile, minIntensityMza))
+                else:
+                    myJobs.append(ConversionJob(row["MSRUN"],
+                                                ' -file "' + xpath + '" -out "' + mzaPath + '" -intensityThreshold ' + str(minIntensityMza),
+                                                mzaFile,
+                                                ConversionThreads(xpath, agilentThreads)))
             dfruns.loc[i,"MZAPATH"] = os.path.join(mzaPath, row["MSRUN"])        
         else:
             # mza file exists in initial path provided
             dfruns.loc[i,"MZAPATH"] = os.path.join(row["MSRUNPATH"], row["MSRUN"])
 
-    if len(myFiles) > 0 and not os.path.exists(mzaPath):
+    if len(myJobs) > 0 and not os.path.exists(mzaPath):
         os.makedirs(mzaPath)
     execPath = '"' + os.path.join(os.getcwd(), 'mza', '"mza.exe')
-    if useMultithreading and len(myFiles) > 0:
-        nProcesses = min(nProcesses, len(myFiles))
-        # create and configure the process pool
-        with Pool(nProcesses) as pool:
-            # issue tasks to the process pool
-            for i in range(0,len(myFiles)):
-                pool.apply_async(mza_conversion, args=(myFiles[i], execPath))
-            pool.close() # close the process pool
-            pool.join() # wait for all tasks to complete
-    else:
-        # Without parallel processing:
-        for i in range(0,len(myFiles)):
-           mza_conversion(myFiles[i], execPath)
+    if len(myJobs) > 0:
+        # mza.exe and Python mzML jobs packed within the cores budget, logs of mza.exe and conversion times in ResultsQC
+        conversions = RunConversions(myJobs, execPath, conversionCores, os.path.join(resultsPath, "logs-conversion"))
+        conversions.to_csv(os.path.join(resultsPath, "Conversion-times.csv"), index=False)
+        for _, x in conversions[conversions["RETURNCODE"] != 0].iterrows():
+            # Python conversions have no log, their error is printed by ConvertMzmlFile
+            print("Warning: conversion of " + x["MSRUN"] + " failed" + (", see " + os.path.join(resultsPath, "logs-conversion", x["MSRUN"] + ".log") if x["LOG"] != "" else ""))
+    for [mzaFile, key] in myCells:
+        if os.path.exists(mzaFile):
+            cache.Update("conversion", mzaFile, key, [mzaFile])
+    cache.Save()
+
+    # compact layout of the converted mza files (all spectra of an MS level in a few large arrays), before indexing as it changes the mza file
+    if config.get("CompactMza", False):
+        print("Compacting mza files...")
+        myFiles = [x + ".mza" for x in dfruns["MZAPATH"] if os.path.dirname(x) == mzaPath and os.path.exists(x + ".mza")]
+        if len(myFiles) > 0:
+            with Pool(max(1, min(nProcesses, len(myFiles)))) as pool:
+                pool.map(mza_compaction, myFiles)
+
+    # m/z index of each mza file for the extracted ion queries, rebuilt if the mza file changed
+    if config.get("MzIndex", False):
+        print("Indexing mza files...")
+        myFiles = [x + ".mza" for x in dfruns["MZAPATH"] if os.path.exists(x + ".mza")]
+        if len(myFiles) > 0:
+            with Pool(max(1, min(nProcesses, len(myFiles)))) as pool:
+                pool.map(mza_indexing, myFiles)
 
     # ---------------------------------------------------------------
-    # 2) Image time-vs-mz: Generate an image for each MS run (only most intense peaks)
+    # 2) Image time-vs-mz: Generate a binned time-vs-m/z matrix (.npz) for each MS run, and optionally its image (only most intense peaks)
     print("Generating time-vs-m/z images...")
 
     # check and create folder if it does not exist
@@ -102,10 +148,14 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
     # create a list to generate images only if not found
     myFiles = []
     myOutputs = []
+    imageKeys = {}
+    saveImages = config.get("TimeVsMzImageJpg", True)
     for row in dfruns.itertuples():
         msfile = os.path.join(resultsPath, "images-time-vs-mz", 
                                 str(row.LABELSAMPLEGROUP) + "_" + str(row.MSRUNID) + "_" + row.MSRUN)
-        if not os.path.exists(msfile + ".jpg"):
+        imageKeys[msfile] = CellKey(FileIdentity(row.MZAPATH + '.mza'), config["TimeVsMzImageMinIntensityPercentage"], config["TimeVsMzImageMaxIntensityCeilingPercentage"],
+                                    saveImages, "npz")
+        if not cache.IsValid("images-time-vs-mz", msfile, imageKeys[msfile]):
             myFiles.append(row.MZAPATH + '.mza')
             myOutputs.append(msfile)
                 
@@ -115,46 +165,72 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
         with Pool(nProcesses) as pool:
             # issue tasks to the process pool
             for i in range(0,len(myFiles)):
-                pool.apply_async(GenerateImageTimeVsMz, args=(myFiles[i], myOutputs[i], config["TimeVsMzImageMinIntensityPercentage"], config["TimeVsMzImageMaxIntensityCeilingPercentage"]))
+                pool.apply_async(GenerateImageTimeVsMz, args=(myFiles[i], myOutputs[i], config["TimeVsMzImageMinIntensityPercentage"], config["TimeVsMzImageMaxIntensityCeilingPercentage"], saveImages))
             pool.close() # close the process pool
             pool.join() # wait for all tasks to complete
+        for msfile in myOutputs:
+            outputs = [msfile + ".npz"] + ([msfile + ".jpg"] if saveImages else [])
+            if all(os.path.exists(x) for x in outputs):
+                cache.Update("images-time-vs-mz", msfile, imageKeys[msfile], outputs)
+        cache.Save()
 
     # ---------------------------------------------------------------
-    # 3) PCA and common ions: Perform PCA based on the LC-MS images and detect common ions
+    # 3) PCA and common ions: Perform PCA based on the binned LC-MS matrices and detect common ions
     print("Performing PCA analysis...")
 
-    if not os.path.exists(os.path.join(resultsPath, "PCA.csv")) or not os.path.exists(os.path.join(resultsPath, "AutoTracked-Ions.csv")):
-        myFiles = []
-        myMzaPaths = []
-        myRuns = []
-        myGroups = []
-        myRunIds = []
-        for row in dfruns.itertuples():
-            outputfile = os.path.join(resultsPath, "images-time-vs-mz", 
-                                      str(row.LABELSAMPLEGROUP) + "_" + str(row.MSRUNID) + "_" + row.MSRUN + ".jpg")
-            if os.path.exists(outputfile):
-                myFiles.append(outputfile)
-                myRuns.append(row.MSRUN)
-                myGroups.append(row.LABELSAMPLEGROUP)
-                myRunIds.append(row.MSRUNID)
-                myMzaPaths.append(row.MZAPATH)
-        if(len(myFiles) == 0):
-            print("Error: No time-vs-mz images found!")
-            return
-
-        dfIons = PerformPCA(myFiles, myRuns, myGroups, myRunIds, outputFolder = resultsPath, mzaFiles = myMzaPaths, display = True, minIntensityPresencePercentage=config["MinIntensityPresencePercentage"])
+    myFiles = []
+    myMzaPaths = []
+    myRuns = []
+    myGroups = []
+    myRunIds = []
+    for row in dfruns.itertuples():
+        outputfile = os.path.join(resultsPath, "images-time-vs-mz", 
+                                  str(row.LABELSAMPLEGROUP) + "_" + str(row.MSRUNID) + "_" + row.MSRUN + ".npz")
+        if os.path.exists(outputfile):
+            myFiles.append(outputfile)
+            myRuns.append(row.MSRUN)
+            myGroups.append(row.LABELSAMPLEGROUP)
+            myRunIds.append(row.MSRUNID)
+            myMzaPaths.append(row.MZAPATH)
+    if(len(myFiles) == 0):
+        print("Error: No time-vs-mz matrices found!")
+        return
+
+    # PCA depends on all MS runs: recomputed if any image, sample group or setting changed
+    pcaOutputs = [os.path.join(resultsPath, "PCA.csv"), os.path.join(resultsPath, "AutoTracked-Ions.csv")]
+    pcaKey = CellKey([imageKeys[x.removesuffix(".npz")] for x in myFiles], myRuns, myGroups, myRunIds, myMzaPaths, 
+                     config["MinIntensityPresencePercentage"], config["AutoTrackedIonsTopN"], config["MinMzDistDetectCentroidMS"],
+                     config.get("PCABatchSize", 0), config.get("PCAProjectNewRuns", False))
+    if not cache.IsValid("pca", "PCA", pcaKey):
+        pcaBasisFile = None
+        if config.get("PCAProjectNewRuns", False):
+            pcaBasisFile = os.path.join(resultsPath, "PCA-basis.npz") # used if saved by a previous run
+        dfIons = PerformPCA(myFiles, myRuns, myGroups, myRunIds, outputFolder = resultsPath, mzaFiles = myMzaPaths, display = True, minIntensityPresencePercentage=config["MinIntensityPresencePercentage"],
+                            batchSize=config.get("PCABatchSize", 0), basisFile=pcaBasisFile,
+                            imageMinIntensityPercentage=config["TimeVsMzImageMinIntensityPercentage"], imageMaxIntensityCeilingPercentage=config["TimeVsMzImageMaxIntensityCeilingPercentage"])
 
         dfautoIons = DetectTopmostIons(dfIons, dfruns, config["AutoTrackedIonsTopN"], config["MinMzDistDetectCentroidMS"])
         pd.DataFrame.to_csv(dfautoIons, os.path.join(resultsPath, "AutoTracked-Ions.csv"), index=False)
+        cache.Update("pca", "PCA", pcaKey, pcaOutputs)
+        cache.Save()
 
     # ---------------------------------------------------------------
     # 4) SpectraMetrics: Generate a data frame with metrics of spectra for each mza file
     print("Extracting metrics spectra summary statistics...")
     spectraMetricsFile = os.path.join(resultsPath, "Metrics_Spectra.csv")
     nProcesses = min(nProcesses, len(dfruns))
-    result = None
-    with Pool(nProcesses) as pool:
-        result = pool.starmap(ExtractSpectraMetadataMetrics, zip(dfruns["MZAPATH"] + '.mza'))
+    extendedSpectraMetrics = config.get("SpectraMetricsExtended", False)
+    runKeys = [CellKey(FileIdentity(x + '.mza')) for x in dfruns["MZAPATH"]]
+    metricsKeys = [CellKey(x, extendedSpectraMetrics) for x in runKeys]
+    result = [cache.Load("spectra-metrics", x, key) for x, key in zip(dfruns["MZAPATH"], metricsKeys)]
+    staleRuns = [k for k in range(len(dfruns)) if result[k] is None]
+    if len(staleRuns) > 0:
+        with Pool(min(nProcesses, len(staleRuns))) as pool:
+            staleResult = pool.starmap(ExtractSpectraMetadataMetrics, [(dfruns["MZAPATH"][k] + '.mza', extendedSpectraMetrics) for k in staleRuns])
+        for k, dfx in zip(staleRuns, staleResult):
+            result[k] = dfx
+            cache.Store("spectra-metrics", dfruns["MZAPATH"][k], metricsKeys[k], dfx)
+        cache.Save()
 
     result = pd.concat(result, ignore_index=True)
     result = pd.concat([dfruns[["MSRUN", "LABELSAMPLEGROUP", "MSRUNID"]],result], axis=1)
@@ -168,16 +244,14 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
     outputFolders = []
     userIonsMS2OutputFolder = "user-ions-ms2"
     userIonsXISOutputFolder = "user-ions-xis"
-    if not os.path.exists(os.path.join(resultsPath, "Metrics_AutoTracked-Ions.csv")):
-        ionsFiles.append(os.path.join(resultsPath, "AutoTracked-Ions.csv"))
-        ionsMetricsFiles.append(os.path.join(resultsPath, "Metrics_AutoTracked-Ions"))
-        messages.append("Generating overlaid ion images for auto tracked ions...")
-        outputFolders.append("overlaid-images-ions")
-    if not os.path.exists(os.path.join(resultsPath, "Metrics_User-Ions.csv")):
-        ionsFiles.append(os.path.join(outputPath, "User-Ions.csv"))
-        ionsMetricsFiles.append(os.path.join(resultsPath, "Metrics_User-Ions"))
-        messages.append("Generating overlaid ion images for user-specified ions (theoretical or reference values)...")
-        outputFolders.append("overlaid-images-user-ions")
+    ionsFiles.append(os.path.join(resultsPath, "AutoTracked-Ions.csv"))
+    ionsMetricsFiles.append(os.path.join(resultsPath, "Metrics_AutoTracked-Ions"))
+    messages.append("Generating overlaid ion images for auto tracked ions...")
+    outputFolders.append("overlaid-images-ions")
+    ionsFiles.append(os.path.join(outputPath, "User-Ions.csv"))
+    ionsMetricsFiles.append(os.path.join(resultsPath, "Metrics_User-Ions"))
+    messages.append("Generating overlaid ion images for user-specified ions (theoretical or reference values)...")
+    outputFolders.append("overlaid-images-user-ions")
     
     dfruns["legend"] = dfruns["LABELSAMPLEGROUP"].astype(str) + "_" + dfruns["MSRUNID"].astype(str)
     for i in range(0, len(ionsFiles)):
@@ -198,12 +272,12 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
             if "User-Ions.csv" in ionsfile and "FRAGSMZ" in dfions.columns:
                 userIonsMS2 = True
                 userIonsMS2OutputFolder = os.path.join(resultsPath, userIonsMS2OutputFolder)
-                os.makedirs(userIonsMS2OutputFolder)
+                os.makedirs(userIonsMS2OutputFolder, exist_ok=True)
             userIonsXIS = False # Generate Extracted Ion Surface images if both RT and AT are provided
             if "User-Ions.csv" in ionsfile and "RT" in dfions.columns and "AT" in dfions.columns:
                 userIonsXIS = True
                 userIonsXISOutputFolder = os.path.join(resultsPath, userIonsXISOutputFolder)
-                os.makedirs(userIonsXISOutputFolder)
+                os.makedirs(userIonsXISOutputFolder, exist_ok=True)
         
             # check columns ions file:
             if "MZVIEWHALFWINDOW" not in dfions.columns:
@@ -221,7 +295,43 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
             if "AT" not in dfions.columns: # AT = arrival time
                 dfions["AT"] = 0
 
-            dferrors = pd.DataFrame()
+            # Cache keys: ion targets (all values of the row in the ions file), MS runs and settings
+            ionKeys = [CellKey(dfions.iloc[k].to_dict(), config["MinMzDistDetectCentroidMS"]) for k in range(0, dfions.shape[0])]
+            runsKey = CellKey(runKeys, list(dfruns["MZAPATH"]), list(dfruns["legend"]))
+            tracesStage = "traces-" + outputFolders[i]
+
+            ionTraces = None
+            if config.get("BatchIonExtraction", True):
+                # Extract the traces of all ions reading each MS run once, only ions not cached for the MS run
+                ionTraces = []
+                staleJobs = []
+                for j in range(len(dfruns)):
+                    runTraces = cache.Load(tracesStage, dfruns["MZAPATH"][j], runKeys[j])
+                    runTraces = {} if runTraces is None else runTraces
+                    staleIons = [k for k in range(0, dfions.shape[0]) if ionKeys[k] not in runTraces]
+                    if len(staleIons) > 0:
+                        staleJobs.append((j, staleIons))
+                    ionTraces.append(runTraces)
+                if len(staleJobs) > 0:
+                    nProcesses = min(nProcesses, len(dfruns))
+                    with Pool(min(nProcesses, len(staleJobs))) as pool:
+                        staleTraces = pool.starmap(ExtractIonTracesBatch, [(dfruns["MZAPATH"][j] + ".mza", dfions.iloc[staleIons]) for j, staleIons in staleJobs])
+                    for [j, staleIons], traces in zip(staleJobs, staleTraces):
+                        ionTraces[j].update({ionKeys[k]: x for k, x in zip(staleIons, traces)})
+                for j in range(len(dfruns)):
+                    ionTraces[j] = {x: ionTraces[j][x] for x in ionKeys} # keep only the current ions in the cache
+                    if j in [x[0] for x in staleJobs]:
+                        cache.Store(tracesStage, dfruns["MZAPATH"][j], runKeys[j], ionTraces[j])
+                ionTraces = [[x[key] for key in ionKeys] for x in ionTraces]
+                cache.Save()
+
+            results = [None] * dfions.shape[0] # metrics of each ion, from the cache or computed
+            ionCells = [] # (ion index, key, outputs) of each job in ionJobs
+            ionJobs = [] # arguments of GenerateImageIonBatch for each ion
+            ms2Cells = [] # (cell, key, outputs) of each job in ms2Jobs
+            ms2Jobs = [] # mza file and arguments of GenerateMS2plot for each ion and MS run
+            xisCells = [] # (cell, key, outputs) of each job in xisJobs
+            xisJobs = [] # mza file and arguments of GenerateXISurfacePlot for each ion and MS run
             for k in range(0, dfions.shape[0]):
                 ionmz = dfions["MZ"][k]
                 ionrt = dfions["RT"][k]
@@ -240,20 +350,27 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
                 if ionat > 0:
                     suffixImage = suffixImage + "-AT" + str(round(ionat, ndigits=1))
 
-                print("     analyzing: " + suffixImage)
-                dfx = GenerateImageIonBatch(dfruns,
-                                outputFolder=outputfolder,
-                                mz=ionmz, 
-                                rt=ionrt,
-                                molecule=molecule,
-                                suffixImage=suffixImage,
-                                mzHalfWindowXIC=mzHalfWindowXIC,
-                                rtrange=rtViewHalfWindow,
-                                mzrange=mzViewHalfWindow, 
-                                at=ionat,
-                                atrange=atViewHalfWindow)
-                if len(dfx) > 0:
-                    dferrors = pd.concat([dferrors, dfx], ignore_index=True)
+                # overlaid images of one ion depend on all MS runs
+                ionKey = CellKey(ionKeys[k], runsKey)
+                results[k] = cache.Load(outputFolders[i], ionKeys[k], ionKey)
+                if results[k] is not None:
+                    print("     up to date: " + suffixImage)
+                else:
+                    print("     analyzing: " + suffixImage)
+                    ionCells.append((k, ionKey, [os.path.join(outputfolder, suffixImage.replace("MZ", label + "-MZ") + x) 
+                                                 for label in dfruns["LABELSAMPLEGROUP"].unique() for x in [".jpg", ".pdf"]]))
+                    ionJobs.append((dfruns,
+                                    outputfolder,
+                                    ionmz, 
+                                    ionrt,
+                                    molecule,
+                                    suffixImage,
+                                    mzHalfWindowXIC,
+                                    rtViewHalfWindow,
+                                    mzViewHalfWindow, 
+                                    ionat,
+                                    atViewHalfWindow,
+                                    None if ionTraces is None else [x[k] for x in ionTraces]))
 
                 # 6) ImageIonBatch MS/MS: Generate for each mza file 
                 if userIonsMS2:
@@ -265,7 +382,11 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
                     for j in range(len(dfruns)):
                         mzaFile = dfruns["MZAPATH"][j] + ".mza"
                         outputFilename = os.path.join(userIonsMS2OutputFolder, molecule + "-" + dfruns["legend"][j])
-                        GenerateMS2plot(mzaFile, 
+                        key = CellKey(ionKeys[k], runKeys[j], fragsMz, fragsIntensity)
+                        if cache.IsValid("user-ions-ms2", outputFilename, key):
+                            continue
+                        ms2Cells.append((outputFilename, key, [outputFilename + ".jpg", outputFilename + ".pdf"]))
+                        ms2Jobs.append((mzaFile, 
                                         outputFilename, 
                                         molecule + "-" + dfruns["legend"][j], 
                                         ionmz, 
@@ -274,28 +395,94 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
                                         fragsMz, 
                                         fragsIntensity, 
                                         ionat,
-                                        config["MinMzDistDetectCentroidMS"])
+                                        config["MinMzDistDetectCentroidMS"]))
             
                 # 7) Extracted Ion Surface (XIS): Generate XIS for each mza file 
                 if userIonsXIS:
-                    nProcesses = min(nProcesses, len(dfruns))
+                    for j in range(0,len(dfruns)):
+                        mzaFile = dfruns["MZAPATH"][j] + ".mza"
+                        outputFilename = os.path.join(userIonsXISOutputFolder, molecule + "-" + dfruns["legend"][j])
+                        key = CellKey(ionKeys[k], runKeys[j])
+                        if cache.IsValid("user-ions-xis", outputFilename, key):
+                            continue
+                        xisCells.append((outputFilename, key, [outputFilename + ".jpg", outputFilename + ".pdf"]))
+                        xisJobs.append((mzaFile, 
+                                        outputFilename, 
+                                        molecule + "-" + dfruns["legend"][j], 
+                                        ionmz, 
+                                        ionrt, 
+                                        ionat, 
+                                        mzHalfWindowXIC, 
+                                        max(rtViewHalfWindow,1),
+                                        max(atViewHalfWindow,3)))
+
+            # MS/MS and XIS plots are generated per MS run: each mza file is opened once for all its ions
+            ms2RunJobs = {}
+            for x in ms2Jobs:
+                ms2RunJobs.setdefault(x[0], []).append(x[1:])
+            xisRunJobs = {}
+            for x in xisJobs:
+                xisRunJobs.setdefault(x[0], []).append(x[1:])
+            # the extraction pool and the render queue need at least 2 processes, otherwise ions are processed serially
+            if config.get("ParallelIonQC", True) and nProcesses >= 2 and len(ionJobs) + len(ms2Jobs) + len(xisJobs) > 0:
+                # Ions and (ion, MS run) pairs are extracted in parallel, results are collected in the order of the ions.
+                #   Figures are drawn by the processes of the render queue while extraction continues,
+                #   the queue is flushed (all figures saved) before updating the cache.
+                #   The processes are split between extraction and rendering (a third for rendering by default).
+                nRenderProcesses = config.get("RenderProcesses", 0)
+                if nRenderProcesses <= 0:
+                    nRenderProcesses = nProcesses // 3
+                nRenderProcesses = max(1, min(nRenderProcesses, nProcesses - 1))
+                nIonProcesses = max(1, min(nProcesses - nRenderProcesses, max(len(ionJobs), len(ms2RunJobs), len(xisRunJobs))))
+                with RenderQueue(nRenderProcesses) as renderQueue, Pool(nIonProcesses) as pool:
+                    ms2Results = [pool.apply_async(GenerateMS2plotBatch, args=x, kwds={"returnPlots": True}) for x in ms2RunJobs.items()]
+                    xisResults = [pool.apply_async(GenerateXISurfacePlotBatch, args=x, kwds={"returnPlots": True}) for x in xisRunJobs.items()]
+                    ionAsyncResults = [pool.apply_async(GenerateImageIonBatch, args=x, kwds={"returnPlots": True}) for x in ionJobs]
+                    ionResults = []
+                    for x in ionAsyncResults:
+                        [dfx, plotSpecs] = x.get() # raise the errors of the task
+                        ionResults.append(dfx)
+                        renderQueue.SubmitAll(RenderImageIonBatch, plotSpecs)
+                    # a failed MS run skips its MS/MS or XIS plots only, its cells are retried at the next run
+                    for mzaFile, x in zip(ms2RunJobs, ms2Results):
+                        try:
+                            renderQueue.SubmitAll(RenderMS2plot, x.get())
+                        except Exception as e:
+                            print("Warning: MS/MS plots not generated for " + mzaFile + ": " + str(e))
+                    for mzaFile, x in zip(xisRunJobs, xisResults):
+                        try:
+                            renderQueue.SubmitAll(RenderXISurfacePlot, x.get())
+                        except Exception as e:
+                            print("Warning: XIS plots not generated for " + mzaFile + ": " + str(e))
+            else:
+                ionResults = [GenerateImageIonBatch(*x) for x in ionJobs]
+                for x in ms2RunJobs.items():
+                    GenerateMS2plotBatch(*x)
+                if len(xisRunJobs) > 0:
                     # create and configure the process pool
-                    with Pool(nProcesses) as pool:
+                    with Pool(min(nProcesses, len(xisRunJobs))) as pool:
                         # issue tasks to the process pool
-                        for j in range(0,len(dfruns)):
-                            mzaFile = dfruns["MZAPATH"][j] + ".mza"
-                            outputFilename = os.path.join(userIonsXISOutputFolder, molecule + "-" + dfruns["legend"][j])
-                            pool.apply_async(GenerateXISurfacePlot, args=(mzaFile, 
-                                                    outputFilename, 
-                                                    molecule + "-" + dfruns["legend"][j], 
-                                                    ionmz, 
-                                                    ionrt, 
-                                                    ionat, 
-                                                    mzHalfWindowXIC, 
-                                                    max(rtViewHalfWindow,1),
-                                                    max(atViewHalfWindow,3)))
+                        for x in xisRunJobs.items():
+                            pool.apply_async(GenerateXISurfacePlotBatch, args=x)
                         pool.close() # close the process pool
                         pool.join() # wait for all tasks to complete
+
+            for [k, key, outputs], dfx in zip(ionCells, ionResults):
+                results[k] = dfx
+                cache.Store(outputFolders[i], ionKeys[k], key, dfx, [x for x in outputs if os.path.exists(x)])
+            # MS/MS and XIS plots are not generated if no spectrum is found, these (ion, MS run) pairs are retried
+            for [cell, key, outputs] in ms2Cells:
+                if os.path.exists(outputs[0]):
+                    cache.Update("user-ions-ms2", cell, key, outputs)
+            for [cell, key, outputs] in xisCells:
+                if os.path.exists(outputs[0]):
+                    cache.Update("user-ions-xis", cell, key, outputs)
+            cache.Save()
+
+            dferrors = pd.DataFrame()
+            for dfx in results:
+                if len(dfx) > 0:
+                    dferrors = pd.concat([dferrors, dfx], ignore_index=True)
             if len(dferrors) > 0:
                 pd.DataFrame.to_csv(dferrors, ionsMetricsFiles[i] + ".csv", index=False)
             else:
@@ -315,7 +502,9 @@ def qc_pipeline(dfruns, outputPath, configFile=""):
             outliers = detect_outliers(df, 
                                        mzerrorppmAbsThreshold=config["MZERRORPPM"], 
                                        rterrorAbsThreshold=config["RTERROR"], 
-                                       aterrorAbsThreshold=config["ATERROR"])
+                                       aterrorAbsThreshold=config["ATERROR"],
+                                       method=config.get("OutlierDetectionMethod", "isolationforest"),
+                                       nJobs=nProcesses)
             if len(outliers) > 0:
                 plot_heatmap(outliers, f.replace(".csv", "_Outliers"))
                 pd.DataFrame.to_csv(outliers, f.replace(".csv", "_Outliers.csv"), index=False)
@@ -0,0 +1,51 @@
+import collections
+from multiprocessing.pool import Pool
+
+# RenderQueue
+# Pool of rendering processes drawing the QC figures (overlaid ion images, MS/MS and XIS plots) from plot specs:
+#   dictionaries of arrays and labels returned by the extraction code, drawn by the render function of each figure
+#   (e.g., RenderMS2plot) with a non-interactive matplotlib backend. Extraction processes never wait on the PDF backend.
+# Backpressure: Submit blocks while maxPending figures are waiting to be drawn. Flush waits for all figures and raises their errors.
+
+def UseNonInteractiveBackend():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+class RenderQueue:
+    def __init__(self, nProcesses=1, maxPending=0):
+        self.nProcesses = max(1, nProcesses)
+        self.maxPending = maxPending if maxPending > 0 else 4 * self.nProcesses
+        self.pool = Pool(self.nProcesses, initializer=UseNonInteractiveBackend)
+        self.pending = collections.deque()
+
+    def Submit(self, renderFunction, plotSpec):
+        while len(self.pending) >= self.maxPending:
+            self.pending.popleft().get() # wait for the oldest figure
+        self.pending.append(self.pool.apply_async(renderFunction, args=(plotSpec,)))
+
+    def SubmitAll(self, renderFunction, plotSpecs):
+        for x in plotSpecs:
+            self.Submit(renderFunction, x)
+
+    def Flush(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().get()
+
+    def close(self):
+        try:
+            self.Flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
+        return False
@@ -1,30 +1,83 @@
 import h5py
-import hdf5plugin
+import numpy as np
 import pandas as pd
+from qc.mza_reader import MzaReader
 
-def ExtractSpectraMetadataMetrics(mzaFile):
-    with h5py.File(mzaFile, 'r') as mza:
-        metadata = mza["Metadata"]
-        # Convert metadata to a DataFrame
-        metadata = pd.DataFrame(metadata[:]) 
+# Spectra metrics of an mza file, per MS level: number of spectra and mean, median and max TIC.
+# Only the needed fields of the Metadata table are read, in chunks of rows, and the statistics are accumulated in a single
+#   pass: sums and max per MS level, and the TIC values only (not the whole Metadata rows) for exact medians.
+# Extended metrics (same pass): scan rate (spectra per minute), TIC coefficient of variation, RT coverage (minutes between
+#   the first and last spectra) and number of ion mobility bins.
+
+METRICS_FIELDS = ["MSLevel", "TIC", "RetentionTime", "IonMobilityBin"]
+
+
+class LevelStatistics:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sumSquares = 0.0
+        self.max = -np.inf
+        self.tics = []
+        self.minRT = np.inf
+        self.maxRT = -np.inf
+        self.imBins = set()
+
+    def Add(self, tic, rt, imBin):
+        tic = tic[~np.isnan(tic)]
+        self.count += tic.size
+        self.sum += tic.sum()
+        self.sumSquares += np.square(tic).sum()
+        self.max = max(self.max, tic.max(initial=-np.inf))
+        self.tics.append(tic)
+        if rt is not None and rt.size > 0:
+            self.minRT = min(self.minRT, rt.min())
+            self.maxRT = max(self.maxRT, rt.max())
+        if imBin is not None:
+            self.imBins.update(np.unique(imBin[imBin > 0]).tolist())
+
+    def Metrics(self, extended=False):
+        mean = self.sum / self.count if self.count > 0 else np.nan
+        metrics = {"COUNT": self.count,
+                   "MEANTIC": mean,
+                   "MEDIANTIC": np.median(np.concatenate(self.tics)) if self.count > 0 else np.nan,
+                   "MAXTIC": self.max if self.count > 0 else np.nan}
+        if extended:
+            coverage = self.maxRT - self.minRT if self.maxRT >= self.minRT else np.nan
+            variance = max(self.sumSquares / self.count - mean**2, 0) if self.count > 0 else np.nan
+            metrics["SCANRATE"] = self.count / coverage if coverage > 0 else np.nan
+            metrics["TICCV"] = np.sqrt(variance) / mean if self.count > 0 and mean != 0 else np.nan
+            metrics["RTCOVERAGE"] = coverage
+            metrics["IMBINS"] = len(self.imBins)
+        return metrics
+
+
+def ExtractSpectraMetadataMetrics(mzaFile, extended=False, chunkRows=1000000):
+    # mzaFile: path to the mza file or an open MzaReader (its Metadata table is already in memory)
+    # extended: add the SCANRATE, TICCV, RTCOVERAGE and IMBINS metrics of each MS level
+    levels = {}
+    def add(chunk):
+        for msLevel in np.unique(chunk["MSLevel"]):
+            rows = chunk["MSLevel"] == msLevel
+            levels.setdefault(int(msLevel), LevelStatistics()).Add(
+                chunk["TIC"][rows].astype(np.float64),
+                chunk["RetentionTime"][rows] if extended else None,
+                chunk["IonMobilityBin"][rows] if extended else None)
+
+    if isinstance(mzaFile, MzaReader):
+        add(mzaFile.metadata)
+    else:
+        with h5py.File(mzaFile, 'r') as mza:
+            metadata = mza["Metadata"]
+            fields = METRICS_FIELDS if extended else METRICS_FIELDS[:2]
+            for start in range(0, metadata.shape[0], chunkRows):
+                add(metadata.fields(fields)[start:start + chunkRows])
 
     # Calculate metrics spectra summary statistics
-    myColumns = ['COUNT', 'MEANTIC', 'MEDIANTIC', 'MAXTIC']
     df = pd.DataFrame()
-    # Group by 'MSLevel' column and extract 'TIC' column
-    grouped_tic = metadata.groupby('MSLevel')['TIC']
-
-    # Iterate over each group and make calculations
-    for mslevel, tic_group in grouped_tic:
-        count = tic_group.count()
-        mean_tic = tic_group.mean()
-        median_tic = tic_group.median()
-        max_tic = tic_group.max()
-        df['MS' + str(mslevel) + myColumns[0]] = [count]
-        df['MS' + str(mslevel) + myColumns[1]] = [mean_tic]
-        df['MS' + str(mslevel) + myColumns[2]] = [median_tic]
-        df['MS' + str(mslevel) + myColumns[3]] = [max_tic]
-
+    for msLevel in sorted(levels):
+        for name, value in levels[msLevel].Metrics(extended).items():
+            df['MS' + str(msLevel) + name] = [value]
     return df
 
 # testdf = ExtractSpectraMetadataMetrics("E:/QCdecoder/code/test_data/LC-IM-MS-Agilent/DataMza/Agile_Pput_CJ019_WT_IMS_5ul_R1_01_20V_redo_12Sep20_Kristin_MA-d3-c3-Min20.mza")
@@ -0,0 +1,212 @@
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from qc.tandem_scoring import EncodedLibrary
+
+# SpectralLibrary
+# MS/MS library (CSV with columns MOLECULE, MZ, FRAGSMZ, FRAGSINTENSITY as Example-Ion-Targets.csv, or MSP) compiled
+#   on first use into binary arrays stored next to the library file (library.msp -> library.speclib/):
+#   flat fragment m/z and intensity arrays with an offsets index (fragments of entry k are offsets[k]:offsets[k+1]),
+#   precursor m/z array sorted in increasing order, and a metadata table of the entries in the same order.
+# Arrays are keyed by a hash of the library file, precursor_mass_tag and precursor_mz_decimals, and are memory-mapped
+#   when loaded: later runs skip the parsing and worker processes share the pages of the arrays.
+# The hash of the library file is kept in fingerprint.json with the size and modification time of the file, and only
+#   recomputed when they change. Each entry records the hash of its library file (<key>-entry.json), entries of an older
+#   library file are removed when a new entry is saved, entries of other settings are kept.
+
+SPECLIB_VERSION = 2
+SPECLIB_ARRAYS = ["precursormz", "offsets", "fragsmz", "fragsintensity"]
+
+
+def SpectralLibraryPath(libraryFile):
+    return os.path.splitext(libraryFile)[0] + ".speclib"
+
+
+def LibraryFileHash(libraryFile):
+    # SHA-1 of the library file, read from fingerprint.json if the size and modification time of the file did not change
+    stat = os.stat(libraryFile)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    fingerprintFile = os.path.join(SpectralLibraryPath(libraryFile), "fingerprint.json")
+    try:
+        with open(fingerprintFile, "r") as f:
+            saved = json.load(f)
+        if saved["size"] == fingerprint["size"] and saved["mtime"] == fingerprint["mtime"]:
+            return saved["sha1"]
+    except (OSError, ValueError, KeyError):
+        pass
+    sha = hashlib.sha1()
+    with open(libraryFile, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024**2), b""):
+            sha.update(chunk)
+    fingerprint["sha1"] = sha.hexdigest()
+    try:
+        os.makedirs(SpectralLibraryPath(libraryFile), exist_ok=True)
+        tmpFile = fingerprintFile + "." + str(os.getpid()) + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(fingerprint, f)
+        os.replace(tmpFile, fingerprintFile)
+    except OSError: # e.g., read-only folder, the hash is computed at each load
+        pass
+    return fingerprint["sha1"]
+
+
+def SpectralLibraryKey(fileHash, precursorMassTag=0, precursorMzDecimals=5):
+    sha = hashlib.sha1(fileHash.encode("utf-8"))
+    sha.update(f"{SPECLIB_VERSION};{float(precursorMassTag)!r};{int(precursorMzDecimals)}".encode("utf-8"))
+    return sha.hexdigest()[:20]
+
+
+def RemoveStaleEntries(cachePath, fileHash):
+    # Removes the complete entries of the cache folder compiled from another version of the library file.
+    #   Temporary files (entries being written by other processes) are not removed.
+    for entryFile in glob.glob(os.path.join(cachePath, "*-entry.json")):
+        try:
+            with open(entryFile, "r") as f:
+                if json.load(f)["library"] == fileHash:
+                    continue
+        except (OSError, ValueError, KeyError):
+            continue
+        prefix = entryFile[:-len("entry.json")]
+        for x in [prefix + "metadata.pkl"] + [prefix + x + ".npy" for x in SPECLIB_ARRAYS] + [entryFile]:
+            try:
+                os.remove(x)
+            except OSError: # e.g., arrays memory-mapped by another process, removed at a later save
+                pass
+
+
+def ReadCsvLibrary(libraryFile):
+    # Returns [metadata, precursorMzs, fragsMz, fragsIntensity] of a CSV library (intensities of 1 if no FRAGSINTENSITY)
+    df = pd.read_csv(libraryFile)
+    df.columns = df.columns.str.upper()
+    df = df[df["FRAGSMZ"].notna()].reset_index(drop=True)
+    fragsMz = [np.array(str(x).split(';'), dtype=float) for x in df["FRAGSMZ"]]
+    if "FRAGSINTENSITY" in df.columns:
+        fragsIntensity = [np.array(str(x).split(';'), dtype=float) for x in df["FRAGSINTENSITY"]]
+    else:
+        fragsIntensity = [np.ones(x.size) for x in fragsMz]
+    metadata = df.drop(columns=[x for x in ["FRAGSMZ", "FRAGSINTENSITY"] if x in df.columns])
+    return [metadata, df["MZ"].to_numpy(dtype=float), fragsMz, fragsIntensity]
+
+
+def ReadMspLibrary(libraryFile):
+    # Returns [metadata, precursorMzs, fragsMz, fragsIntensity] of an MSP library.
+    # Metadata columns are the upper case field names (Name -> MOLECULE, PrecursorMZ -> MZ), peaks are "mz intensity" lines
+    #   (or pairs separated by ';' on one line) after the Num Peaks field.
+    entries = []
+    fragsMz = []
+    fragsIntensity = []
+    fields = {}
+    peaks = []
+    inPeaks = False
+
+    def addEntry():
+        if "MZ" in fields:
+            entries.append(fields)
+            values = np.array(peaks, dtype=float).reshape(-1, 2)
+            fragsMz.append(values[:, 0])
+            fragsIntensity.append(values[:, 1])
+
+    with open(libraryFile, "r", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                addEntry()
+                fields, peaks, inPeaks = {}, [], False
+            elif inPeaks and (line[0].isdigit() or line[0] == '.'):
+                for pair in line.split(';'):
+                    values = pair.replace(',', ' ').split()
+                    if len(values) >= 2:
+                        peaks.append(values[:2])
+            elif ':' in line:
+                name, value = line.split(':', 1)
+                name = name.strip().upper()
+                value = value.strip()
+                if name == "NAME":
+                    name = "MOLECULE"
+                elif name in ["PRECURSORMZ", "PRECURSOR_MZ", "PEPMASS"]:
+                    name = "MZ"
+                    value = float(value.split()[0])
+                elif name == "NUM PEAKS":
+                    inPeaks = True
+                    continue
+                fields[name] = value
+    addEntry()
+    return [pd.DataFrame(entries), np.array([x["MZ"] for x in entries], dtype=float), fragsMz, fragsIntensity]
+
+
+class SpectralLibrary:
+    def __init__(self, metadata, precursorMzs, offsets, fragsMz, fragsIntensity):
+        self.metadata = metadata
+        self.precursorMzs = precursorMzs
+        self.offsets = offsets
+        self.fragsMz = fragsMz
+        self.fragsIntensity = fragsIntensity
+
+    def __len__(self):
+        return self.precursorMzs.size
+
+    def Fragments(self, k):
+        # [mz_array, intensity_array] of entry k (views of the flat arrays)
+        return [self.fragsMz[self.offsets[k]:self.offsets[k + 1]], self.fragsIntensity[self.offsets[k]:self.offsets[k + 1]]]
+
+    def Encode(self, mztolhalfwidth=0.01):
+        # EncodedLibrary for ScoreSpectraBatch; LIBRARYINDEX of the scores are rows of metadata
+        starts = self.offsets[:-1]
+        ends = self.offsets[1:]
+        return EncodedLibrary(self.precursorMzs, [self.fragsMz[i:j] for i, j in zip(starts, ends)],
+                              [self.fragsIntensity[i:j] for i, j in zip(starts, ends)], mztolhalfwidth)
+
+    @staticmethod
+    def Compile(libraryFile, precursorMassTag=0, precursorMzDecimals=5):
+        # Parses the library file, adds the precursor mass tag and rounds the precursor m/z, and sorts entries by precursor m/z
+        if os.path.splitext(libraryFile)[1].lower() == ".msp":
+            [metadata, precursorMzs, fragsMz, fragsIntensity] = ReadMspLibrary(libraryFile)
+        else:
+            [metadata, precursorMzs, fragsMz, fragsIntensity] = ReadCsvLibrary(libraryFile)
+        precursorMzs = np.round(precursorMzs + precursorMassTag, precursorMzDecimals)
+        order = np.argsort(precursorMzs, kind="stable")
+        sizes = np.array([len(fragsMz[k]) for k in order], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        metadata = metadata.iloc[order].reset_index(drop=True)
+        metadata["MZ"] = precursorMzs[order]
+        return SpectralLibrary(metadata,
+                               precursorMzs[order],
+                               offsets,
+                               np.concatenate([np.asarray(fragsMz[k], dtype=float) for k in order] + [np.array([])]),
+                               np.concatenate([np.asarray(fragsIntensity[k], dtype=float) for k in order] + [np.array([])]))
+
+    @staticmethod
+    def Load(libraryFile, precursorMassTag=0, precursorMzDecimals=5):
+        # Returns the library from its compiled arrays if up to date (memory-mapped), otherwise compiles it
+        #   and saves the arrays next to the library file when possible
+        cachePath = SpectralLibraryPath(libraryFile)
+        fileHash = LibraryFileHash(libraryFile)
+        key = SpectralLibraryKey(fileHash, precursorMassTag, precursorMzDecimals)
+        prefix = os.path.join(cachePath, key + "-")
+        try:
+            metadata = pd.read_pickle(prefix + "metadata.pkl")
+            arrays = [np.load(prefix + x + ".npy", mmap_mode='r') for x in SPECLIB_ARRAYS]
+            return SpectralLibrary(metadata, *arrays)
+        except (OSError, ValueError, EOFError):
+            pass
+        library = SpectralLibrary.Compile(libraryFile, precursorMassTag, precursorMzDecimals)
+        try:
+            os.makedirs(cachePath, exist_ok=True)
+            # write to temporary files of this process first, the metadata file is written last and marks complete arrays
+            tmpSuffix = "." + str(os.getpid()) + ".tmp"
+            for name, values in zip(SPECLIB_ARRAYS, [library.precursorMzs, library.offsets, library.fragsMz, library.fragsIntensity]):
+                with open(prefix + name + tmpSuffix, "wb") as f:
+                    np.save(f, values)
+                os.replace(prefix + name + tmpSuffix, prefix + name + ".npy")
+            with open(prefix + "entry" + tmpSuffix, "w") as f:
+                json.dump({"library": fileHash, "precursorMassTag": float(precursorMassTag), "precursorMzDecimals": int(precursorMzDecimals)}, f)
+            os.replace(prefix + "entry" + tmpSuffix, prefix + "entry.json")
+            library.metadata.to_pickle(prefix + "metadata" + tmpSuffix, compression=None)
+            os.replace(prefix + "metadata" + tmpSuffix, prefix + "metadata.pkl")
+            RemoveStaleEntries(cachePath, fileHash)
+        except OSError: # e.g., read-only folder or arrays in use by another process, the library is kept in memory only
+            pass
+        return library
@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import pickle
+
+# StageCache
+# Manifest of the cells (MS run, ion, (ion, MS run)) computed by each stage of the QC pipeline, saved in ResultsQC/manifest.json.
+# Each cell records a key, a hash of its inputs (mza file identity, config values, ion target values), and its output files.
+# A cell is up to date if its key is unchanged and its output files still exist, so a rerun recomputes only the stale cells.
+# Values of cells that are merged into the stage results (e.g., spectra metrics of one MS run) are saved in ResultsQC/cache.
+
+class StageCache:
+    def __init__(self, resultsPath):
+        self.manifestFile = os.path.join(resultsPath, "manifest.json")
+        self.cachePath = os.path.join(resultsPath, "cache")
+        self.manifest = {}
+        if os.path.exists(self.manifestFile):
+            try:
+                with open(self.manifestFile, "r") as f:
+                    self.manifest = json.load(f)
+            except ValueError: # corrupted manifest, all stages are recomputed
+                self.manifest = {}
+
+    def Get(self, stage, cell):
+        return self.manifest.get(stage, {}).get(cell)
+
+    def IsValid(self, stage, cell, key):
+        entry = self.Get(stage, cell)
+        return entry is not None and entry["key"] == key and all(os.path.exists(x) for x in entry["outputs"])
+
+    def Update(self, stage, cell, key, outputs=[]):
+        self.manifest.setdefault(stage, {})[cell] = {"key": key, "outputs": list(outputs)}
+
+    def Remove(self, stage, cell):
+        self.manifest.get(stage, {}).pop(cell, None)
+
+    def ValueFile(self, stage, cell):
+        return os.path.join(self.cachePath, stage, hashlib.sha1(cell.encode("utf-8")).hexdigest() + ".pkl")
+
+    def Load(self, stage, cell, key):
+        # Returns the cached value of the cell, or None if the cell is stale
+        valueFile = self.ValueFile(stage, cell)
+        if not self.IsValid(stage, cell, key) or not os.path.exists(valueFile):
+            return None
+        try:
+            with open(valueFile, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def Store(self, stage, cell, key, value, outputs=[]):
+        valueFile = self.ValueFile(stage, cell)
+        os.makedirs(os.path.dirname(valueFile), exist_ok=True)
+        with open(valueFile, "wb") as f:
+            pickle.dump(value, f)
+        self.Update(stage, cell, key, outputs)
+
+    def Save(self):
+        # write to a temporary file first to keep the previous manifest if interrupted
+        with open(self.manifestFile + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.manifestFile + ".tmp", self.manifestFile)
+
+
+def CellKey(*values):
+    # Hash of the input values of a cell (numbers, strings, lists, dicts)
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def FileIdentity(path):
+    # Identity of an input file or folder (e.g., Agilent .d), changes if the file is replaced or modified
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.normpath(path), stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Batch scoring of experimental MS/MS spectra against a spectral library (TandemMatch).
+# Library spectra are encoded once in a sparse matrix (library entries x fragment m/z bins of width mz_tolerance_halfwidth),
+#   sorted by precursor m/z, and their raw fragments are kept in flat arrays. Candidates of each experimental spectrum are the
+#   library entries with a precursor m/z within +- mz_tolerance_halfwidth (binary search in the sorted precursor array).
+# Candidate pairs are filtered with sparse row products: each experimental peak covers the bins of mz +- mz_tolerance_halfwidth
+#   (max intensity per bin), so a library fragment within the tolerance of an experimental peak is always in a covered bin and the
+#   products are upper bounds of the cosine score and of the number of matched fragments.
+# Scores of the remaining pairs are computed with the raw fragments: each library fragment is matched to the most intense
+#   experimental peak within +- mz_tolerance_halfwidth, score = dot product / (library norm x experimental norm), at most 1.
+
+class EncodedLibrary:
+    def __init__(self, precursorMzs, fragsMz, fragsIntensity, mztolhalfwidth=0.01):
+        # precursorMzs: precursor m/z of each library entry
+        # fragsMz, fragsIntensity: fragment m/z and intensities of each library entry (lists of arrays)
+        self.mztolhalfwidth = mztolhalfwidth
+        precursorMzs = np.asarray(precursorMzs, dtype=float)
+        # entries sorted by precursor m/z, order keeps the index of each entry in the input
+        self.order = np.argsort(precursorMzs, kind="stable")
+        self.precursorMzs = precursorMzs[self.order]
+        sizes = np.array([len(fragsMz[k]) for k in self.order], dtype=np.int64)
+        # raw fragments of entry k are offsets[k]:offsets[k+1]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.fragsMz = np.concatenate([np.asarray(fragsMz[k], dtype=float) for k in self.order]) if sizes.sum() > 0 else np.array([])
+        self.fragsIntensity = np.concatenate([np.asarray(fragsIntensity[k], dtype=float) for k in self.order]) if sizes.sum() > 0 else np.array([])
+        rows = np.repeat(np.arange(sizes.size), sizes)
+        bins = np.floor(self.fragsMz / mztolhalfwidth).astype(np.int64)
+        self.nbins = int(bins.max()) + 4 if bins.size > 0 else 4 # room for the bins covered by experimental peaks
+        self.matrix = sparse.csr_matrix((self.fragsIntensity, (rows, bins)), shape=(sizes.size, self.nbins)) # fragments in the same bin are summed
+        self.matrix.sum_duplicates()
+        self.counts = sparse.csr_matrix((np.ones(bins.size), (rows, bins)), shape=(sizes.size, self.nbins)) # fragments per bin
+        self.counts.sum_duplicates()
+        self.norms = np.sqrt(np.bincount(rows, weights=self.fragsIntensity**2, minlength=sizes.size))
+        self.nfragments = sizes
+
+    def Candidates(self, precursorMzs):
+        # (experimental index, library index in input order) of the library entries with a precursor m/z within the tolerance
+        precursorMzs = np.asarray(precursorMzs, dtype=float)
+        starts = np.searchsorted(self.precursorMzs, precursorMzs - self.mztolhalfwidth, side="left")
+        ends = np.searchsorted(self.precursorMzs, precursorMzs + self.mztolhalfwidth, side="right")
+        counts = ends - starts
+        experimental = np.repeat(np.arange(precursorMzs.size), counts)
+        library = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return [experimental, library]
+
+
+def FlattenSpectra(spectra):
+    # [rows, mzs, intensities] of the peaks of all spectra, one after the other
+    sizes = np.array([len(x[0]) for x in spectra], dtype=np.int64)
+    mzs = np.concatenate([np.asarray(x[0], dtype=float) for x in spectra]) if sizes.sum() > 0 else np.array([])
+    intensities = np.concatenate([np.asarray(x[1], dtype=float) for x in spectra]) if sizes.sum() > 0 else np.array([])
+    return [np.repeat(np.arange(sizes.size), sizes), mzs, intensities]
+
+
+def EncodeExperimentalSpectra(spectra, nbins, mztolhalfwidth=0.01):
+    # Sparse matrices (spectra x bins) of the experimental spectra [mz_array, intensity_array]:
+    #   peaks covering the bins of mz +- mztolhalfwidth (max intensity per bin), and norms of the spectra
+    [rows, mzs, intensities] = FlattenSpectra(spectra)
+    norms = np.sqrt(np.bincount(rows, weights=intensities**2, minlength=len(spectra)))
+    reach = mztolhalfwidth * (1 + 1e-9) # covered bins include fragments at the tolerance despite rounding
+    firstBins = np.floor((mzs - reach) / mztolhalfwidth).astype(np.int64)
+    lastBins = np.floor((mzs + reach) / mztolhalfwidth).astype(np.int64)
+    keep = (firstBins < nbins) & (lastBins >= 0)
+    cover = [(rows[keep], np.clip(firstBins[keep] + k, 0, nbins - 1), intensities[keep], firstBins[keep] + k <= lastBins[keep]) for k in range(4)]
+    rows = np.concatenate([x[0][x[3]] for x in cover])
+    bins = np.concatenate([x[1][x[3]] for x in cover])
+    intensities = np.concatenate([x[2][x[3]] for x in cover])
+    # max intensity per (spectrum, bin): sort by intensity and keep the last of each cell
+    order = np.lexsort((intensities, bins, rows))
+    rows, bins, intensities = rows[order], bins[order], intensities[order]
+    last = np.ones(rows.size, dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (bins[1:] != bins[:-1])
+    matrix = sparse.csr_matrix((intensities[last], (rows[last], bins[last])), shape=(len(spectra), nbins))
+    return [matrix, norms]
+
+
+class SortedPeaks:
+    def __init__(self, spectra, span):
+        # Peaks of all experimental spectra sorted by m/z within each spectrum, spectra one after the other:
+        #   keys are the m/z shifted by span x spectrum index (span above the max m/z)
+        [rows, mzs, intensities] = FlattenSpectra(spectra)
+        self.span = span
+        keys = mzs + rows * span
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.mzs = mzs[order]
+        self.intensities = intensities[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(spectra)))]).astype(np.int64)
+
+
+def ExactMatches(library, peaks, experimental, candidates):
+    # Dot products and numbers of matched fragments of (experimental, library) pairs with the raw fragments:
+    #   each library fragment is matched to the most intense experimental peak within +- mztolhalfwidth
+    tol = library.mztolhalfwidth
+    starts = library.offsets[candidates]
+    sizes = library.offsets[candidates + 1] - starts
+    pairs = np.repeat(np.arange(candidates.size), sizes)
+    fragments = np.repeat(starts, sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    fragsMz = library.fragsMz[fragments]
+    spectra = experimental[pairs]
+    # peaks of the spectrum located within twice the tolerance (the shifted keys round), then checked exactly
+    shifts = spectra * peaks.span
+    lows = np.clip(np.searchsorted(peaks.keys, fragsMz + shifts - 2 * tol, side="left"), peaks.offsets[spectra], peaks.offsets[spectra + 1])
+    highs = np.clip(np.searchsorted(peaks.keys, fragsMz + shifts + 2 * tol, side="right"), peaks.offsets[spectra], peaks.offsets[spectra + 1])
+    counts = np.maximum(highs - lows, 0)
+    fragmentPeaks = np.repeat(np.arange(fragments.size), counts)
+    positions = np.repeat(lows, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    close = np.abs(peaks.mzs[positions] - fragsMz[fragmentPeaks]) <= tol
+    fragmentPeaks = fragmentPeaks[close]
+    best = np.zeros(fragments.size)
+    np.maximum.at(best, fragmentPeaks, peaks.intensities[positions[close]])
+    isMatched = np.zeros(fragments.size, dtype=bool)
+    isMatched[fragmentPeaks] = True
+    dots = np.bincount(pairs[isMatched], weights=library.fragsIntensity[fragments[isMatched]] * best[isMatched], minlength=candidates.size)
+    matched = np.bincount(pairs[isMatched], minlength=candidates.size)
+    return [dots, matched]
+
+
+def ScoreSpectraBatch(library, precursorMzs, spectra, minFragments=2, minCosineScore=0.0, chunkSize=100000):
+    # Cosine scores of the experimental spectra (precursor m/z and [mz_array, intensity_array]) against their library candidates.
+    # Returns a data frame of the pairs with at least minFragments matched fragments and a score >= minCosineScore:
+    #   SPECTRUMINDEX (experimental), LIBRARYINDEX (input order of the library), COSINESCORE, MATCHEDFRAGMENTS
+    [experimental, candidates] = library.Candidates(precursorMzs)
+    [expMatrix, expNorms] = EncodeExperimentalSpectra(spectra, library.nbins, library.mztolhalfwidth)
+    expBinary = expMatrix.copy()
+    expBinary.data = np.ones(expBinary.data.size)
+    maxMz = max(library.fragsMz.max(initial=0), max((np.max(x[0], initial=0) for x in spectra), default=0))
+    peaks = SortedPeaks(spectra, maxMz + 4 * library.mztolhalfwidth + 1)
+    scores = np.zeros(experimental.size)
+    matched = np.zeros(experimental.size, dtype=np.int64)
+    for start in range(0, experimental.size, chunkSize):
+        end = min(start + chunkSize, experimental.size)
+        e = experimental[start:end]
+        c = candidates[start:end]
+        # upper bounds of the binned spectra, exact scores of the pairs that can pass the filters
+        upperDots = np.asarray(library.matrix[c].multiply(expMatrix[e]).sum(axis=1)).ravel()
+        upperMatched = np.asarray(library.counts[c].multiply(expBinary[e]).sum(axis=1)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            upperScores = np.minimum(np.nan_to_num(upperDots / (library.norms[c] * expNorms[e])), 1)
+        pairs = np.flatnonzero((upperMatched >= minFragments) & (upperScores >= minCosineScore))
+        [dots, exactMatched] = ExactMatches(library, peaks, e[pairs], c[pairs])
+        matched[start + pairs] = exactMatched
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores[start + pairs] = np.minimum(np.nan_to_num(dots / (library.norms[c[pairs]] * expNorms[e[pairs]])), 1)
+    keep = (matched >= minFragments) & (scores >= minCosineScore)
+    return pd.DataFrame({"SPECTRUMINDEX": experimental[keep],
+                         "LIBRARYINDEX": library.order[candidates[keep]],
+                         "COSINESCORE": scores[keep],
+                         "MATCHEDFRAGMENTS": matched[keep]})
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import pandas as pd
+from multiprocessing.pool import Pool
+from qc.mza_reader import OpenMza
+
+# TMT reporter ion quantification
+# Reporter intensities of every MS/MS scan of an MS run, saved as a compact matrix (scans x channels, float32) in an .npz file
+#   with the scan numbers, retention times and precursor m/z of the scans and the channel names (tmt_reporter_fragments_csv).
+# Spectra are processed in blocks: the points of all spectra of a block are assigned to their reporter window with one
+#   searchsorted against the sorted reporter m/z, and summed per (scan, channel) with one bincount.
+#   If the MS run has an m/z index, the points within the reporter m/z range are read from the index instead of the spectra.
+# Reporter windows (m/z +- mztolhalfwidth) must not overlap, i.e., mztolhalfwidth below half the smallest reporter spacing
+#   (0.0063 Da between the N and C channels of TMT).
+
+
+def ReadReporterFragments(reportersFile):
+    # Returns [names, mzs] of the reporter ions (columns NAME and MZ, comma or tab separated) sorted by m/z
+    df = pd.read_csv(reportersFile, sep=None, engine="python")
+    df.columns = df.columns.str.strip().str.upper()
+    df = df.sort_values("MZ", kind="stable")
+    return [df["NAME"].to_numpy(dtype=str), df["MZ"].to_numpy(dtype=float)]
+
+
+def SumReporterWindows(positions, mz_array, intensity_array, reporterMzs, mztolhalfwidth, nScans):
+    # Summed intensity (nScans x channels) of the points (scan position, mz, intensity) within the reporter windows
+    channels = np.searchsorted(reporterMzs - mztolhalfwidth, mz_array, side="right") - 1
+    inWindow = (channels >= 0) & (mz_array <= reporterMzs[np.maximum(channels, 0)] + mztolhalfwidth)
+    cells = positions[inWindow] * reporterMzs.size + channels[inWindow]
+    sums = np.bincount(cells, weights=intensity_array[inWindow].astype(np.float64), minlength=nScans * reporterMzs.size)
+    return sums.reshape(nScans, reporterMzs.size)
+
+
+def ExtractReporterIntensities(mzaFile, reporterMzs, mztolhalfwidth=0.003, blockSize=1000):
+    # Returns [rows, intensities] of the MS/MS scans of an mza file (rows sorted by retention time, intensities scans x channels)
+    #   for the reporter m/z sorted in increasing order
+    reporterMzs = np.asarray(reporterMzs, dtype=float)
+    lowMz = reporterMzs[0] - mztolhalfwidth
+    highMz = reporterMzs[-1] + mztolhalfwidth
+    with OpenMza(mzaFile) as mza:
+        rows = mza.GetRows(msLevel=2)
+        intensities = np.zeros((rows.size, reporterMzs.size), dtype=np.float32)
+        if rows.size == 0:
+            return [rows, intensities]
+        if mza.index is not None:
+            [mz_array, postingRows, intensity_array] = mza.index.Window(2, False, lowMz, highMz)
+            sortedRows = np.argsort(rows)
+            positions = np.minimum(np.searchsorted(rows[sortedRows], postingRows), rows.size - 1)
+            selected = rows[sortedRows][positions] == postingRows
+            positions = sortedRows[positions[selected]]
+            intensities[:] = SumReporterWindows(positions, mz_array[selected], intensity_array[selected], reporterMzs, mztolhalfwidth, rows.size)
+            return [rows, intensities]
+        for start in range(0, rows.size, blockSize):
+            block = rows[start:start + blockSize]
+            spectra = mza.ReadSpectra(block) # each scan is read once, no need to cache it
+            # points within the reporter m/z range of each spectrum (spectra are sorted by m/z)
+            bounds = [(np.searchsorted(x[0], lowMz, side="left"), np.searchsorted(x[0], highMz, side="right")) for x in spectra]
+            mz_array = np.concatenate([x[0][b[0]:b[1]] for x, b in zip(spectra, bounds)])
+            intensity_array = np.concatenate([x[1][b[0]:b[1]] for x, b in zip(spectra, bounds)])
+            positions = np.repeat(np.arange(block.size), [b[1] - b[0] for b in bounds])
+            intensities[start:start + block.size] = SumReporterWindows(positions, mz_array, intensity_array, reporterMzs, mztolhalfwidth, block.size)
+    return [rows, intensities]
+
+
+def ExtractReporterMatrix(mzaFile, outputFile, reportersFile, mztolhalfwidth=0.003, blockSize=1000):
+    # Saves the reporter matrix of an mza file in outputFile (.npz): INTENSITY (scans x channels, float32), CHANNEL,
+    #   SCAN, RT and PRECURSORMZ (isolation window target m/z) of the MS/MS scans
+    [names, reporterMzs] = ReadReporterFragments(reportersFile)
+    [rows, intensities] = ExtractReporterIntensities(mzaFile, reporterMzs, mztolhalfwidth, blockSize)
+    with OpenMza(mzaFile) as mza:
+        metadata = mza.metadata[rows]
+    with open(outputFile, "wb") as f: # file object: np.savez adds no extension
+        np.savez(f, INTENSITY=intensities, CHANNEL=names, SCAN=metadata["Scan"], RT=metadata["RetentionTime"],
+                 PRECURSORMZ=metadata["IsolationWindowTargetMz"])
+
+
+def LoadReporterMatrix(reporterFile):
+    # Returns a data frame with the columns SCAN, RT, PRECURSORMZ and one column of reporter intensities per channel
+    with np.load(reporterFile) as data:
+        df = pd.DataFrame(data["INTENSITY"], columns=data["CHANNEL"])
+        df.insert(0, "PRECURSORMZ", data["PRECURSORMZ"])
+        df.insert(0, "RT", data["RT"])
+        df.insert(0, "SCAN", data["SCAN"])
+    return df
+
+
+def ExtractReporterMatrices(mzaFiles, outputFolder, reportersFile, mztolhalfwidth=0.003, nProcesses=1, blockSize=1000):
+    # Reporter matrices of several MS runs (one process per MS run), saved as <outputFolder>/<run>-reporters.npz
+    os.makedirs(outputFolder, exist_ok=True)
+    outputFiles = [os.path.join(outputFolder, os.path.splitext(os.path.basename(x))[0] + "-reporters.npz") for x in mzaFiles]
+    if nProcesses > 1 and len(mzaFiles) > 1:
+        with Pool(min(nProcesses, len(mzaFiles))) as pool:
+            results = [pool.apply_async(ExtractReporterMatrix, args=(x, y, reportersFile, mztolhalfwidth, blockSize)) for x, y in zip(mzaFiles, outputFiles)]
+            for x in results:
+                x.get()
+    else:
+        for x, y in zip(mzaFiles, outputFiles):
+            ExtractReporterMatrix(x, y, reportersFile, mztolhalfwidth, blockSize)
+    return outputFiles
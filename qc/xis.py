@@ -1,44 +1,114 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
-from mza.mza import CreateMZA, Extract2DIonIntensityFrame
+import pandas as pd
+from qc.mza_reader import OpenMza, SumIntensityWindows
 
-def GenerateXISurfacePlot(mzaFile, outputFilename, molecule, precMz, rt, at, mzHalfWindowXIC=0.01, rtrange=0.3, atrange=1.5):
+def GenerateXISurfacePlot(mzaFile, outputFilename, molecule, precMz, rt, at, mzHalfWindowXIC=0.01, rtrange=0.3, atrange=1.5, returnPlots=False):
+    # mzaFile: path to the mza file or an open MzaReader
+    # returnPlots: return the plot spec (list) drawn by RenderXISurfacePlot instead of drawing the figure, e.g., for a RenderQueue
     # Check if ion mobility data:
-    with CreateMZA(mzaFile) as mza:
-        metadata = mza["Metadata"]
+    with OpenMza(mzaFile) as mza:
+        metadata = mza.metadata
         metadata = metadata[(metadata["MSLevel"] == 1)]
         if len(metadata["IonMobilityBin"] > 0) == 0:
-            return # data has no ion mobility separation
+            return [] # data has no ion mobility separation
 
-        df = Extract2DIonIntensityFrame(mza, precMz, msLevel=1, startRT = rt-rtrange, endRT = rt+rtrange, startAT = at-atrange, endAT = at+atrange, mztolhalfwidth=mzHalfWindowXIC)
+        df = mza.Extract2DIonIntensityFrame(precMz, msLevel=1, startRT = rt-rtrange, endRT = rt+rtrange, startAT = at-atrange, endAT = at+atrange, mztolhalfwidth=mzHalfWindowXIC)
         df = df[df["intensity"] >= 1]
-        # TODO: need to adjust figure size (w x h) and marker size (s) based on sampling frequency
-        figWidth = 5 #len(np.unique(df["rtbin"]))/10 # 6.2 
-        figHeight = 5 #len(np.unique(df["atbin"]))/10 #6
-        #print(molecule)
-        #print("w h = " + str(figWidth) + " " + str(figHeight))
-        fig, ax = plt.subplots()
-        ax.patch.set_facecolor('black')  # Set background color to black
-        ax.set_xlim(rt-rtrange, rt+rtrange)
-        ax.set_ylim(at-atrange, at+atrange)
-        fig.set_figwidth(figWidth)
-        fig.set_figheight(figHeight) # 12 for proteomics and 6 for metabolomics
-        scatter = ax.scatter(x=df["rt"], 
-                    y=df["at"], 
-                    c=np.log10(df["intensity"]), 
-                    cmap='viridis',
-                    marker ='s',
-                    s=30,
-                    #linewidths = 0.9,
-                    edgecolors = 'face')
-        
-        ax.set_xlabel("Retention time")
-        ax.set_ylabel("Arrival time")
-        # Add color bar
-        cbar = plt.colorbar(scatter)
-        cbar.set_label('Log10(Intensity)')
-        fig.suptitle(f"Extracted ion surface for {molecule}")
-        plt.savefig(outputFilename + ".jpg")
-        plt.savefig(outputFilename + ".pdf")
-        plt.close(fig)
+    plotSpec = {"outputFilename": outputFilename, "molecule": molecule, "rt": df["rt"], "at": df["at"], "intensity": df["intensity"],
+                "rtlim": (rt-rtrange, rt+rtrange), "atlim": (at-atrange, at+atrange)}
+    if returnPlots:
+        return [plotSpec]
+    RenderXISurfacePlot(plotSpec)
+
+
+def GenerateXISurfacePlotBatch(mzaFile, xisIons, returnPlots=False):
+    # XIS plots of all ions of one MS run, opening the mza file once.
+    # xisIons: list of the arguments of GenerateXISurfacePlot after mzaFile for each ion:
+    #   (outputFilename, molecule, precMz, rt, at, mzHalfWindowXIC, rtrange, atrange)
+    # returnPlots: return the plot specs drawn by RenderXISurfacePlot instead of drawing the figures, e.g., for a RenderQueue
+    with OpenMza(mzaFile) as mza:
+        metadata = mza.metadata
+        metadata = metadata[(metadata["MSLevel"] == 1)]
+        if len(metadata["IonMobilityBin"] > 0) == 0:
+            return [] # data has no ion mobility separation
+        ions = np.array([x[2:8] for x in xisIons], dtype=float).reshape(-1, 6)
+        [precMzs, rts, ats, mzTols, rtRanges, atRanges] = ions.T
+        frames = ExtractIonIntensityFramesBatch(mza, precMzs, rts - rtRanges, rts + rtRanges, ats - atRanges, ats + atRanges, mzTols)
+
+    plotSpecs = []
+    for x, df in zip(xisIons, frames):
+        [outputFilename, molecule, precMz, rt, at, mzHalfWindowXIC, rtrange, atrange] = x
+        df = df[df["intensity"] >= 1]
+        plotSpecs.append({"outputFilename": outputFilename, "molecule": molecule, "rt": df["rt"], "at": df["at"], "intensity": df["intensity"],
+                          "rtlim": (rt-rtrange, rt+rtrange), "atlim": (at-atrange, at+atrange)})
+    if returnPlots:
+        return plotSpecs
+    for x in plotSpecs:
+        RenderXISurfacePlot(x)
+
+
+def ExtractIonIntensityFramesBatch(mzaFile, mzs, startRTs, endRTs, startATs, endATs, mztolhalfwidths):
+    # Extract2DIonIntensityFrame of MzaReader for all ions, reading each ion mobility scan of the MS run once
+    #   (or querying the m/z index of the MS run if it exists). Returns a list of data frames (rt, at, intensity) in the order of the ions.
+    with OpenMza(mzaFile) as mza:
+        if mza.index is not None:
+            return [mza.Extract2DIonIntensityFrame(mzs[k], msLevel=1, startRT=startRTs[k], endRT=endRTs[k], startAT=startATs[k], endAT=endATs[k], mztolhalfwidth=mztolhalfwidths[k]) 
+                    for k in range(len(mzs))]
+        rows = mza.GetRows(msLevel=1, ionMobility=True)
+        rts = mza.metadata["RetentionTime"][rows]
+        ats = mza.metadata["IonMobilityTime"][rows]
+        # scan positions of each ion: RT range located with searchsorted (rows sorted by retention time), then AT range
+        starts = np.searchsorted(rts, startRTs, side="left")
+        ends = np.searchsorted(rts, endRTs, side="right")
+        positions = []
+        for k in range(len(mzs)):
+            x = np.arange(starts[k], max(starts[k], ends[k]))
+            positions.append(x[(ats[x] >= startATs[k]) & (ats[x] <= endATs[k])])
+        sizes = np.array([x.size for x in positions], dtype=np.int64)
+        ionPositions = np.concatenate(positions) if len(positions) > 0 else np.array([], dtype=np.int64)
+        ions = np.repeat(np.arange(len(mzs)), sizes)
+        intensities = np.zeros(ionPositions.size)
+        # (ion, scan) pairs grouped by scan
+        order = np.argsort(ionPositions, kind="stable")
+        scans, firsts = np.unique(ionPositions[order], return_index=True)
+        for i, pairs in zip(scans, np.split(order, firsts[1:])):
+            active = ions[pairs]
+            mz_array, intensity_array = mza.ReadSpectrum(rows[i]) # each scan is read once, no need to cache it
+            intensities[pairs] = SumIntensityWindows(mz_array, intensity_array, mzs[active] - mztolhalfwidths[active], mzs[active] + mztolhalfwidths[active])
+    return [pd.DataFrame({"rt": rts[x], "at": ats[x], "intensity": y}) for x, y in zip(positions, np.split(intensities, np.cumsum(sizes)[:-1]))]
+
+
+def RenderXISurfacePlot(plotSpec):
+    # Draws and saves (.jpg and .pdf) the figure of a plot spec from GenerateXISurfacePlot
+    p = plotSpec
+    # TODO: need to adjust figure size (w x h) and marker size (s) based on sampling frequency
+    figWidth = 5 #len(np.unique(df["rtbin"]))/10 # 6.2 
+    figHeight = 5 #len(np.unique(df["atbin"]))/10 #6
+    #print(molecule)
+    #print("w h = " + str(figWidth) + " " + str(figHeight))
+    fig, ax = plt.subplots()
+    ax.patch.set_facecolor('black')  # Set background color to black
+    ax.set_xlim(*p["rtlim"])
+    ax.set_ylim(*p["atlim"])
+    fig.set_figwidth(figWidth)
+    fig.set_figheight(figHeight) # 12 for proteomics and 6 for metabolomics
+    scatter = ax.scatter(x=p["rt"], 
+                y=p["at"], 
+                c=np.log10(p["intensity"]), 
+                cmap='viridis',
+                marker ='s',
+                s=30,
+                #linewidths = 0.9,
+                edgecolors = 'face')
+    
+    ax.set_xlabel("Retention time")
+    ax.set_ylabel("Arrival time")
+    # Add color bar
+    cbar = plt.colorbar(scatter)
+    cbar.set_label('Log10(Intensity)')
+    fig.suptitle(f"Extracted ion surface for {p['molecule']}")
+    plt.savefig(p["outputFilename"] + ".jpg")
+    plt.savefig(p["outputFilename"] + ".pdf")
+    plt.close(fig)